@@ -0,0 +1,398 @@
+#! /usr/bin/env python
+"""
+Benchmark the build and classification hot paths on synthetic data.
+
+Briefly,
+
+* generate a random taxonomy (as nodes.dmp/names.dmp) and time parsing it,
+  building the LCA tables and the compact .taxdb file, and find_lca;
+* for each database size, scaled and ksize, generate random hash values
+  below the scaled cutoff, each assigned to a few random species, and time
+  the LCA reduction, saving and loading the database in each format,
+  classifying synthetic queries with classify.py, rendering the report,
+  and loading and classifying with free-tax-2.py;
+* write the wall time and memory for each phase to a JSON file.
+
+Usage::
+
+   benchmark.py -o bench-$(git rev-parse --short HEAD).json
+   benchmark.py --sizes 1e4,1e5,1e6,1e7,1e8 -o big.json
+   benchmark.py -o new.json --compare bench-old.json
+
+The LCA reduction and the pickle format work on Python dictionaries, so
+they are only run for sizes up to --max-dict-size.
+"""
+import argparse
+import contextlib
+import gc
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, OrderedDict
+from pickle import dump
+
+import numpy
+
+import classify
+import extract
+import lca_index
+import lca_json
+import lineage_db
+import ncbi_taxdump_utils
+import profiling
+
+RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus',
+         'species']
+
+
+def load_script(name):
+    "Import one of the hyphenated scripts here as a module."
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'),
+                                                  filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_taxonomy(n_nodes, rng):
+    """
+    Make a random tree of about 'n_nodes' taxids, one level per rank, with
+    each level twice as wide as the one above it.  Returns (parents, ranks,
+    species) where 'species' is an array of the leaf taxids.
+    """
+    weights = numpy.array([ 2.0**i for i in range(len(RANKS)) ])
+    level_sizes = numpy.maximum((weights / weights.sum() * n_nodes).astype(int),
+                                1)
+
+    parents = { 1: 1 }
+    ranks = { 1: 'no rank' }
+    above = numpy.array([1])
+    next_taxid = 2
+    for rank, size in zip(RANKS, level_sizes):
+        level = numpy.arange(next_taxid, next_taxid + size)
+        for taxid, parent in zip(level.tolist(),
+                                 rng.choice(above, size).tolist()):
+            parents[taxid] = parent
+            ranks[taxid] = rank
+        above = level
+        next_taxid += size
+
+    return parents, ranks, above
+
+
+def write_taxdump(dirname, parents, ranks):
+    "Write 'parents' and 'ranks' as NCBI nodes.dmp and names.dmp files."
+    nodes_file = os.path.join(dirname, 'nodes.dmp')
+    names_file = os.path.join(dirname, 'names.dmp')
+
+    with open(nodes_file, 'wt') as fp:
+        for taxid, parent in parents.items():
+            fields = [taxid, parent, ranks[taxid], '', 0, 0, 11, 0, 0, 0, 0,
+                      0, '']
+            fp.write('\t|\t'.join(map(str, fields)) + '\t|\n')
+
+    with open(names_file, 'wt') as fp:
+        for taxid in parents:
+            fp.write('{}\t|\t{} {}\t|\t\t|\tscientific name\t|\n'.format(taxid, ranks[taxid], taxid))
+
+    return nodes_file, names_file
+
+
+def make_hashvals(size, scaled, rng):
+    "Make 'size' distinct random hash values kept at 'scaled'."
+    max_hash = lca_index.max_hash_for_scaled(scaled)
+    hashvals = numpy.unique(rng.integers(0, max_hash, size, dtype=numpy.uint64,
+                                         endpoint=True))
+    while len(hashvals) < size:
+        more = rng.integers(0, max_hash, size - len(hashvals),
+                            dtype=numpy.uint64, endpoint=True)
+        hashvals = numpy.unique(numpy.concatenate([hashvals, more]))
+    return hashvals
+
+
+def make_query(hashvals, query_size, scaled, rng, frac_found=0.5):
+    "Make a query of 'query_size' hash values, 'frac_found' from 'hashvals'."
+    n_found = min(int(query_size * frac_found), len(hashvals))
+    found = rng.choice(hashvals, n_found, replace=False)
+    not_found = make_hashvals(query_size - n_found, scaled, rng)
+    return numpy.unique(numpy.concatenate([found, not_found]))
+
+
+class QuerySignature(object):
+    "Just enough of a signature for free-tax-2.classify_signature."
+    def __init__(self, hashvals):
+        self.hashvals = hashvals.tolist()
+        self.minhash = self
+
+    def get_mins(self):
+        return self.hashvals
+
+
+class Benchmark(object):
+    def __init__(self, args, profile):
+        self.args = args
+        self.profile = profile
+        self.rng = numpy.random.default_rng(args.seed)
+        self.tempdir = tempfile.mkdtemp(prefix='benchmark-',
+                                        dir=args.tempdir)
+        self.free_tax_2 = load_script('free-tax-2')
+
+    def phase(self, name, **info):
+        gc.collect()
+        print('...', name, ' '.join([ '{}={}'.format(k, v)
+                                      for (k, v) in info.items() ]),
+              file=sys.stderr)
+        return self.profile.phase(name, **info)
+
+    def run(self):
+        try:
+            self.run_taxonomy()
+            for size in self.args.sizes:
+                for scaled in self.args.scaled:
+                    for ksize in self.args.ksizes:
+                        self.run_database(size, scaled, ksize)
+        finally:
+            shutil.rmtree(self.tempdir)
+
+    def run_taxonomy(self):
+        n_nodes = self.args.taxonomy_size
+        parents, ranks, self.species = make_taxonomy(n_nodes, self.rng)
+        nodes_file, names_file = write_taxdump(self.tempdir, parents, ranks)
+
+        with self.phase('parse_nodes', n_nodes=len(parents)):
+            ncbi_taxdump_utils.parse_nodes(nodes_file)
+        with self.phase('parse_names', n_nodes=len(parents)):
+            ncbi_taxdump_utils.parse_names(names_file)
+
+        taxfoo = ncbi_taxdump_utils.NCBI_TaxonomyFoo()
+        taxfoo.load_nodes_dmp(nodes_file, False)
+        taxfoo.load_names_dmp(names_file, False)
+        with self.phase('build_lca_index', n_nodes=len(parents)):
+            taxfoo.build_lca_index()
+
+        taxdb_file = nodes_file + '.taxdb'
+        with self.phase('taxdb_save', n_nodes=len(parents)):
+            compact = ncbi_taxdump_utils.NCBI_CompactTaxonomyFoo.from_taxonomy(taxfoo)
+            compact.save_taxonomy_db(taxdb_file)
+        with self.phase('taxdb_load', n_nodes=len(parents)):
+            self.taxfoo = ncbi_taxdump_utils.load_taxonomy(nodes_file)
+            self.taxfoo.build_lca_index()
+
+        n_sets = self.args.n_lca_sets
+        taxid_sets = [ set(self.rng.choice(self.species,
+                                           self.rng.integers(1, 6)).tolist())
+                       for i in range(n_sets) ]
+        with self.phase('find_lca', n_sets=n_sets):
+            for taxid_set in taxid_sets:
+                self.taxfoo.find_lca(taxid_set)
+
+        self.lineages = {}
+        for lineage_id, taxid in enumerate(self.species[:1000].tolist()):
+            lineage = self.taxfoo.get_lineage(taxid, RANKS)
+            self.lineages[lineage_id] = list(zip(RANKS, lineage))
+
+    def run_database(self, size, scaled, ksize):
+        args = self.args
+        info = OrderedDict(size=size, scaled=scaled, ksize=ksize)
+        rng = self.rng
+
+        # each hash value is assigned to 1-3 random species.
+        hashvals = make_hashvals(size, scaled, rng)
+        n_assigned = rng.integers(1, 4, len(hashvals))
+        offsets = numpy.zeros(len(hashvals) + 1, dtype=numpy.int64)
+        numpy.cumsum(n_assigned, out=offsets[1:])
+        assigned = rng.choice(self.species, int(offsets[-1])).astype(numpy.uint32)
+
+        if size <= args.max_dict_size:
+            hashval_to_taxids = defaultdict(set)
+            for hashval, start, end in zip(hashvals.tolist(),
+                                           offsets[:-1].tolist(),
+                                           offsets[1:].tolist()):
+                hashval_to_taxids[hashval].update(assigned[start:end].tolist())
+
+            with self.phase('lca_reduction', **info):
+                hashval_to_lca, _, _ = extract.find_lcas(hashval_to_taxids,
+                                                         self.taxfoo)
+            del hashval_to_taxids
+            index = lca_index.LCA_Index.from_dict(hashval_to_lca)
+        else:
+            hashval_to_lca = None
+            index = lca_index.LCA_Index(hashvals, assigned[offsets[:-1]])
+
+        formats = [('index', lca_index.LCA_Index.save),
+                   ('packed', lambda index, filename:
+                        lca_index.PackedLCA_Index.from_arrays(index.hashvals,
+                                                              index.taxids).save(filename))]
+        if hashval_to_lca is not None:
+            def save_pickle(index, filename):
+                with open(filename, 'wb') as fp:
+                    dump(hashval_to_lca, fp)
+            formats.append(('pickle', save_pickle))
+
+        queries = [ make_query(hashvals, args.query_size, scaled, rng)
+                    for i in range(args.n_queries) ]
+
+        for format, save in formats:
+            filename = os.path.join(self.tempdir, 'db.' + format)
+            with self.phase('db_save', format=format, **info):
+                save(index, filename)
+
+            with self.phase('db_load', format=format, **info) as record:
+                db = lca_json.load_lca_file(filename)
+                record['file_size'] = os.path.getsize(filename)
+
+            with self.phase('classify_query', format=format,
+                            n_queries=len(queries), **info) as record:
+                results = []
+                for query in queries:
+                    counts = numpy.ones(len(query), dtype=numpy.int64)
+                    results.append(classify.classify_hashvals(db, query,
+                                                              counts)[0])
+                n_found = sum([ len(query) - by_taxid.get(0, 0)
+                                for query, by_taxid in zip(queries, results) ])
+                record['hit_rate'] = n_found / sum(map(len, queries))
+
+            del db
+            os.unlink(filename)
+
+        with self.phase('render_report', n_queries=len(queries), **info):
+            for by_taxid in results:
+                classify.make_report(self.taxfoo, by_taxid)
+
+        del hashval_to_lca, index
+        self.run_free_tax_2(hashvals, queries, info)
+
+    def run_free_tax_2(self, hashvals, queries, info):
+        "Benchmark loading and classifying with a v3 free-tax-2.py database."
+        rng = self.rng
+        n_lineages = len(self.lineages)
+
+        n_assigned = rng.integers(1, 3, len(hashvals))
+        offsets = numpy.zeros(len(hashvals) + 1, dtype=numpy.int64)
+        numpy.cumsum(n_assigned, out=offsets[1:])
+        lineage_ids = rng.integers(0, n_lineages, int(offsets[-1]))
+
+        filename = os.path.join(self.tempdir, 'db.lca')
+        lineage_db.save_lineage_db(filename, info['ksize'], info['scaled'],
+                                   self.lineages, hashvals, offsets,
+                                   lineage_ids, {})
+
+        with self.phase('free_tax_2_load', **info):
+            db = self.free_tax_2.LCA_Database()
+            db.load(filename)
+
+        sigs = [ QuerySignature(query) for query in queries ]
+        with self.phase('free_tax_2_classify', n_queries=len(sigs), **info):
+            for sig in sigs:
+                self.free_tax_2.classify_signature(sig, [db],
+                                                   self.free_tax_2.DEFAULT_THRESHOLD)
+
+        del db
+        os.unlink(filename)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def phase_key(phase):
+    "Identify a phase across runs, ignoring the measurements."
+    skip = ('seconds', 'rss', 'peak_rss', 'peak_rss_is_per_phase', 'hit_rate',
+            'file_size')
+    return tuple([ (k, v) for (k, v) in phase.items() if k not in skip ])
+
+
+def compare(baseline, phases):
+    "Print the time and peak RSS of 'phases' relative to 'baseline'."
+    old = dict([ (phase_key(phase), phase) for phase in baseline['phases'] ])
+
+    print('{:<60} {:>10} {:>10} {:>8} {:>8}'.format('phase', 'old (s)',
+                                                    'new (s)', 'time', 'mem'))
+    for phase in phases:
+        key = phase_key(phase)
+        if key not in old:
+            continue
+        before = old[key]
+        name = ' '.join([ str(v) for (k, v) in key ])
+        time_ratio = phase['seconds'] / max(before['seconds'], 1e-9)
+        mem_ratio = phase['peak_rss'] / max(before['peak_rss'], 1)
+        print('{:<60} {:>10.4f} {:>10.4f} {:>7.2f}x {:>7.2f}x'.format(name, before['seconds'], phase['seconds'], time_ratio, mem_ratio))
+
+
+def int_value(s):
+    "Parse an integer, allowing e.g. '1e6'."
+    return int(float(s))
+
+
+def int_list(s):
+    return [ int_value(x) for x in s.split(',') ]
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('-o', '--output', type=argparse.FileType('wt'),
+                   help='write the results as JSON to this file')
+    p.add_argument('--compare', type=argparse.FileType('rt'),
+                   help='compare against the results in this JSON file')
+    p.add_argument('--sizes', default='1e4,1e5,1e6', type=int_list,
+                   help='comma-separated database sizes, in hashes (default: 1e4,1e5,1e6)')
+    p.add_argument('--scaled', default='10000', type=int_list,
+                   help='comma-separated scaled values (default: 10000)')
+    p.add_argument('-k', '--ksizes', default='31', type=int_list,
+                   help='comma-separated ksizes (default: 31)')
+    p.add_argument('--taxonomy-size', default=100000, type=int,
+                   help='number of taxids in the synthetic taxonomy')
+    p.add_argument('--n-lca-sets', default=100000, type=int,
+                   help='number of taxid sets to time find_lca on')
+    p.add_argument('--n-queries', default=100, type=int)
+    p.add_argument('--query-size', default=500, type=int,
+                   help='hashes per query signature')
+    p.add_argument('--max-dict-size', default=1000000, type=int_value,
+                   help='largest size to run the dictionary-based LCA reduction and pickle format at')
+    p.add_argument('--seed', default=1, type=int)
+    p.add_argument('--tempdir', default=None)
+    args = p.parse_args()
+
+    # keep the progress output of the code under test off stdout.
+    profile = profiling.Profile()
+    start = time.time()
+    with contextlib.redirect_stdout(sys.stderr):
+        Benchmark(args, profile).run()
+
+    results = OrderedDict()
+    results['commit'] = git_commit()
+    results['date'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start))
+    results['python'] = platform.python_version()
+    results['numpy'] = numpy.__version__
+    results['platform'] = platform.platform()
+    results['args'] = dict([ (k, v) for (k, v) in vars(args).items()
+                             if k not in ('output', 'compare') ])
+    results['phases'] = profile.phases
+
+    if args.output:
+        json.dump(results, args.output, indent=2)
+        args.output.write('\n')
+        print('wrote results to', args.output.name, file=sys.stderr)
+
+    if args.compare:
+        compare(json.load(args.compare), profile.phases)
+    elif not args.output:
+        json.dump(results, sys.stdout, indent=2)
+        print('')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,19 +2,21 @@
 """
 Load a genbank-free lineage, anchor with genbank.
 """
+import os
 import sys
 import argparse
 import csv
 import traceback
 import ncbi_taxdump_utils
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 import itertools
 import pprint
+import numpy
 import sourmash_lib
 import lca_json                      # from github.com/ctb/2017-sourmash-lca
+import lineage_db
 
 LCA_DBs = ['db/genbank.lca.json']
-SCALED=10000
 THRESHOLD=5                               # how many counts of a taxid at min
 
 sys.path.insert(0, '../2017-sourmash-revindex')
@@ -242,39 +244,49 @@ def test_build_reverse_tree_3():
                         ('rank1', 'name1'): ('root', 'root') }
 
 
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('csv')
-    p.add_argument('revindex')
-    p.add_argument('siglist', nargs='+')
-    p.add_argument('--lca', nargs='+', default=LCA_DBs)
-    p.add_argument('-k', '--ksize', default=31, type=int)
-    p.add_argument('-o', '--output', type=argparse.FileType('wt'),
-                   help='output CSV to this file instead of stdout')
-    #p.add_argument('-v', '--verbose', action='store_true')
-    p.add_argument('-d', '--debug', action='store_true')
-    args = p.parse_args()
+def get_ncbi_lineage(taxfoo, taxid):
+    """
+    Return the NCBI lineage of 'taxid' as a tuple of (rank, name), down
+    to just before the first rank in 'taxlist' that it is missing.
+    """
+    lineage = taxfoo.get_lineage_tuple(taxid, taxlist)
+    for i, ((rank, _), want_rank) in enumerate(zip(lineage, taxlist)):
+        if rank != want_rank:
+            return lineage[:i]
+    return lineage[:len(taxlist)]
 
-    if args.debug:
-        global _print_debug
-        _print_debug = True
 
-    ## load LCA databases
-    lca_db_list = []
-    for lca_filename in args.lca:
-        print('loading LCA database from {}'.format(lca_filename),
-              file=sys.stderr)
-        lca_db = lca_json.LCA_Database(lca_filename)
-        taxfoo, hashval_to_lca, _ = lca_db.get_database(args.ksize, SCALED)
-        lca_db_list.append((taxfoo, hashval_to_lca))
-    
+def test_get_ncbi_lineage():
+    taxfoo = ncbi_taxdump_utils.NCBI_TaxonomyFoo()
+    taxfoo.child_to_parent = { 2: 1, 3: 2, 4: 3, 5: 4, 6: 2, 7: 6 }
+    taxfoo.node_to_info = { 2: ('superkingdom',), 3: ('phylum',),
+                            4: ('no rank',), 5: ('class',),
+                            6: ('phylum',), 7: ('order',) }
+    taxfoo.taxid_to_names = dict([ (taxid, ('n{}'.format(taxid),))
+                                   for taxid in taxfoo.node_to_info ])
+
+    assert get_ncbi_lineage(taxfoo, 5) == \
+      (('superkingdom', 'n2'), ('phylum', 'n3'), ('class', 'n5'))
+
+    # no class: stop at the phylum, as 'taxlist' order requires.
+    assert get_ncbi_lineage(taxfoo, 7) == \
+      (('superkingdom', 'n2'), ('phylum', 'n6'))
+
+
+def load_custom_assignments(csv_filename, revindex_filename, taxfoo):
+    """
+    Anchor the lineages in the spreadsheet 'csv_filename' to the NCBI
+    taxonomy, and connect them to hashvals via the custom genome
+    signatures in the revindex.  Returns (hashval_to_custom, ksize), where
+    'hashval_to_custom' is a dictionary of hashval -> list of lineages.
+    """
     # reverse index names -> taxids
     names_to_taxids = defaultdict(set)
     for taxid, (name, _, _) in taxfoo.taxid_to_names.items():
         names_to_taxids[name].add(taxid)
 
     ### parse spreadsheet
-    r = csv.reader(open(args.csv, 'rt'))
+    r = csv.reader(open(csv_filename, 'rt'))
     row_headers = ['identifier'] + taxlist
 
     print('examining spreadsheet headers...', file=sys.stderr)
@@ -366,8 +378,8 @@ def main():
     ## next phase: collapse lineages etc.
 
     ## load revindex
-    print('loading reverse index:', args.revindex, file=sys.stderr)
-    custom_bins_ri = revindex_utils.HashvalRevindex(args.revindex)
+    print('loading reverse index:', revindex_filename, file=sys.stderr)
+    custom_bins_ri = revindex_utils.HashvalRevindex(revindex_filename)
 
     # load the signatures associated with each revindex.
     print('loading signatures for custom genomes...', file=sys.stderr)
@@ -397,6 +409,212 @@ def main():
 
     # whew! done!! we can now go from a hashval to a custom assignment!!
 
+    return hashval_to_custom, ksize
+
+
+class CustomIndex(object):
+    """
+    The hashval -> custom lineages mapping from 'load_custom_assignments',
+    saved in the lineage_db (v3) format: each distinct lineage is stored
+    once, in the header, and the hashvals and their lineage ids are
+    mmapped.  Loaded by mmap on later runs.
+
+    'sources' records the spreadsheet and revindex the index was built
+    from, as name -> [path, mtime]; see 'get_sources'.
+    """
+    def __init__(self, lineages, hashvals, offsets, lineage_ids, ksize,
+                 sources=None):
+        self.lineages = lineages
+        self.hashvals = hashvals
+        self.offsets = offsets
+        self.lineage_ids = lineage_ids
+        self.ksize = ksize
+        self.sources = sources
+
+    @classmethod
+    def from_dict(cls, hashval_to_custom, ksize, sources=None):
+        "Build from a hashval -> list of lineages dictionary."
+        lineage_idx = {}
+        hashval_to_lineage = {}
+        for hashval, assignments in hashval_to_custom.items():
+            hashval_to_lineage[hashval] = \
+              [ lineage_idx.setdefault(tuple(lineage), len(lineage_idx))
+                for lineage in assignments ]
+
+        lineages = [None] * len(lineage_idx)
+        for lineage, idx in lineage_idx.items():
+            lineages[idx] = list(lineage)
+
+        hashvals, offsets, lineage_ids = \
+          lineage_db.hashval_assignments_to_arrays(hashval_to_lineage)
+        return cls(lineages, hashvals, offsets, lineage_ids, ksize, sources)
+
+    def save(self, filename):
+        lineage_dict = OrderedDict(enumerate(self.lineages))
+        lineage_db.save_lineage_db(filename, self.ksize, None, lineage_dict,
+                                   self.hashvals, self.offsets,
+                                   self.lineage_ids, {},
+                                   sources=self.sources)
+
+    @classmethod
+    def load(cls, filename):
+        header, hashvals, offsets, lineage_ids = \
+          lineage_db.load_lineage_db(filename)
+
+        lineages = [None] * len(header['lineages'])
+        for idx, lineage in header['lineages'].items():
+            lineages[int(idx)] = list(lineage.items())
+
+        return cls(lineages, hashvals, offsets, lineage_ids, header['ksize'],
+                   header.get('sources'))
+
+    def get(self, hashval, default=None):
+        key = numpy.uint64(hashval)
+        i = int(numpy.searchsorted(self.hashvals, key))
+        if i < len(self.hashvals) and self.hashvals[i] == key:
+            return [ self.lineages[idx] for idx in
+                     self.lineage_ids[self.offsets[i]:self.offsets[i + 1]].tolist() ]
+        return default
+
+    def __len__(self):
+        return len(self.hashvals)
+
+
+def test_custom_index(tmpdir):
+    filename = str(tmpdir.join('custom.idx'))
+    lineage_a = [('superkingdom', 'a'), ('phylum', 'b')]
+    lineage_c = [('superkingdom', 'c')]
+    hashval_to_custom = { 2**64 - 1: [lineage_a], 5: [lineage_c, lineage_a] }
+    sources = { 'csv': ['/a/b.csv', 1.5] }
+
+    CustomIndex.from_dict(hashval_to_custom, 31, sources).save(filename)
+    custom_index = CustomIndex.load(filename)
+
+    assert custom_index.ksize == 31
+    assert custom_index.sources == sources
+    assert len(custom_index) == 2
+    assert custom_index.get(5) == [lineage_c, lineage_a]
+    assert custom_index.get(2**64 - 1) == [lineage_a]
+    assert custom_index.get(6, []) == []
+
+
+def get_sources(csv_filename, revindex_filename):
+    "The files a CustomIndex is built from, with their modification times."
+    return dict([ (name, [os.path.abspath(filename),
+                          os.path.getmtime(filename)])
+                  for (name, filename) in (('csv', csv_filename),
+                                           ('revindex', revindex_filename)) ])
+
+
+def load_custom_index(filename, csv_filename, revindex_filename, taxfoo,
+                      ksize):
+    """
+    Load the CustomIndex in 'filename'.  If it doesn't exist, or was built
+    from a different spreadsheet or revindex, or they have changed since,
+    build it with 'load_custom_assignments' and save it there first.
+    Raises ValueError if the index isn't for k-mer size 'ksize'.
+    """
+    sources = get_sources(csv_filename, revindex_filename)
+
+    custom_index = None
+    if os.path.exists(filename):
+        print('loading custom lineage index from:', filename, file=sys.stderr)
+        custom_index = CustomIndex.load(filename)
+        if custom_index.sources != sources:
+            print('** spreadsheet or revindex changed since {} was built; rebuilding'.format(filename), file=sys.stderr)
+            custom_index = None
+
+    if custom_index is None:
+        hashval_to_custom, custom_ksize = \
+          load_custom_assignments(csv_filename, revindex_filename, taxfoo)
+
+        print('saving custom lineage index to:', filename, file=sys.stderr)
+        custom_index = CustomIndex.from_dict(hashval_to_custom, custom_ksize,
+                                             sources)
+        custom_index.save(filename)
+
+    if custom_index.ksize != ksize:
+        raise ValueError('custom lineage index {} has ksize {}, not {}'.format(filename, custom_index.ksize, ksize))
+
+    return custom_index
+
+
+def test_load_custom_index(tmpdir, monkeypatch):
+    filename = str(tmpdir.join('custom.idx'))
+    csv_filename = str(tmpdir.join('custom.csv'))
+    revindex_filename = str(tmpdir.join('custom.revindex'))
+    for source in (csv_filename, revindex_filename):
+        with open(source, 'wt') as fp:
+            fp.write('v1')
+
+    lineage_a = [('superkingdom', 'a')]
+    builds = []
+    def fake_load_custom_assignments(csv_filename, revindex_filename, taxfoo):
+        builds.append(csv_filename)
+        return { 5: [lineage_a] }, 31
+
+    monkeypatch.setattr(sys.modules[__name__], 'load_custom_assignments',
+                        fake_load_custom_assignments)
+
+    custom_index = load_custom_index(filename, csv_filename,
+                                     revindex_filename, None, 31)
+    assert custom_index.get(5) == [lineage_a]
+    assert len(builds) == 1
+
+    load_custom_index(filename, csv_filename, revindex_filename, None, 31)
+    assert len(builds) == 1
+
+    # a changed revindex means a rebuild...
+    os.utime(revindex_filename, (0, 0))
+    load_custom_index(filename, csv_filename, revindex_filename, None, 31)
+    assert len(builds) == 2
+
+    # ...and the wrong ksize is an error.
+    try:
+        load_custom_index(filename, csv_filename, revindex_filename, None, 21)
+        assert 0, 'ksize mismatch should raise ValueError'
+    except ValueError:
+        pass
+    assert len(builds) == 2
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('csv')
+    p.add_argument('revindex')
+    p.add_argument('siglist', nargs='+')
+    p.add_argument('--lca', nargs='+', default=LCA_DBs)
+    p.add_argument('-k', '--ksize', default=31, type=int)
+    p.add_argument('--custom-index',
+                   help='load the hashval -> custom lineage index from this file, building it from the spreadsheet and revindex if missing or out of date')
+    p.add_argument('-o', '--output', type=argparse.FileType('wt'),
+                   help='output CSV to this file instead of stdout')
+    #p.add_argument('-v', '--verbose', action='store_true')
+    p.add_argument('-d', '--debug', action='store_true')
+    args = p.parse_args()
+
+    if args.debug:
+        global _print_debug
+        _print_debug = True
+
+    ## load LCA databases
+    lca_db_list = []
+    for lca_filename in args.lca:
+        print('loading LCA database from {}'.format(lca_filename),
+              file=sys.stderr)
+        lca_db = lca_json.LCA_Database(lca_filename)
+        taxfoo, hashval_to_lca, _ = lca_db.get_database(args.ksize, None)
+        lca_db_list.append((taxfoo, hashval_to_lca))
+
+    if args.custom_index:
+        hashval_to_custom = load_custom_index(args.custom_index, args.csv,
+                                              args.revindex, taxfoo,
+                                              args.ksize)
+        ksize = hashval_to_custom.ksize
+    else:
+        hashval_to_custom, ksize = \
+          load_custom_assignments(args.csv, args.revindex, taxfoo)
+
     # for each query, gather all the matches in both custom and NCBI, then
     # classify.
     csvfp = csv.writer(sys.stdout)
@@ -430,14 +648,8 @@ def main():
                 for (this_taxfoo, hashval_to_lca) in lca_db_list:
                     hashval_lca = hashval_to_lca.get(hashval)
                     if hashval_lca is not None and hashval_lca != 1:
-                        lineage = this_taxfoo.get_lineage_as_dict(hashval_lca,
-                                                                  taxlist)
-
-                        tuple_info = []
-                        for rank in taxlist:
-                            if rank not in lineage:
-                                break
-                            tuple_info.append((rank, lineage[rank]))
+                        tuple_info = get_ncbi_lineage(this_taxfoo,
+                                                      hashval_lca)
                         these_assignments[hashval_lca].append(tuple_info)
 
             check_counts = Counter()
@@ -523,6 +735,12 @@ def main():
     print(u'\r\033[K', end=u'', file=sys.stderr)
     print('classified {} signatures total'.format(total_count), file=sys.stderr)
 
+    taxfoos = dict([ (id(this_taxfoo), this_taxfoo)
+                     for (this_taxfoo, _) in lca_db_list ])
+    cache_infos = [ this_taxfoo.lineage_cache_info()
+                    for this_taxfoo in taxfoos.values() ]
+    print('NCBI lineage cache: {} hits, {} misses'.format(sum([ c.hits for c in cache_infos ]), sum([ c.misses for c in cache_infos ])), file=sys.stderr)
+
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+"""
+Run 'classify.py' as a long-running server that keeps the taxonomy and
+LCA databases loaded.
+
+Briefly,
+
+* load one or more LCA databases (lca.json files) once, at startup;
+* listen for HTTP requests on localhost or on a Unix socket;
+* for each POST to /classify, load the query signature(s), classify them
+  and return the same kraken-style report that 'classify.py' prints.
+
+Usage::
+
+   classify-server.py db.lca.json --socket /tmp/lca.sock
+
+and then, e.g.::
+
+   curl --unix-socket /tmp/lca.sock -d '{"sigfile": "ecoli-1.sig"}' http://localhost/classify
+
+The request body is a JSON object with either "sigfile" (the path to a
+signature file readable by the server) or "signature" (the signature JSON
+itself), plus optional "db" (the lca.json filename, default the first one
+given), "ksize" (default -k/--ksize) and "scaled" (default --scaled, or the
+scaled of the database).  Databases built at a fine scaled answer queries
+at any coarser scaled.  GET / lists the loaded databases.
+"""
+import argparse
+import io
+import json
+import os
+import socketserver
+import sys
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import classify
+import lca_json
+
+
+class ClassifyRequestError(Exception):
+    pass
+
+
+class LCA_Databases(object):
+    "All of the (lca.json, ksize) databases served, loaded once."
+    def __init__(self, lca_filenames, ksizes, scaled=None):
+        self.lca_filenames = list(lca_filenames)
+        self.dbs = {}
+
+        for lca_filename in self.lca_filenames:
+            lca_db = lca_json.LCA_Database(lca_filename)
+            for ksize in ksizes:
+                print('loading {} at k={}'.format(lca_filename, ksize),
+                      file=sys.stderr)
+                db = lca_db.get_handle(ksize, scaled)
+
+                # load everything now, rather than on the first request.
+                db.taxfoo
+                db.hashval_to_lca
+                self.dbs[(lca_filename, ksize)] = db
+
+        self.default_ksize = ksizes[0]
+        self.default_scaled = scaled
+
+    def classify(self, request):
+        "Classify the signature(s) in 'request'; return the report lines."
+        lca_filename = request.get('db', self.lca_filenames[0])
+        ksize = int(request.get('ksize', self.default_ksize))
+
+        db = self.dbs.get((lca_filename, ksize))
+        if db is None:
+            raise ClassifyRequestError('no database {} at k={}'.format(lca_filename, ksize))
+
+        scaled = int(request.get('scaled') or self.default_scaled or db.scaled)
+        if scaled < db.scaled:
+            raise ClassifyRequestError('database {} at k={} is at scaled={}; cannot classify at scaled={}'.format(lca_filename, ksize, db.scaled, scaled))
+        hashval_to_lca = db.get_index(scaled)
+
+        if 'sigfile' in request:
+            sigfile = request['sigfile']
+            if not os.path.exists(sigfile):
+                raise ClassifyRequestError('no such file: {}'.format(sigfile))
+        elif 'signature' in request:
+            sigfile = request['signature']
+            if not isinstance(sigfile, str):
+                sigfile = json.dumps(sigfile)
+            sigfile = io.StringIO(sigfile)
+        else:
+            raise ClassifyRequestError('need either "sigfile" or "signature"')
+
+        siglist = classify.load_query_signatures([sigfile], ksize)
+        if not siglist:
+            raise ClassifyRequestError('no signatures at k={}'.format(ksize))
+        classify.downsample_signatures(siglist, scaled)
+
+        query_hashvals, counts = classify.count_hashvals(siglist)
+        by_taxid, _ = classify.classify_hashvals(hashval_to_lca,
+                                                 query_hashvals, counts)
+
+        return classify.make_report(db.taxfoo, by_taxid)
+
+    def describe(self):
+        return [ dict(db=lca_filename, ksize=ksize, scaled=db.scaled)
+                 for (lca_filename, ksize), db in sorted(self.dbs.items()) ]
+
+
+class ClassifyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/':
+            self.send_error(404)
+            return
+
+        self._respond(200, json.dumps(self.server.lca_dbs.describe()),
+                      'application/json')
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ClassifyRequestError('request must be a JSON object')
+
+            lines = self.server.lca_dbs.classify(request)
+        except (ClassifyRequestError, ValueError) as e:
+            self._respond(400, 'error: {}\n'.format(e))
+            return
+        except Exception:
+            traceback.print_exc()
+            self._respond(500, 'error: internal error; see server log\n')
+            return
+
+        self._respond(200, '\n'.join(lines) + '\n')
+
+    def _respond(self, code, text, content_type='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        if not self.client_address:
+            return self.server.server_address
+        return BaseHTTPRequestHandler.address_string(self)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('lca_filenames', nargs='+')
+    p.add_argument('-k', '--ksize', default='31',
+                   help='comma-separated list of ksizes to load (default: 31)')
+    p.add_argument('--scaled', type=int, default=None,
+                   help='default scaled value to classify at (default: the scaled of each database)')
+    p.add_argument('--socket', help='listen on this Unix socket')
+    p.add_argument('--port', type=int, help='listen on localhost:PORT')
+    args = p.parse_args()
+
+    if bool(args.socket) == bool(args.port):
+        p.error('specify exactly one of --socket or --port')
+
+    ksizes = list(map(int, args.ksize.split(',')))
+    lca_dbs = LCA_Databases(args.lca_filenames, ksizes, args.scaled)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, ClassifyHandler)
+        where = args.socket
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), ClassifyHandler)
+        where = 'http://127.0.0.1:{}/'.format(args.port)
+
+    server.lca_dbs = lca_dbs
+    print('serving classification requests on {}'.format(where),
+          file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,11 +23,14 @@ TODO:
 
 import argparse
 import collections
+import os
+import re
+
+import numpy
 
 import sourmash_lib
 import lca_json
-
-SCALED=10000                              # should match the LCA compute @CTB
+import profiling
 
 kraken_rank_code = {
     'genus' : 'G',
@@ -41,91 +44,232 @@ kraken_rank_code = {
     'domain': 'D' }
 
 
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('lca_filename')
-    p.add_argument('sigfiles', nargs='+')
-    p.add_argument('-k', '--ksize', default=31, type=int)
-    p.add_argument('--output-unassigned', type=argparse.FileType('wt'),
-                        help='output unassigned portions of the query as a signature to this file')
-    args = p.parse_args()
-
-    # load lca info
-    lca_db = lca_json.LCA_Database(args.lca_filename)
-    taxfoo, hashval_to_lca, scaled = lca_db.get_database(args.ksize, SCALED)
-    
-    # load signatures
+def load_query_signatures(sigfiles, ksize):
+    """
+    Load all the signatures of the given ksize from 'sigfiles' (filenames
+    or open file handles).
+    """
     siglist = []
-    print('loading signatures from {} signature files'.format(len(args.sigfiles)))
-    for sigfile in args.sigfiles:
-        sigs = sourmash_lib.load_signatures(sigfile, ksize=args.ksize)
-        sigs = list(sigs)
+    for sigfile in sigfiles:
+        sigs = sourmash_lib.load_signatures(sigfile, ksize=ksize)
         siglist.extend(sigs)
 
-    print('loaded {} signatures total at k={}'.format(len(siglist), args.ksize))
+    return siglist
 
-    # downsample
-    print('downsampling to scaled value: {}'.format(scaled))
+
+def downsample_signatures(siglist, scaled):
     for sig in siglist:
         if sig.minhash.scaled < scaled:
             sig.minhash = sig.minhash.downsample_scaled(scaled)
 
-    # now, extract hash values!
-    hashvals = collections.defaultdict(int)
+
+def count_hashvals(siglist):
+    """
+    Return (hashvals, counts) numpy arrays of the distinct hash values
+    across all signatures in 'siglist' and how many signatures have each.
+    """
+    all_hashvals = []
     for sig in siglist:
-        for hashval in sig.minhash.get_mins():
-            hashvals[hashval] += 1
+        all_hashvals.extend(sig.minhash.get_mins())
+    all_hashvals = numpy.array(all_hashvals, dtype=numpy.uint64)
+    return numpy.unique(all_hashvals, return_counts=True)
 
-    found = 0
-    total = 0
-    by_taxid = collections.defaultdict(int)
 
-    unassigned_hashvals = set()
+def classify_hashvals(hashval_to_lca, query_hashvals, counts):
+    """
+    Look up the LCA for each query hashval; return a dictionary of
+    taxid -> summed counts, with unassigned hashvals counted under taxid 0,
+    as well as an array of the unassigned hashvals.
+    """
+    # for every hash, get LCA of labels, all at once. (0 => not found)
+    lcas = hashval_to_lca.get_lcas(query_hashvals)
 
-    # for every hash, get LCA of labels
-    for hashval, count in hashvals.items():
-        lca = hashval_to_lca.get(hashval)
-        total += count
+    return sum_by_taxid(lcas, counts), query_hashvals[lcas == 0]
 
-        if lca is None:
-            by_taxid[0] += count
-            unassigned_hashvals.add(hashval)
-            continue
 
-        by_taxid[lca] += count
-        found += count
-
-    print('found LCA classifications for', found, 'of', total, 'hashes')
-    not_found = total - found
+def sum_by_taxid(lcas, counts=None):
+    "Sum 'counts' (default 1 each) for each distinct taxid in 'lcas'."
+    by_taxid = collections.defaultdict(int)
+    taxids, inverse = numpy.unique(lcas, return_inverse=True)
+    taxid_counts = numpy.bincount(inverse.ravel(), weights=counts,
+                                  minlength=len(taxids))
+    for taxid, count in zip(taxids, taxid_counts):
+        by_taxid[int(taxid)] = int(count)
+
+    return by_taxid
+
+
+def classify_signatures_separately(hashval_to_lca, siglist):
+    """
+    Classify each signature in 'siglist' on its own; returns a list of
+    taxid -> count dictionaries, as from classify_hashvals, in the same
+    order.  Hash values shared between signatures are only looked up once.
+    """
+    sig_hashvals = [ numpy.array(sig.minhash.get_mins(), dtype=numpy.uint64)
+                     for sig in siglist ]
+    if not sig_hashvals:
+        return []
+
+    # look up all of the distinct hash values at once...
+    all_hashvals = numpy.concatenate(sig_hashvals)
+    distinct_hashvals, inverse = numpy.unique(all_hashvals,
+                                              return_inverse=True)
+    print('looking up {} distinct hashes for {} total across {} signatures'.format(len(distinct_hashvals), len(all_hashvals), len(siglist)))
+    lcas = hashval_to_lca.get_lcas(distinct_hashvals)[inverse.ravel()]
+
+    # ...and then split the results back out by signature.
+    results = []
+    start = 0
+    for hashvals in sig_hashvals:
+        results.append(sum_by_taxid(lcas[start:start + len(hashvals)]))
+        start += len(hashvals)
+
+    return results
+
+
+def report_filename(output_dir, name, md5, used):
+    "Pick a unique, filesystem-safe report filename for a query."
+    safe_name = re.sub(r'[^\w.-]+', '_', name).strip('_') or md5
+    filename = os.path.join(output_dir, safe_name + '.report.txt')
+    if filename in used:
+        filename = os.path.join(output_dir,
+                                '{}.{}.report.txt'.format(safe_name, md5[:8]))
+    used.add(filename)
+    return filename
+
+
+def output_per_signature(taxfoo, siglist, results, output_dir, output_tsv):
+    """
+    Write one report per signature into 'output_dir', and/or all reports
+    into one long-format TSV file with the query name as the first column.
+    Print the reports if neither is given.
+    """
+    used_filenames = set()
+    if output_tsv:
+        output_tsv.write('query\tpercent\tbelow\tat node\tcode\ttaxid\tname\n')
+
+    for sig, by_taxid in zip(siglist, results):
+        lines = make_report(taxfoo, by_taxid)
+
+        if output_dir:
+            filename = report_filename(output_dir, sig.name(), sig.md5sum(),
+                                       used_filenames)
+            with open(filename, 'wt') as fp:
+                for line in lines:
+                    fp.write(line + '\n')
+
+        if output_tsv:
+            for line in lines[1:]:
+                output_tsv.write('{}\t{}\n'.format(sig.name(), line))
+
+        if not output_dir and not output_tsv:
+            print('# {}'.format(sig.name()))
+            for line in lines:
+                print(line)
+
+
+def sum_up_tree(taxfoo, by_taxid):
+    """
+    Propagate the counts in 'by_taxid' up the taxonomic tree, stopping
+    below the root.  Returns (by_taxid_lca, lineage_len): dictionaries of
+    taxid -> count at or below that taxid, and of taxid -> length of its
+    lineage, for the taxids in 'by_taxid' and all of their ancestors.
+    """
+    parent, depth = taxfoo.get_parent_and_depth()
+
+    by_taxid_lca = {}
+    lineage_len = {}
+
+    taxids = numpy.fromiter(by_taxid.keys(), dtype=numpy.int64,
+                            count=len(by_taxid))
+    counts = numpy.fromiter(by_taxid.values(), dtype=numpy.int64,
+                            count=len(by_taxid))
+    taxid_depth = numpy.full(len(taxids), -1, dtype=numpy.int64)
+    in_table = taxids < len(depth)
+    taxid_depth[in_table] = depth[taxids[in_table]]
+
+    # taxids below the root: sum the counts one level at a time, from the
+    # deepest level up, so that each taxid is visited once, after all of
+    # its children.
+    below_root = taxid_depth >= 1
+    nodes = numpy.zeros(0, dtype=numpy.int64)
+    node_counts = numpy.zeros(0, dtype=numpy.int64)
+    max_depth = int(taxid_depth.max()) if len(taxids) else 0
+    for level in range(max_depth, 0, -1):
+        at_level = taxid_depth == level
+        nodes, inverse = numpy.unique(numpy.concatenate([nodes,
+                                                         taxids[at_level]]),
+                                      return_inverse=True)
+        summed = numpy.zeros(len(nodes), dtype=numpy.int64)
+        numpy.add.at(summed, inverse.ravel(),
+                     numpy.concatenate([node_counts, counts[at_level]]))
+
+        for taxid, count in zip(nodes.tolist(), summed.tolist()):
+            by_taxid_lca[taxid] = count
+            lineage_len[taxid] = level
+
+        nodes = parent[nodes].astype(numpy.int64)
+        node_counts = summed
+
+    # the rest (the root, taxid 0, and taxids that aren't in the taxonomy
+    # or aren't connected to the root) are rare: walk up from each of them.
+    for taxid, count in zip(taxids[~below_root].tolist(),
+                            counts[~below_root].tolist()):
+        parent_taxid = taxid
+        while parent_taxid != None:
+            if parent_taxid not in lineage_len:
+                by_taxid_lca[parent_taxid] = 0
+                lineage_len[parent_taxid] = _lineage_len(taxfoo, parent_taxid)
+            by_taxid_lca[parent_taxid] += count
+
+            parent_taxid = taxfoo.child_to_parent.get(parent_taxid)
+            if parent_taxid == 1:
+                break
+
+    return by_taxid_lca, lineage_len
+
+
+def _lineage_len(taxfoo, taxid):
+    "The length of taxfoo.get_lineage(taxid), without building it."
+    n = 0
+    while taxid in taxfoo.node_to_info:
+        n += 1
+        taxid = taxfoo.get_taxid_parent(taxid)
+        if taxid == 1:
+            break
+
+    return n
+
+
+def make_report(taxfoo, by_taxid):
+    """
+    Build the kraken-style report for the taxid -> count dictionary
+    produced by classify_hashvals; returns a list of lines.
+    """
+    not_found = by_taxid.get(0, 0)
 
     # now, propogate counts up the taxonomic tree.
-    by_taxid_lca = collections.defaultdict(int)
-    for taxid, count in by_taxid.items():
-        by_taxid_lca[taxid] += count
-
-        parent = taxfoo.child_to_parent.get(taxid)
-        while parent != None and parent != 1:
-            by_taxid_lca[parent] += count
-            parent = taxfoo.child_to_parent.get(parent)
+    by_taxid_lca, lineage_len = sum_up_tree(taxfoo, by_taxid)
 
     total_count = sum(by_taxid.values())
 
     # sort by lineage length
     x = []
     for taxid, count in by_taxid_lca.items():
-        x.append((len(taxfoo.get_lineage(taxid)), taxid, count))
+        x.append((lineage_len[taxid], taxid, count))
 
     x.sort()
 
     # ...aaaaaand output.
-    print('{}\t{}\t{}\t{}\t{}\t{}'.format('percent', 'below', 'at node',
-                                          'code', 'taxid', 'name'))
+    lines = []
+    lines.append('{}\t{}\t{}\t{}\t{}\t{}'.format('percent', 'below', 'at node',
+                                                 'code', 'taxid', 'name'))
     for _, taxid, count_below in x:
         if taxid == 0:
             continue
 
         percent = round(100 * count_below / total_count, 2)
-        count_at = by_taxid[taxid]
+        count_at = by_taxid.get(taxid, 0)
 
         rank = taxfoo.node_to_info.get(taxid)
         if rank:
@@ -140,8 +284,9 @@ def main():
         else:
             name = '-'
 
-        print('{}\t{}\t{}\t{}\t{}\t{}'.format(percent, count_below, count_at,
-                                              classify_code, taxid, name))
+        lines.append('{}\t{}\t{}\t{}\t{}\t{}'.format(percent, count_below,
+                                                     count_at, classify_code,
+                                                     taxid, name))
 
     if not_found:
         classify_code = 'U'
@@ -151,19 +296,122 @@ def main():
         taxid = 0
         name = 'not classified'
 
-        print('{}\t{}\t{}\t{}\t{}\t{}'.format(percent, count_below, count_at,
-                                              classify_code, taxid, name))
+        lines.append('{}\t{}\t{}\t{}\t{}\t{}'.format(percent, count_below,
+                                                     count_at, classify_code,
+                                                     taxid, name))
+
+    return lines
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('lca_filename')
+    p.add_argument('sigfiles', nargs='+')
+    p.add_argument('-k', '--ksize', default=31, type=int)
+    p.add_argument('--scaled', default=None, type=int,
+                   help='classify at this scaled value; the database may be built at any finer scaled (default: the scaled of the database)')
+    p.add_argument('--output-unassigned', type=argparse.FileType('wt'),
+                        help='output unassigned portions of the query as a signature to this file')
+    p.add_argument('--per-signature', action='store_true',
+                   help='classify each query signature separately')
+    p.add_argument('--output-dir',
+                   help='with --per-signature, write one report per query into this directory')
+    p.add_argument('--output-tsv', type=argparse.FileType('wt'),
+                   help='with --per-signature, write all reports to this long-format TSV file')
+    profiling.add_profile_report_option(p)
+    args = p.parse_args()
+
+    if args.per_signature and args.output_unassigned:
+        p.error('--output-unassigned cannot be used with --per-signature')
+    if (args.output_dir or args.output_tsv) and not args.per_signature:
+        p.error('--output-dir and --output-tsv require --per-signature')
+
+    profile = profiling.Profile(enabled=bool(args.profile_report))
 
-        if args.output_unassigned:
-            outname = args.output_unassigned.name
-            print('saving unassigned hashes to "{}"'.format(outname))
+    # load lca info
+    with profile.phase('load_lca_json'):
+        lca_db = lca_json.LCA_Database(args.lca_filename)
+        db = lca_db.get_handle(args.ksize, args.scaled)
+        scaled = args.scaled or db.scaled
 
-            e = sourmash_lib.MinHash(ksize=args.ksize, n=0, scaled=scaled)
-            e.add_many(unassigned_hashvals)
-            sourmash_lib.save_signatures([ sourmash_lib.SourmashSignature('', e) ],
-                                         args.output_unassigned)
+    with profile.phase('load_taxonomy'):
+        taxfoo = db.taxfoo
 
+    with profile.phase('load_database', ksize=db.ksize, scaled=db.scaled) as record:
+        hashval_to_lca = db.get_index(scaled)
+        record['n_hashvals'] = len(hashval_to_lca)
 
+    # load signatures
+    print('loading signatures from {} signature files'.format(len(args.sigfiles)))
+    with profile.phase('load_signatures', n_files=len(args.sigfiles)) as record:
+        siglist = load_query_signatures(args.sigfiles, args.ksize)
+        record['n_signatures'] = len(siglist)
+        if profile.enabled:
+            record['n_hashes'] = sum([ len(sig.minhash.get_mins()) for sig in siglist ])
+
+    print('loaded {} signatures total at k={}'.format(len(siglist), args.ksize))
+
+    # downsample
+    print('downsampling to scaled value: {}'.format(scaled))
+    with profile.phase('downsample', scaled=scaled) as record:
+        downsample_signatures(siglist, scaled)
+        if profile.enabled:
+            record['n_hashes'] = sum([ len(sig.minhash.get_mins()) for sig in siglist ])
+
+    if args.per_signature:
+        with profile.phase('lookup') as record:
+            results = classify_signatures_separately(hashval_to_lca, siglist)
+            n_hashes = sum([ sum(by_taxid.values()) for by_taxid in results ])
+            n_found = n_hashes - sum([ by_taxid.get(0, 0) for by_taxid in results ])
+            record.update(n_hashes=n_hashes, n_found=n_found,
+                          hit_rate=n_found / n_hashes if n_hashes else None)
+
+        if args.output_dir:
+            print('writing {} reports to {}'.format(len(results),
+                                                    args.output_dir))
+            if not os.path.isdir(args.output_dir):
+                os.makedirs(args.output_dir)
+        if args.output_tsv:
+            print('writing reports to {}'.format(args.output_tsv.name))
+
+        with profile.phase('report', n_reports=len(results)):
+            output_per_signature(taxfoo, siglist, results, args.output_dir,
+                                 args.output_tsv)
+
+        if args.profile_report:
+            profile.write_report(args.profile_report, script='classify.py')
+        return
+
+    # now, extract hash values & count them.
+    with profile.phase('lookup') as record:
+        query_hashvals, counts = count_hashvals(siglist)
+        by_taxid, unassigned_hashvals = classify_hashvals(hashval_to_lca,
+                                                          query_hashvals,
+                                                          counts)
+
+        total = int(counts.sum())
+        not_found = by_taxid.get(0, 0)
+        record.update(n_hashes=total, n_distinct=len(query_hashvals),
+                      n_found=total - not_found,
+                      hit_rate=(total - not_found) / total if total else None)
+    print('found LCA classifications for', total - not_found, 'of', total,
+          'hashes')
+
+    with profile.phase('report'):
+        for line in make_report(taxfoo, by_taxid):
+            print(line)
+
+    if not_found and args.output_unassigned:
+        outname = args.output_unassigned.name
+        print('saving unassigned hashes to "{}"'.format(outname))
+
+        e = sourmash_lib.MinHash(ksize=args.ksize, n=0, scaled=scaled)
+        e.add_many(map(int, unassigned_hashvals))
+        sourmash_lib.save_signatures([ sourmash_lib.SourmashSignature('', e) ],
+                                     args.output_unassigned)
+
+    if args.profile_report:
+        profile.write_report(args.profile_report, script='classify.py')
 
 if __name__ == '__main__':
     main()
@@ -19,7 +19,6 @@ import sourmash_lib.signature
 import lca_json                      # from github.com/ctb/2017-sourmash-lca
 
 LCA_DBs = []
-SCALED=10000
 
 want_taxonomy = ['superkingdom', 'phylum', 'order', 'class', 'family', 'genus', 'species']
 
@@ -85,7 +84,7 @@ def main():
     # load the LCA databases from the JSON file(s)
     print('loading LCA database from {}'.format(args.lca))
     lca_db = lca_json.LCA_Database(args.lca)
-    taxfoo, hashval_to_lca, _ = lca_db.get_database(args.ksize, SCALED)
+    taxfoo, hashval_to_lca, _ = lca_db.get_database(args.ksize, None)
 
     print('loading revindex:', args.revindex)
     revidx = HashvalRevindex(args.revindex)
@@ -11,12 +11,26 @@ Briefly,
   signature (signature genbank accession ID -> lineage);
 * after loading in all signatures & hashes, find the last-common-ancestor
   lineage for each hash and associate in a dictionary;
-* save dictionary.
+* save dictionary, by default as an mmap-able sorted-array index (see
+  lca_index.py); use '--format packed' for a compressed index, or
+  '--format pickle' for the old pickled dictionary (the default when the
+  output name ends in '.gz').
+
+With -s/--save-hashvals, the full hash -> taxids assignment is saved
+alongside the database, as '<lca_output>.hashvals'.  New genomes can then
+be added with '--update OLD_DB', which only recomputes the LCA for hashes
+that the new signatures contain.
 
 Usage::
 
    kraken/extract.py foobar.lca genbank/*.csv.gz nodes.dmp ecoli_many_sigs/ecoli-*.sig --lca-json=db.lca.json
 
+To build databases for several ksizes while reading each signature file
+only once, give a comma-separated list of ksizes and put '{ksize}' in the
+output filename::
+
+   kraken/extract.py -k 21,31,51 'genbank-k{ksize}.lca' genbank/*.csv.gz nodes.dmp genbank-sigs/ --traverse-directory --lca-json=genbank.lca.json
+
 The E. coli signatures used in the command above can be downloaded like so:
 
    curl -O -L https://github.com/dib-lab/sourmash/raw/master/data/eschericia-sigs.tar.gz
@@ -30,11 +44,17 @@ The E. coli signatures used in the command above can be downloaded like so:
 import sys, os
 import sourmash_lib, sourmash_lib.signature
 import argparse
+import multiprocessing
+import shutil
+import tempfile
 from pickle import dump, load
 from collections import defaultdict
 
+import numpy
+
 import lca_json
-from ncbi_taxdump_utils import NCBI_TaxonomyFoo
+import lca_index
+from ncbi_taxdump_utils import load_taxonomy
 
 
 def traverse_find_sigs(dirnames):
@@ -46,122 +66,633 @@ def traverse_find_sigs(dirnames):
                     yield fullname
 
 
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('lca_output')
-    p.add_argument('genbank_csv')
-    p.add_argument('nodes_dmp')
-    p.add_argument('sigs', nargs='+')
-    p.add_argument('-k', '--ksize', default=31, type=int)
-    p.add_argument('--scaled', default=10000, type=int)
+def load_sig_hashvals(filename, taxfoo, ksizes, scaled):
+    """
+    Load the signatures in 'filename', find the taxid for their accession,
+    and return (taxid, hashvals) where hashvals is a list with the hash
+    values downsampled to 'scaled' for each of 'ksizes', or None if there
+    is no signature at that ksize.  The file is only parsed once.  taxid
+    is None if the accession has no known taxid.
+    """
+    siglist = list(sourmash_lib.signature.load_signatures(filename))
+
+    sigs = []
+    for ksize in ksizes:
+        matching = [ sig for sig in siglist if sig.minhash.ksize == ksize ]
+        if len(matching) > 1:
+            raise ValueError('more than one signature at k={} in {}'.format(ksize, filename))
+        sigs.append(matching[0] if matching else None)
+
+    found = [ sig for sig in sigs if sig is not None ]
+    if not found:
+        raise ValueError('no signatures at k={} in {}'.format(ksizes, filename))
+
+    acc = found[0].name().split(' ')[0]   # first part of sequence name
+    acc = acc.split('.')[0]               # get acc w/o version
+
+    taxid = taxfoo.get_taxid(acc)
+    if taxid == None:
+        return None, [ [] if sig is not None else None for sig in sigs ]
+
+    hashvals = []
+    for sig in sigs:
+        if sig is None:
+            hashvals.append(None)
+            continue
+        sig.minhash = sig.minhash.downsample_scaled(scaled)
+        hashvals.append(sig.minhash.get_mins())
 
-    p.add_argument('--traverse-directory', action='store_true')
+    return taxid, hashvals
 
-    p.add_argument('-s', '--save-hashvals', action='store_true')
-    p.add_argument('-l', '--load-hashvals', action='store_true')
 
-    p.add_argument('--lca-json')
-    p.add_argument('--names-dmp', default='')
-    args = p.parse_args()
+def get_shard(hashval, n_shards, scaled):
+    "Partition the (downsampled) hash space into n_shards equal ranges."
+    max_hash = lca_index.max_hash_for_scaled(scaled)
+    return min(hashval * n_shards // max_hash, n_shards - 1)
 
-    taxfoo = NCBI_TaxonomyFoo()
 
-    # load the accessions->taxid info
-    taxfoo.load_accessions_csv(args.genbank_csv)
+def find_lcas(hashval_to_taxids, taxfoo):
+    """
+    Find the LCA for each hashval in 'hashval_to_taxids'; return a tuple
+    (hashval_to_lca, found_root, empty_set) where the last two count the
+    hashvals that had no LCA below the root.
+    """
+    hashval_to_lca = {}
+    found_root = 0
+    empty_set = 0
 
-    # load the nodes_dmp file to get the tax tree
-    print('loading nodes_dmp / taxonomic tree')
-    taxfoo.load_nodes_dmp(args.nodes_dmp)
+    for n, (hashval, taxid_set) in enumerate(hashval_to_taxids.items()):
+        if n % 10000 == 0:
+            print('...', n, end='\r')
 
-    # track hashval -> set of taxids
-    hashval_to_taxids = defaultdict(set)
+        # find associated least-common-ancestors.
+        lca = taxfoo.find_lca(taxid_set)
 
-    # for every minhash in every signature, link it to its NCBI taxonomic ID.
-    if args.traverse_directory:
-        inp_files = list(traverse_find_sigs(args.sigs))
+        if lca == 1:
+            if taxid_set:
+                found_root += 1
+            else:
+                empty_set += 1
+            continue
+
+        # save!!
+        hashval_to_lca[hashval] = lca
+
+    return hashval_to_lca, found_root, empty_set
+
+
+### parallel build; worker state is inherited from the parent via fork.
+
+_worker_state = {}
+
+
+def _load_sig_shards(filename):
+    taxfoo = _worker_state['taxfoo']
+    args = _worker_state['args']
+    n_shards = _worker_state['n_shards']
+
+    try:
+        taxid, ksize_mins = load_sig_hashvals(filename, taxfoo, args.ksizes,
+                                              args.scaled)
+    except (FileNotFoundError, ValueError):
+        if not args.traverse_directory:
+            raise
+        return None, None
+
+    if None in ksize_mins and not args.traverse_directory:
+        ksize = args.ksizes[ksize_mins.index(None)]
+        raise ValueError('no signature at k={} in {}'.format(ksize, filename))
+
+    ksize_shard_mins = []
+    for mins in ksize_mins:
+        if mins is None:                  # no signature at this ksize
+            ksize_shard_mins.append([ [] for i in range(n_shards) ])
+            continue
+        if n_shards == 1:
+            ksize_shard_mins.append([mins])
+            continue
+
+        shard_mins = [ [] for i in range(n_shards) ]
+        for m in mins:
+            shard_mins[get_shard(m, n_shards, args.scaled)].append(m)
+        ksize_shard_mins.append(shard_mins)
+
+    return taxid, ksize_shard_mins
+
+
+def _reduce_shard(shard_n):
+    return find_lcas(_worker_state['shards'][shard_n],
+                     _worker_state['taxfoo'])
+
+
+def iter_sig_shards(inp_files, taxfoo, args, n_shards):
+    """
+    Load all the signatures in 'inp_files', yielding (taxid, shard_mins) for
+    each, where shard_mins[i] is a list of n_shards lists of hashvals for
+    args.ksizes[i], split by hash range (and empty if the file has no
+    signature at that ksize).  shard_mins is None for files that could not
+    be loaded.  With args.jobs > 1, signatures are parsed by a
+    pool of worker processes.
+    """
+    _worker_state.update(taxfoo=taxfoo, args=args, n_shards=n_shards)
+    if args.jobs > 1:
+        pool = multiprocessing.get_context('fork').Pool(args.jobs)
+        results = pool.imap_unordered(_load_sig_shards, inp_files,
+                                      chunksize=16)
     else:
-        inp_files = list(args.sigs)
+        pool = None
+        results = map(_load_sig_shards, inp_files)
+
+    try:
+        for result in results:
+            yield result
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        _worker_state.clear()
+
+
+def load_shards(inp_files, taxfoo, args, n_shards):
+    """
+    Load all the signatures in 'inp_files', and build n_shards dictionaries
+    of hashval -> set of taxids, partitioned by hash range, for each of
+    args.ksizes.
+    """
+    ksize_shards = [ [ defaultdict(set) for i in range(n_shards) ]
+                     for ksize in args.ksizes ]
+    bad_input = 0
+
+    for n, (taxid, ksize_shard_mins) in enumerate(iter_sig_shards(inp_files,
+                                                                  taxfoo, args,
+                                                                  n_shards)):
+        if n % 100 == 0:
+            print('... loading file #', n, 'of', len(inp_files), end='\r')
+
+        if ksize_shard_mins is None:
+            bad_input += 1
+            continue
+        if taxid is None:
+            continue
+
+        for shards, shard_mins in zip(ksize_shards, ksize_shard_mins):
+            for shard, mins in zip(shards, shard_mins):
+                for m in mins:
+                    shard[m].add(taxid)
+
+    return ksize_shards, bad_input
+
+
+def reduce_shards(shards, taxfoo, jobs):
+    """
+    Find LCAs for each shard of hashval -> taxids, in parallel if jobs > 1.
+    Yields find_lcas(...) results in shard order.
+    """
+    if jobs == 1 or len(shards) == 1:
+        for shard in shards:
+            yield find_lcas(shard, taxfoo)
+        return
+
+    _worker_state.update(taxfoo=taxfoo, shards=shards)
+    pool = multiprocessing.get_context('fork').Pool(jobs)
+    try:
+        for result in pool.imap(_reduce_shard, range(len(shards))):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+        _worker_state.clear()
+
+
+def build_in_memory(inp_files, taxfoo, args):
+    """
+    Build the LCA databases in memory, as hashval -> set of taxids
+    dictionaries (one per hash range), and save them to args.lca_output.
+    """
+    n_shards = args.jobs
 
     if args.load_hashvals:
-        with open(args.lca_output + '.hashvals', 'rb') as hashval_fp:
-            print('loading hashvals dict per -l/--load-hashvals...')
-            hashval_to_taxids = load(hashval_fp)
-            print('loaded {} hashvals'.format(len(hashval_to_taxids)))
+        ksize_shards = [ load_hashval_shards(kargs, n_shards)
+                         for kargs in per_ksize_args(args) ]
     else:
-
         print('loading signatures & traversing hashes')
+        ksize_shards, bad_input = load_shards(inp_files, taxfoo, args,
+                                              n_shards)
+        print('\n...done')
+        if bad_input:
+            print('failed to load {} of {} files found'.format(bad_input,
+                                                               len(inp_files)))
+
+    for kargs, shards in zip(per_ksize_args(args), ksize_shards):
+        if len(args.ksizes) > 1:
+            print('building database for k={}'.format(kargs.ksize))
+
+        if args.save_hashvals:
+            records = numpy.concatenate([ lca_index.records_from_dict(shard)
+                                          for shard in shards ])
+            lca_index.save_hashval_taxids(kargs.lca_output + '.hashvals',
+                                          records, kargs.ksize, kargs.scaled)
+            del records
+
+        reduce_and_save(shards, taxfoo, kargs)
+
+    del ksize_shards
+
+
+def load_hashval_shards(args, n_shards):
+    "Load the -s/--save-hashvals sidecar for args.lca_output into shards."
+    hashvals_file = args.lca_output + '.hashvals'
+    print('loading hashvals per -l/--load-hashvals from', hashvals_file)
+    records = load_hashval_records(hashvals_file, args)
+    print('loaded {} hashvals'.format(len(lca_index.find_runs(records['hashval'])[0])))
+
+    shards = [ defaultdict(set) for i in range(n_shards) ]
+    for hashval, taxid in zip(records['hashval'].tolist(),
+                              records['taxid'].tolist()):
+        shard = get_shard(hashval, n_shards, args.scaled)
+        shards[shard][hashval].add(taxid)
+
+    return shards
+
+
+def reduce_and_save(shards, taxfoo, args):
+    "Find the LCA for each hashval in 'shards' and save to args.lca_output."
+    n_tags = sum([ len(shard) for shard in shards ])
+    print('traversing tags and finding last-common-ancestor for {} tags'.format(n_tags))
+
+    # find the LCA for each hashval, one hash range (shard) at a time.
+    hashval_to_lca = {}
+    found_root = 0
+    empty_set = 0
+    for (shard_lca, shard_root, shard_empty) in reduce_shards(shards, taxfoo,
+                                                              args.jobs):
+        hashval_to_lca.update(shard_lca)
+        found_root += shard_root
+        empty_set += shard_empty
+    print('\ndone')
+
+    if found_root:
+        print('found root {} times'.format(found_root))
+    if empty_set:
+        print('found empty set {} times'.format(empty_set))
+
+    save_lca_output(hashval_to_lca, args)
+
+
+class SortedRunSpiller(object):
+    """
+    Collect (hashval, taxid) records in a buffer of 'budget' records, and
+    spill each full buffer to disk as a sorted run.
+    """
+    def __init__(self, budget, prefix):
+        self.budget = budget
+        self.prefix = prefix
+        self.hashvals = numpy.empty(budget, dtype=numpy.uint64)
+        self.taxids = numpy.empty(budget, dtype=numpy.uint32)
+        self.n_records = 0
+        self.run_files = []
+
+    def add(self, mins, taxid):
+        start = 0
+        while start < len(mins):
+            n_add = min(self.budget - self.n_records, len(mins) - start)
+            end = self.n_records + n_add
+            self.hashvals[self.n_records:end] = mins[start:start + n_add]
+            self.taxids[self.n_records:end] = taxid
+            self.n_records = end
+            start += n_add
+
+            if self.n_records == self.budget:
+                self.spill()
+
+    def spill(self):
+        run_file = '{}{}'.format(self.prefix, len(self.run_files))
+        lca_index.write_sorted_run(run_file, self.hashvals[:self.n_records],
+                                   self.taxids[:self.n_records])
+        self.run_files.append(run_file)
+        self.n_records = 0
+
+    def close(self):
+        if self.n_records:
+            self.spill()
+        self.hashvals = self.taxids = None
+
+
+def build_external(inp_files, taxfoo, args):
+    """
+    Build the LCA databases out-of-core: collect (hashval, taxid) records
+    in buffers of args.memory_budget records in total, spill each full
+    buffer to disk as a sorted run, and then merge the runs and find the
+    LCA of each hashval in streaming order, writing the index as we go.
+    """
+    budget = max(args.memory_budget // len(args.ksizes), 1)
+    tempdir = tempfile.mkdtemp(prefix='extract-', dir=args.tempdir)
+
+    try:
+        spillers = [ SortedRunSpiller(budget,
+                                      os.path.join(tempdir,
+                                                   'k{}-run'.format(ksize)))
+                     for ksize in args.ksizes ]
+
+        print('loading signatures & spilling hashes to', tempdir)
         bad_input = 0
-        for n, filename in enumerate(inp_files):
+        for n, (taxid, ksize_shard_mins) in enumerate(iter_sig_shards(inp_files,
+                                                                      taxfoo, args,
+                                                                      1)):
             if n % 100 == 0:
                 print('... loading file #', n, 'of', len(inp_files), end='\r')
 
-            try:
-                sig = sourmash_lib.signature.load_one_signature(filename,
-                                                                ksize=args.ksize)
-            except (FileNotFoundError, ValueError):
-                if not args.traverse_directory:
-                    raise
-
+            if ksize_shard_mins is None:
                 bad_input += 1
                 continue
-
-            acc = sig.name().split(' ')[0]   # first part of sequence name
-            acc = acc.split('.')[0]          # get acc w/o version
-
-            taxid = taxfoo.get_taxid(acc)
-            if taxid == None:
+            if taxid is None:
                 continue
 
-            sig.minhash = sig.minhash.downsample_scaled(args.scaled)
+            for spiller, shard_mins in zip(spillers, ksize_shard_mins):
+                spiller.add(shard_mins[0], taxid)
 
-            mins = sig.minhash.get_mins()
+        for spiller in spillers:
+            spiller.close()
 
-            for m in mins:
-                hashval_to_taxids[m].add(taxid)
-        print('\n...done')
+        print('\n...done; {} sorted runs'.format(sum([ len(spiller.run_files)
+                                                      for spiller in spillers ])))
         if bad_input:
             print('failed to load {} of {} files found'.format(bad_input,
                                                                len(inp_files)))
 
-        if args.save_hashvals:
-            with open(args.lca_output + '.hashvals', 'wb') as hashval_fp:
-                dump(hashval_to_taxids, hashval_fp)
+        for kargs, spiller in zip(per_ksize_args(args), spillers):
+            merge_and_save(spiller.run_files, taxfoo, kargs)
+    finally:
+        shutil.rmtree(tempdir)
 
-    ####
 
-    print('traversing tags and finding last-common-ancestor for {} tags'.format(len(hashval_to_taxids)))
+def merge_and_save(run_files, taxfoo, args):
+    """
+    Merge the sorted runs, find the LCA of each hashval and write the
+    index to args.lca_output.
+    """
+    print('merging runs, finding last-common-ancestors & saving to',
+          args.lca_output)
+    block_size = max(args.memory_budget // (len(run_files) + 1), 1)
 
-    hashval_to_lca = {}
+    writer = lca_index.LCA_IndexWriter(args.lca_output,
+                                       packed=args.format == 'packed')
+    n_tags = 0
     found_root = 0
-    empty_set = 0
+    chunks = lca_index.merge_sorted_runs(run_files, block_size)
+    for n, chunk in enumerate(chunks):
+        chunk_hashvals = chunk['hashval']
+        chunk_taxids = chunk['taxid'].tolist()
 
-    # find the LCA for each hashval and store.
-    for n, (hashval, taxid_set) in enumerate(hashval_to_taxids.items()):
-        if n % 10000 == 0:
-            print('...', n, end='\r')
+        # the records for each hashval are adjacent; find their extent.
+        starts, ends = lca_index.find_runs(chunk_hashvals)
 
-        # find associated least-common-ancestors.
-        lca = taxfoo.find_lca(taxid_set)
+        lcas = numpy.empty(len(starts), dtype=numpy.uint32)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            lcas[i] = taxfoo.find_lca(set(chunk_taxids[start:end]))
 
-        if lca == 1:
-            if taxid_set:
-                found_root += 1
-            else:
-                empty_set += 1
-            continue
+        keep = lcas != 1
+        writer.add_many(chunk_hashvals[starts][keep], lcas[keep])
 
-        # save!!
-        hashval_to_lca[hashval] = lca
-    print('\ndone')
+        n_tags += len(starts)
+        found_root += int((~keep).sum())
+        if n % 100 == 0:
+            print('...', n_tags, end='\r')
+
+    writer.close()
+    print('\ndone; {} tags'.format(n_tags))
 
     if found_root:
         print('found root {} times'.format(found_root))
-    if empty_set:
-        print('found empty set {} times'.format(empty_set))
 
+
+def update_database(inp_files, taxfoo, args):
+    """
+    Add the signatures in 'inp_files' to the existing databases args.update,
+    using their hashval -> taxids sidecars (saved with -s/--save-hashvals)
+    to find the LCA of only those hashvals that the new signatures touch.
+    The updated databases and sidecars are saved to args.lca_output.
+    """
+    print('loading signatures & traversing hashes')
+    ksize_records = [ [] for ksize in args.ksizes ]
+    bad_input = 0
+    for n, (taxid, ksize_shard_mins) in enumerate(iter_sig_shards(inp_files,
+                                                                  taxfoo, args,
+                                                                  1)):
+        if n % 100 == 0:
+            print('... loading file #', n, 'of', len(inp_files), end='\r')
+
+        if ksize_shard_mins is None:
+            bad_input += 1
+            continue
+        if taxid is None:
+            continue
+
+        for new_records, shard_mins in zip(ksize_records, ksize_shard_mins):
+            records = numpy.empty(len(shard_mins[0]),
+                                  dtype=lca_index.RECORD_DTYPE)
+            records['hashval'] = shard_mins[0]
+            records['taxid'] = taxid
+            new_records.append(records)
+
+    print('\n...done')
+    if bad_input:
+        print('failed to load {} of {} files found'.format(bad_input,
+                                                           len(inp_files)))
+
+    for kargs, new_records in zip(per_ksize_args(args), ksize_records):
+        if len(args.ksizes) > 1:
+            print('updating database for k={}'.format(kargs.ksize))
+
+        new_records = numpy.concatenate(new_records or
+                                        [ numpy.empty(0, lca_index.RECORD_DTYPE) ])
+        apply_update(new_records, taxfoo, kargs)
+
+
+def apply_update(new_records, taxfoo, args):
+    """
+    Merge the (hashval, taxid) 'new_records' into the database args.update,
+    and save the updated database to args.lca_output.
+    """
+    old_sidecar = args.update + '.hashvals'
+    print('loading hashval -> taxids for', args.update, 'from', old_sidecar)
+    old_records = load_hashval_records(old_sidecar, args)
+
+    touched = numpy.unique(new_records['hashval'])
+    records = numpy.unique(numpy.concatenate([old_records, new_records]))
+    del old_records, new_records
+
+    print('finding last-common-ancestor for {} touched tags'.format(len(touched)))
+    left = numpy.searchsorted(records['hashval'], touched, side='left')
+    right = numpy.searchsorted(records['hashval'], touched, side='right')
+    all_taxids = records['taxid'].tolist()
+
+    lcas = numpy.empty(len(touched), dtype=numpy.uint32)
+    for i, (start, end) in enumerate(zip(left.tolist(), right.tolist())):
+        lcas[i] = taxfoo.find_lca(set(all_taxids[start:end]))
+    del all_taxids
+
+    found_root = int((lcas == 1).sum())
+    if found_root:
+        print('found root {} times'.format(found_root))
+
+    # replace the LCAs of all touched hashvals in the existing database.
+    print('loading existing LCA database', args.update)
+    old_index = lca_json.load_lca_file(args.update)
+    old_hashvals = old_index.hashvals
+    untouched = numpy.ones(len(old_hashvals), dtype=bool)
+    if len(touched):
+        pos = numpy.searchsorted(touched, old_hashvals)
+        pos[pos == len(touched)] = 0
+        untouched = touched[pos] != old_hashvals
+
+    keep = lcas != 1
+    hashvals = numpy.concatenate([old_hashvals[untouched], touched[keep]])
+    taxids = numpy.concatenate([old_index.taxids[untouched], lcas[keep]])
+    del old_index, old_hashvals
+
+    order = numpy.argsort(hashvals, kind='stable')
+    print('{} tags in updated database'.format(len(hashvals)))
+    save_lca_output(lca_index.LCA_Index(hashvals[order], taxids[order]), args)
+
+    lca_index.save_hashval_taxids(args.lca_output + '.hashvals', records,
+                                  args.ksize, args.scaled)
+
+
+def per_ksize_args(args):
+    """
+    Yield a copy of 'args' for each of args.ksizes, with args.ksize set and
+    '{ksize}' in the database filenames filled in.
+    """
+    for ksize in args.ksizes:
+        kargs = argparse.Namespace(**vars(args))
+        kargs.ksize = ksize
+        kargs.lca_output = args.lca_output.format(ksize=ksize)
+        if args.update:
+            kargs.update = args.update.format(ksize=ksize)
+        yield kargs
+
+
+def load_hashval_records(filename, args):
+    """
+    Load a hashval -> taxids sidecar saved by -s/--save-hashvals, as
+    sorted (hashval, taxid) records; old pickled sidecars are converted.
+    """
+    if not lca_index.is_lca_index(filename):
+        with open(filename, 'rb') as hashval_fp:
+            return lca_index.records_from_dict(load(hashval_fp))
+
+    header, records = lca_index.load_hashval_taxids(filename)
+    if (header['ksize'], header['scaled']) != (args.ksize, args.scaled):
+        raise ValueError('{} is for ksize={} scaled={}, not ksize={} scaled={}'.format(filename, header['ksize'], header['scaled'], args.ksize, args.scaled))
+
+    return records
+
+
+def save_lca_output(hashval_to_lca, args):
+    "Save a hashval -> LCA dictionary or index to args.lca_output."
     print('saving to', args.lca_output)
-    with lca_json.xopen(args.lca_output, 'wb') as lca_fp:
-        dump(hashval_to_lca, lca_fp)
+    if args.format == 'index':
+        if not isinstance(hashval_to_lca, lca_index.LCA_Index):
+            hashval_to_lca = lca_index.LCA_Index.from_dict(hashval_to_lca)
+        hashval_to_lca.save(args.lca_output)
+    elif args.format == 'packed':
+        if isinstance(hashval_to_lca, lca_index.LCA_Index):
+            hashval_to_lca = lca_index.PackedLCA_Index.from_arrays(
+                hashval_to_lca.hashvals, hashval_to_lca.taxids)
+        else:
+            hashval_to_lca = lca_index.PackedLCA_Index.from_dict(hashval_to_lca)
+        hashval_to_lca.save(args.lca_output)
+    else:
+        if isinstance(hashval_to_lca, lca_index.LCA_Index):
+            hashval_to_lca = dict(hashval_to_lca.items())
+        with lca_json.xopen(args.lca_output, 'wb') as lca_fp:
+            dump(hashval_to_lca, lca_fp)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('lca_output')
+    p.add_argument('genbank_csv')
+    p.add_argument('nodes_dmp')
+    p.add_argument('sigs', nargs='+')
+    p.add_argument('-k', '--ksize', default='31',
+                   help="comma-separated list of ksizes to build databases for, in one pass over the signatures; with more than one, lca_output must contain '{ksize}'")
+    p.add_argument('--scaled', default=10000, type=int)
+
+    p.add_argument('--traverse-directory', action='store_true')
+
+    p.add_argument('-s', '--save-hashvals', action='store_true')
+    p.add_argument('-l', '--load-hashvals', action='store_true')
+
+    p.add_argument('--lca-json')
+    p.add_argument('--names-dmp', default='')
+    p.add_argument('--format', choices=['index', 'packed', 'pickle'],
+                   help="on-disk format of the LCA database (default: pickle if lca_output ends in .gz, index otherwise); 'packed' is a compressed index")
+    p.add_argument('-j', '--jobs', default=1, type=int,
+                   help='number of worker processes to use for the build')
+    p.add_argument('-M', '--memory-budget', default=0, type=int,
+                   help='build out-of-core, holding at most this many (hash, taxid) records in memory')
+    p.add_argument('--tempdir', default=None,
+                   help='directory for the temporary files of -M/--memory-budget')
+    p.add_argument('--update', metavar='OLD_LCA_DB',
+                   help='add the signatures to this existing database (built with -s) rather than starting from scratch')
+    args = p.parse_args()
+
+    if args.jobs < 1:
+        p.error('--jobs must be at least 1')
+
+    if args.format is None:
+        if args.lca_output.endswith('.gz'):
+            args.format = 'pickle'
+        else:
+            args.format = 'index'
+
+    args.ksizes = list(map(int, args.ksize.split(',')))
+    if len(args.ksizes) != len(set(args.ksizes)):
+        p.error('-k/--ksize has repeated ksizes')
+    if len(args.ksizes) > 1:
+        if '{ksize}' not in args.lca_output:
+            p.error("with several ksizes, lca_output must contain '{ksize}'")
+        if args.update and '{ksize}' not in args.update:
+            p.error("with several ksizes, --update must contain '{ksize}'")
+
+    if args.memory_budget:
+        if args.format == 'pickle':
+            p.error('-M/--memory-budget does not support --format pickle')
+        if args.save_hashvals or args.load_hashvals:
+            p.error('-M/--memory-budget cannot be used with -s or -l')
+
+    if args.update:
+        if args.memory_budget or args.load_hashvals:
+            p.error('--update cannot be used with -M or -l')
+        for kargs in per_ksize_args(args):
+            if not os.path.exists(kargs.update + '.hashvals'):
+                p.error('no {}.hashvals; --update needs a database built with -s/--save-hashvals'.format(kargs.update))
+
+    if args.format != 'pickle' and args.lca_output.endswith('.gz'):
+        p.error('cannot mmap a gzipped index; use --format pickle for .gz')
+
+    # load the nodes_dmp file to get the tax tree
+    print('loading nodes_dmp / taxonomic tree')
+    taxfoo = load_taxonomy(args.nodes_dmp)
+    taxfoo.build_lca_index()
+
+    # load the accessions->taxid info
+    taxfoo.load_accessions_csv(args.genbank_csv)
+
+    # for every minhash in every signature, link it to its NCBI taxonomic ID.
+    if args.traverse_directory:
+        inp_files = list(traverse_find_sigs(args.sigs))
+    else:
+        inp_files = list(args.sigs)
+
+    if args.update:
+        update_database(inp_files, taxfoo, args)
+    elif args.memory_budget:
+        build_external(inp_files, taxfoo, args)
+    else:
+        build_in_memory(inp_files, taxfoo, args)
 
     # update LCA DB JSON file if provided
     if args.lca_json:
@@ -172,10 +703,6 @@ def main():
 
         prefix = os.path.dirname(args.lca_json) + '/'
 
-        lca_output = args.lca_output
-        if lca_output.startswith(prefix):
-            lca_output = lca_output[len(prefix):]
-
         nodes_dmp = args.nodes_dmp
         if nodes_dmp.startswith(prefix):
             nodes_dmp = nodes_dmp[len(prefix):]
@@ -187,7 +714,13 @@ def main():
         else:
             names_dmp = nodes_dmp.replace('nodes', 'names')
 
-        lca_db.add_db(args.ksize, args.scaled, lca_output, nodes_dmp, names_dmp)
+        for kargs in per_ksize_args(args):
+            lca_output = kargs.lca_output
+            if lca_output.startswith(prefix):
+                lca_output = lca_output[len(prefix):]
+
+            lca_db.add_db(kargs.ksize, kargs.scaled, lca_output, nodes_dmp,
+                          names_dmp)
         print('saving LCA JSON file:', args.lca_json)
         lca_db.save(args.lca_json)
 
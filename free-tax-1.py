@@ -2,6 +2,15 @@
 """
 Build a least-common-ancestor database with given taxonomy and genome sigs.
 
+The database is saved in the binary v3 format (see lineage_db.py), which
+'free-tax-2.py' loads by mmap.  Earlier versions wrote v2 JSON by default;
+tools that read the database as JSON need '--json' to get that instead.
+
+Usage::
+
+   free-tax-1.py tara-delmont-SuppTable3.csv tara-delmont.lca sigs/*.sig
+   free-tax-1.py --json tara-delmont-SuppTable3.csv tara-delmont.lca.json sigs/*.sig
+
 TODO:
 * add --traverse
 """
@@ -12,6 +21,8 @@ from collections import defaultdict, OrderedDict
 import json
 
 import sourmash_lib
+import lineage_db
+import lineage_trie
 
 taxlist = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus',
            'species']
@@ -24,6 +35,70 @@ def debug(*args):
         print(*args)
 
 
+def precompute_lcas(hashval_to_lineage, lineage_dict, branches=False):
+    """
+    Where a hashval's lineages all lie on one path, replace its list of
+    lineage ids with the deepest one, which is the LCA that free-tax-2.py
+    would find.  This gives the same results in free-tax-2.py, whatever
+    other databases this one is used with.
+
+    With 'branches', the LCA of disagreeing lineages is also stored, as a
+    new lineage added to 'lineage_dict' and flagged as a branch point by
+    returning its id in a set.  free-tax-2.py takes the parent of a
+    (rank, name) that appears under different parents from the lineages
+    of each hashval, though, and those below the LCA are lost; so this
+    gives the same results only for a database that is used on its own.
+    Even then, if such a name is below the LCA, the list is kept.
+    """
+    trie = lineage_trie.LineageTrie()
+    lineage_nodes = {}
+    node_lineages = {}
+    for idx in sorted(lineage_dict):
+        node = trie.add(lineage_dict[idx])
+        lineage_nodes[idx] = node
+        node_lineages.setdefault(node, idx)
+
+    next_lineage_index = max(lineage_dict, default=-1) + 1
+    branch_lineages = {}
+    resolved = {}
+    n_agree = n_branch = n_kept = 0
+    for hashval, lineage_ids in hashval_to_lineage.items():
+        if len(lineage_ids) == 1:
+            continue
+
+        key = tuple(lineage_ids)
+        if key not in resolved:
+            nodes = [ lineage_nodes[idx] for idx in lineage_ids ]
+            lca, is_branch = trie.fold_lca(nodes)
+            if not is_branch:
+                resolved[key] = [node_lineages[lca]], False
+            elif not branches or \
+              any([ trie.has_ambiguous_label(node, lca) for node in nodes ]):
+                resolved[key] = None, True
+            else:
+                if lca not in branch_lineages:
+                    branch_lineages[lca] = next_lineage_index
+                    lineage_dict[next_lineage_index] = \
+                      tuple(trie.get_lineage(lca))
+                    next_lineage_index += 1
+                resolved[key] = [branch_lineages[lca]], True
+
+        new_lineage_ids, is_branch = resolved[key]
+        if new_lineage_ids is None:
+            n_kept += 1
+            continue
+
+        hashval_to_lineage[hashval] = new_lineage_ids
+        if is_branch:
+            n_branch += 1
+        else:
+            n_agree += 1
+
+    print('precomputed LCAs: {} hashvals with agreeing lineages, {} with disagreeing lineages ({} new LCA lineages), {} kept as lists'.format(n_agree, n_branch, len(branch_lineages), n_kept), file=sys.stderr)
+
+    return set(branch_lineages.values())
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('csv')
@@ -35,6 +110,12 @@ def main():
     p.add_argument('-1', '--start-column', default=2, type=int,
                    help='column at which taxonomic assignments start')
     p.add_argument('-f', '--force', action='store_true')
+    p.add_argument('--json', action='store_true',
+                   help='save as a v2 JSON database (the old default) instead of the binary v3 format')
+    p.add_argument('--precompute-lca', action='store_true',
+                   help='store one lineage for each hash whose lineages lie on one path, rather than all of them')
+    p.add_argument('--precompute-lca-branches', action='store_true',
+                   help='as --precompute-lca, but also store the LCA of disagreeing lineages; for databases that are not used with others')
     args = p.parse_args()
 
     if args.start_column < 2:
@@ -145,22 +226,37 @@ def main():
     print('{} assigned lineages out of {} distinct lineages in spreadsheet'.format(len(lineage_dict_2), len(lineage_dict)))
     lineage_dict = lineage_dict_2
 
-    # now, save!
-    print('saving to LCA DB v2: {}'.format(args.lca_db_out))
-    with open(args.lca_db_out, 'wt') as fp:
-        save_d = OrderedDict()
-        save_d['version'] = '1.0'
-        save_d['type'] = 'sourmash_lca'
-        save_d['license'] = 'CC0'
-        save_d['ksize'] = ksize
-        save_d['scaled'] = scaled
-        # convert lineage internals from tuples to dictionaries
-        save_d['lineages'] = OrderedDict([ (k, OrderedDict(v)) \
-                                           for k, v in lineage_dict.items() ])
-        save_d['hashval_assignments'] = hashval_to_lineage
-        save_d['signatures_to_lineage'] = md5_to_lineage
-        json.dump(save_d, fp)
+    lca_lineages = set()
+    if args.precompute_lca or args.precompute_lca_branches:
+        lca_lineages = precompute_lcas(hashval_to_lineage, lineage_dict,
+                                       args.precompute_lca_branches)
 
+    # now, save!
+    if args.json:
+        print('saving to LCA DB v2: {}'.format(args.lca_db_out))
+        with open(args.lca_db_out, 'wt') as fp:
+            save_d = OrderedDict()
+            save_d['version'] = '1.0'
+            save_d['type'] = 'sourmash_lca'
+            save_d['license'] = 'CC0'
+            save_d['ksize'] = ksize
+            save_d['scaled'] = scaled
+            # convert lineage internals from tuples to dictionaries
+            save_d['lineages'] = OrderedDict([ (k, OrderedDict(v)) \
+                                               for k, v in lineage_dict.items() ])
+            save_d['hashval_assignments'] = hashval_to_lineage
+            save_d['signatures_to_lineage'] = md5_to_lineage
+            if lca_lineages:
+                save_d['lca_lineages'] = sorted(lca_lineages)
+            json.dump(save_d, fp)
+    else:
+        print('saving to LCA DB v3: {}'.format(args.lca_db_out))
+        hashvals, offsets, lineage_ids = \
+          lineage_db.hashval_assignments_to_arrays(hashval_to_lineage)
+        lineage_db.save_lineage_db(args.lca_db_out, ksize, scaled,
+                                   lineage_dict, hashvals, offsets,
+                                   lineage_ids, md5_to_lineage,
+                                   lca_lineages=lca_lineages)
 
 if __name__ == '__main__':
     sys.exit(main())
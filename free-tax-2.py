@@ -13,12 +13,28 @@ import itertools
 import pprint
 import sourmash_lib
 import json
+import multiprocessing
+import time
+from array import array
+
+import ijson
+import numpy
+
+import lca_index
+import lineage_db
+import lineage_trie
+import profiling
 
 DEFAULT_THRESHOLD=5                  # how many counts of a taxid at min
 
+array_I_dtype = numpy.dtype('u{}'.format(array('I').itemsize))
+
 taxlist = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus',
            'species']
 
+# the lineages of all loaded databases, by default.
+_lineage_trie = lineage_trie.LineageTrie()
+
 _print_debug = False
 def debug(*args):
     if _print_debug:
@@ -173,139 +189,449 @@ def test_build_reverse_tree_4():          # empty 'rank2' name
 
 
 class LCA_Database(object):
-    def __init__(self):
+    """
+    A sourmash_lca database.  The hashval -> lineage ids assignments are
+    kept in compact CSR-style arrays: a sorted uint64 'hashvals' column,
+    and 'lineage_ids[offsets[i]:offsets[i + 1]]' for the i'th hashval.
+    The lineages are interned in a LineageTrie shared between databases;
+    'lineage_nodes' maps lineage ids to trie nodes, and 'lineage_branched'
+    flags the lineages that free-tax-1.py --precompute-lca-branches stored as the
+    LCA of disagreeing lineages.
+    """
+    def __init__(self, trie=None):
+        if trie is None:
+            trie = _lineage_trie
+        self.trie = trie
         self.lineage_dict = None
-        self.hashval_to_lineage_id = None
+        self.lineage_nodes = None
+        self.lineage_branched = None
+        self.hashvals = None
+        self.offsets = None
+        self.lineage_ids = None
         self.ksize = None
         self.scaled = None
         self.signatures_to_lineage = None
 
     def load(self, db_name):
-        with open(db_name, 'rt') as fp:
-            load_d = json.load(fp)
-            version = load_d['version']
-            assert version == '1.0'
-
-            type = load_d['type']
-            assert type == 'sourmash_lca'
+        """
+        Load a database saved by free-tax-1.py, either in the binary v3
+        format (which is mmapped) or as v2 JSON.
+        """
+        if lca_index.is_lca_index(db_name):
+            self._load_binary(db_name)
+        else:
+            self._load_json(db_name)
+
+    def _load_binary(self, db_name):
+        header, hashvals, offsets, lineage_ids = \
+          lineage_db.load_lineage_db(db_name)
+
+        self._set_header(header, header['lineages'],
+                         header['signatures_to_lineage'],
+                         header.get('lca_lineages', []))
+        self.hashvals = hashvals
+        self.offsets = offsets
+        self.lineage_ids = lineage_ids
+
+    def _load_json(self, db_name):
+        """
+        The JSON is streamed with ijson straight into the final arrays,
+        without ever holding the parsed JSON (or a dictionary of all the
+        hashvals) in memory.
+        """
+        load_d = {}
+        lineage_dict_2 = defaultdict(dict)
+        signatures_to_lineage = {}
+        lca_lineages = []
+
+        hashvals = array('Q')
+        n_assignments = array('Q')
+        lineage_ids = array('I')
+
+        with open(db_name, 'rb') as fp:
+            depth = 0
+            top_key = None
+            key = None
+            rank = None
+            for event, value in ijson.basic_parse(fp):
+                if event == 'number' or event == 'string':
+                    if depth == 1:
+                        load_d[top_key] = value
+                    elif top_key == 'hashval_assignments':
+                        lineage_ids.append(value)
+                    elif top_key == 'lineages':
+                        lineage_dict_2[key][rank] = value
+                    elif top_key == 'signatures_to_lineage':
+                        signatures_to_lineage[key] = value
+                    elif top_key == 'lca_lineages':
+                        lca_lineages.append(value)
+                elif event == 'map_key':
+                    if depth == 1:
+                        top_key = value
+                    elif depth == 2:
+                        key = value
+                        if top_key == 'hashval_assignments':
+                            hashvals.append(int(value))
+                            n_assignments.append(len(lineage_ids))
+                        elif top_key == 'lineages':    # may be empty
+                            lineage_dict_2.setdefault(value, {})
+                    else:
+                        rank = value
+                elif event == 'start_map' or event == 'start_array':
+                    depth += 1
+                elif event == 'end_map' or event == 'end_array':
+                    depth -= 1
+
+        version = load_d['version']
+        assert version == '1.0'
+
+        type = load_d['type']
+        assert type == 'sourmash_lca'
+
+        self._set_header(load_d, lineage_dict_2, signatures_to_lineage,
+                         lca_lineages)
+
+        n_assignments.append(len(lineage_ids))
+        self._set_assignments(numpy.frombuffer(hashvals, dtype=numpy.uint64),
+                              numpy.frombuffer(n_assignments, dtype=numpy.uint64),
+                              numpy.frombuffer(lineage_ids, dtype=array_I_dtype))
+
+    def _set_header(self, load_d, lineages, signatures_to_lineage,
+                    lca_lineages=()):
+        "Set ksize, scaled and the lineage table from a loaded header."
+        lineage_dict = {}
+        for k, v in lineages.items():
+            vv = []
+            for rank in taxlist:
+                name = v.get(rank, '')
+                vv.append((rank, name))
+
+            lineage_dict[int(k)] = tuple(vv)
+
+        # intern the lineages in the trie, once, at load.
+        lineage_nodes = numpy.zeros(max(lineage_dict, default=-1) + 1,
+                                    dtype=numpy.int64)
+        for lineage_id, lineage in lineage_dict.items():
+            lineage_nodes[lineage_id] = self.trie.add(lineage)
+
+        lineage_branched = numpy.zeros(len(lineage_nodes), dtype=bool)
+        lineage_branched[numpy.array(lca_lineages, dtype=numpy.int64)] = True
 
-            ksize = load_d['ksize']
-            scaled = load_d['scaled']
-
-            lineage_dict_2 = load_d['lineages']
-            lineage_dict = {}
-            for k, v in lineage_dict_2.items():
-                vv = []
-                for rank in taxlist:
-                    name = v.get(rank, '')
-                    vv.append((rank, name))
+        self.lineage_dict = lineage_dict
+        self.lineage_nodes = lineage_nodes
+        self.lineage_branched = lineage_branched
+        self.ksize = load_d['ksize']
+        self.scaled = load_d['scaled']
+        self.signatures_to_lineage = signatures_to_lineage
 
-                lineage_dict[int(k)] = tuple(vv)
+    def _set_assignments(self, hashvals, starts, lineage_ids):
+        """
+        Sort the hashvals (in file order, with the lineage ids for hashval
+        i in 'lineage_ids[starts[i]:starts[i + 1]]') into the CSR arrays.
+        """
+        order = numpy.argsort(hashvals, kind='stable')
+        counts = numpy.diff(starts.astype(numpy.int64))[order]
+
+        offsets = numpy.zeros(len(hashvals) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+
+        # gather each hashval's lineage ids into their new place.
+        src = numpy.repeat(starts[:-1][order].astype(numpy.int64) - offsets[:-1],
+                           counts) + numpy.arange(offsets[-1])
+
+        self.hashvals = numpy.array(hashvals[order], dtype=numpy.uint64)
+        self.offsets = offsets
+        self.lineage_ids = numpy.array(lineage_ids, dtype=numpy.uint32)[src]
+
+    def find_hashvals(self, query_hashvals):
+        """
+        Vectorized lookup: return a numpy array with the position of each
+        of 'query_hashvals' (a uint64 numpy array) in this database, or -1
+        if it is not present.
+        """
+        if not len(self.hashvals):
+            return numpy.full(len(query_hashvals), -1, dtype=numpy.int64)
+
+        idx = numpy.searchsorted(self.hashvals, query_hashvals)
+        idx[idx == len(self.hashvals)] = 0
+        idx[self.hashvals[idx] != query_hashvals] = -1
+        return idx
+
+    def get_lineage_ids(self, pos):
+        "Get the list of lineage ids for the hashval at position 'pos'."
+        return self.lineage_ids[self.offsets[pos]:self.offsets[pos + 1]].tolist()
+
+
+def merge_databases(dblist):
+    """
+    Merge the databases in 'dblist', which must have the same ksize and
+    scaled, into one LCA_Database with a single lineage table, so that
+    each query hashval is looked up once rather than once per database.
+    Classification results are the same as with the list.
+    """
+    ksize = dblist[0].ksize
+    scaled = dblist[0].scaled
+    for lca_db in dblist:
+        if lca_db.ksize != ksize:
+            raise Exception('multiple ksizes, cannot merge')
+        if lca_db.scaled != scaled:
+            raise Exception('multiple scaled vals, cannot merge')
+
+    lineage_dict, hashvals, offsets, lineage_ids, signatures_to_lineage, \
+      lca_lineages = lineage_db.merge_lineage_dbs(
+          [ (lca_db.lineage_dict, lca_db.hashvals, lca_db.offsets,
+             lca_db.lineage_ids, lca_db.signatures_to_lineage,
+             numpy.flatnonzero(lca_db.lineage_branched).tolist())
+            for lca_db in dblist ])
+
+    merged = LCA_Database(dblist[0].trie)
+    merged._set_header({ 'ksize': ksize, 'scaled': scaled },
+                       { k: dict(v) for k, v in lineage_dict.items() },
+                       signatures_to_lineage, sorted(lca_lineages))
+    merged.hashvals = hashvals
+    merged.offsets = offsets
+    merged.lineage_ids = lineage_ids
+    return merged
+
+
+def check_stacked_lca_lineages(dblist):
+    """
+    Warn if 'dblist' stacks databases built with --precompute-lca-branches
+    where some (rank, name) has different parents, in which case results
+    can differ from those with databases built without it.  Returns True
+    if so.
+    """
+    if len(dblist) < 2 or not dblist[0].trie.n_ambiguous:
+        return False
+    if not any([ lca_db.lineage_branched.any() for lca_db in dblist ]):
+        return False
+
+    print('** warning: databases built with --precompute-lca-branches are used with others, and {} names have more than one parent; results may differ from databases built without it.'.format(dblist[0].trie.n_ambiguous), file=sys.stderr)
+    return True
+
+
+def test_merge_databases():
+    class FakeSignature(object):
+        def __init__(self, mins):
+            self.minhash = self
+            self.mins = mins
+        def get_mins(self):
+            return self.mins
+
+    trie = lineage_trie.LineageTrie()
+    lineages = { 0: { 'superkingdom': 'a', 'phylum': 'b' },
+                 1: { 'superkingdom': 'a', 'phylum': 'c' },
+                 2: { 'superkingdom': 'd' } }
+    dblist = []
+    for assignments in ({ 1: [0], 2: [0, 1], 3: [2] },
+                        { 2: [0], 3: [0], 4: [1], 5: [0] }):
+        lca_db = LCA_Database(trie)
+        lca_db._set_header({ 'ksize': 31, 'scaled': 1 }, lineages, {})
+        lca_db.hashvals, lca_db.offsets, lca_db.lineage_ids = \
+          lineage_db.hashval_assignments_to_arrays(assignments)
+        dblist.append(lca_db)
 
-            hashval_to_lineage_id_2 = load_d['hashval_assignments']
-            hashval_to_lineage_id = {}
-            for k, v in hashval_to_lineage_id_2.items():
-                hashval_to_lineage_id[int(k)] = v
+    merged = merge_databases(dblist)
+    assert merged.hashvals.tolist() == [1, 2, 3, 4, 5]
+    assert len(merged.lineage_dict) == 3
+
+    query_sig = FakeSignature([1, 2, 3, 4, 5, 6])
+    for threshold in (1, 2, 3):
+        assert classify_signature(query_sig, [merged], threshold) == \
+          classify_signature(query_sig, dblist, threshold)
+    assert classify_signature(query_sig, [merged], 2) == \
+      [('superkingdom', 'a'), ('phylum', 'b')]
+
+
+def test_check_stacked_lca_lineages():
+    # 'cl0' is under 'ph1' in db1 and under 'ph0' in db2; with hash 4
+    # stored as its LCA (the root), the baseline's 'ph0' parent is lost.
+    class FakeSignature(object):
+        def __init__(self, mins):
+            self.minhash = self
+            self.mins = mins
+        def get_mins(self):
+            return self.mins
+
+    def make_dblist(db2_lineages, db2_assignments, lca_lineages=()):
+        trie = lineage_trie.LineageTrie()
+        dblist = []
+        for lineages, assignments, lca in \
+          (({ 0: { 'superkingdom': 'su0', 'phylum': 'ph1', 'class': 'cl0' } },
+            { 2: [0] }, ()),
+           (db2_lineages, db2_assignments, lca_lineages)):
+            lca_db = LCA_Database(trie)
+            lca_db._set_header({ 'ksize': 31, 'scaled': 1 }, lineages, {},
+                               lca)
+            lca_db.hashvals, lca_db.offsets, lca_db.lineage_ids = \
+              lineage_db.hashval_assignments_to_arrays(assignments)
+            dblist.append(lca_db)
+        return dblist
+
+    db2_lineages = { 0: { 'superkingdom': 'su1' },
+                     1: { 'superkingdom': 'su0', 'phylum': 'ph0',
+                          'class': 'cl0' } }
+    query_sig = FakeSignature([2, 4])
+
+    dblist = make_dblist(db2_lineages, { 4: [1, 0] })
+    assert not check_stacked_lca_lineages(dblist)
+    assert classify_signature(query_sig, dblist, 1) == \
+      [('superkingdom', 'su0'), ('phylum', 'ph0'), ('class', 'cl0')]
+
+    db2_lineages[2] = {}
+    dblist = make_dblist(db2_lineages, { 4: [2] }, [2])
+    assert check_stacked_lca_lineages(dblist)
+    assert classify_signature(query_sig, dblist, 1) == \
+      [('superkingdom', 'su0'), ('phylum', 'ph1'), ('class', 'cl0')]
+
+
+def classify_signature(query_sig, dblist, threshold, stats=None):
+    """
+    Classify 'query_sig' against 'dblist'; returns the lineage as a list of
+    (rank, name) tuples.  If 'stats' (a Counter) is given, the hash counts
+    and the time spent looking up hashes and building trees are added to it.
+    """
+    start = time.perf_counter()
+
+    trie = dblist[0].trie
+    assert all([ lca_db.trie is trie for lca_db in dblist ])
+
+    # find which hashvals are in which database all at once, and gather
+    # the trie nodes for their lineages, grouped by hashval (in query
+    # order) and then by database.
+    query_hashvals = numpy.array(query_sig.minhash.get_mins(),
+                                 dtype=numpy.uint64)
+    hash_idx = []
+    nodes = []
+    branched = []
+    any_found = numpy.zeros(len(query_hashvals), dtype=bool)
+    for lca_db in dblist:
+        pos = lca_db.find_hashvals(query_hashvals)
+        found = numpy.flatnonzero(pos >= 0)
+        any_found[found] = True
+
+        starts = lca_db.offsets[pos[found]]
+        n_assigned = lca_db.offsets[pos[found] + 1] - starts
+        src = numpy.repeat(starts - (numpy.cumsum(n_assigned) - n_assigned),
+                           n_assigned) + numpy.arange(n_assigned.sum())
+
+        hash_idx.append(numpy.repeat(found, n_assigned))
+        lineage_ids = lca_db.lineage_ids[src]
+        nodes.append(lca_db.lineage_nodes[lineage_ids])
+        branched.append(lca_db.lineage_branched[lineage_ids])
+
+    hash_idx = numpy.concatenate(hash_idx)
+    order = numpy.argsort(hash_idx, kind='stable')
+    nodes = numpy.concatenate(nodes)[order]
+    branched = numpy.concatenate(branched)[order]
+    _, group_starts = numpy.unique(hash_idx[order], return_index=True)
+    group_ends = numpy.append(group_starts, len(nodes))[1:]
+
+    debug('n custom hashvals:', len(nodes))
+    if _print_debug:
+        check_counts = Counter([ tuple(trie.get_lineage(node)) for node in
+                                 nodes[group_ends - 1].tolist() ])
+        debug(pprint.pformat(check_counts.most_common()))
+
+    if stats is not None:
+        lookup_done = time.perf_counter()
+        stats['n_hashes'] += len(query_hashvals)
+        stats['n_found'] += int(any_found.sum())
+        stats['lookup_seconds'] += lookup_done - start
+
+    # find the LCA for each hashval: where all of its lineages end at the
+    # same node, that's it; otherwise, walk the trie.  (Precomputed LCAs
+    # of disagreeing lineages are 'branched'.)
+    node_list = nodes.tolist()
+    branched_list = branched.tolist() if branched.any() else None
+    if len(nodes):
+        lcas = numpy.minimum.reduceat(nodes, group_starts)
+        mixed = numpy.flatnonzero(lcas != numpy.maximum.reduceat(nodes,
+                                                                 group_starts))
+        lcas[mixed] = [ trie.find_lca(node_list[start:end],
+                                      branched_list and
+                                      branched_list[start:end])
+                        for start, end in zip(group_starts[mixed].tolist(),
+                                              group_ends[mixed].tolist()) ]
+    else:
+        lcas = nodes
 
-            signatures_to_lineage = load_d['signatures_to_lineage']
+    # count the LCAs by (rank, name), in the order they're first seen.
+    lca_nodes, first, lca_counts = numpy.unique(lcas, return_index=True,
+                                                return_counts=True)
+    counts = Counter()
+    for i in numpy.argsort(first, kind='stable'):
+        counts[trie.label[lca_nodes[i]]] += int(lca_counts[i])
 
-        self.lineage_dict = lineage_dict
-        self.hashval_to_lineage_id = hashval_to_lineage_id
-        self.ksize = ksize
-        self.scaled = scaled
-        self.signatures_to_lineage = signatures_to_lineage
+    if _print_debug:
+        debug(pprint.pformat(counts.most_common()))
 
+    # now sum across "significant" LCAs - those above threshold - and
+    # find the LCA of those.
+    significant = [ label_id for label_id, count in counts.most_common()
+                    if count >= threshold ]
+    if len(significant) > 1:
+        debug('XXX', len(significant))
 
-def classify_signature(query_sig, dblist, threshold):
-    # gather assignments from across all the databases
-    these_assignments = defaultdict(list)
-    n_custom = 0
-    for hashval in query_sig.minhash.get_mins():
-        for lca_db in dblist:
-            assignments = lca_db.hashval_to_lineage_id.get(hashval, [])
-            for lineage_id in assignments:
-                assignment = lca_db.lineage_dict[lineage_id]
-                these_assignments[hashval].append(assignment)
-                n_custom += 1
-
-    # count number of assignments for each most-specific
-    check_counts = Counter()
-    for tuple_info in these_assignments.values():
-        last_tup = tuple(tuple_info[-1])
-        check_counts[last_tup] += 1
-
-    debug('n custom hashvals:', n_custom)
-    debug(pprint.pformat(check_counts.most_common()))
-
-    # now convert to trees -> do LCA & counts
-    counts = Counter()
-    parents = {}
-    for hashval in these_assignments:
-
-        # for each list of tuple_info [(rank, name), ...] build
-        # a tree that lets us discover least-common-ancestor.
-        tuple_info = these_assignments[hashval]
-        tree = build_tree(tuple_info)
-
-        # also update a tree that we can ascend from leaves -> parents
-        # for all assignments for all hashvals
-        parents = build_reverse_tree(tuple_info, parents)
-
-        # now find either a leaf or the first node with multiple
-        # children; that's our least-common-ancestor node.
-        lca, reason = find_lca(tree)
-        counts[lca] += 1
-
-    # ok, we now have the LCAs for each hashval, and their number
-    # of counts. Now sum across "significant" LCAs - those above
-    # threshold.
-
-    tree = {}
-    tree_counts = defaultdict(int)
-
-    debug(pprint.pformat(counts.most_common()))
-
-    n = 0
-    for lca, count in counts.most_common():
-        if count < threshold:
-            break
-
-        n += 1
-
-        xx = []
-        parent = lca
-        while parent:
-            xx.insert(0, parent)
-            tree_counts[parent] += count
-            parent = parents.get(parent)
-        debug(n, count, xx[1:])
-
-        # update tree with this set of assignments
-        build_tree([xx], tree)
-
-    if n > 1:
-        debug('XXX', n)
-
-    # now find LCA? or whatever.
-    lca, reason = find_lca(tree)
-    if reason == 0:               # leaf node
-        debug('END', lca)
-    else:                         # internal node
-        debug('MULTI', lca)
-
-    # backtrack to full lineage via parents
-    lineage = []
-    parent = lca
-    while parent != ('root', 'root'):
-        lineage.insert(0, parent)
-        parent = parents.get(parent)
-
-    debug(parents)
+    label_parents = trie.get_label_parents(node_list)
+    lineage = trie.find_label_lca(significant, label_parents)
     debug('lineage is:', lineage)
 
+    if stats is not None:
+        stats['lca_seconds'] += time.perf_counter() - lookup_done
+
     return lineage
 
 
+def classify_query_file(query_filename, dblist, ksize, scaled, threshold,
+                        stats=None):
+    """
+    Classify all the signatures in 'query_filename'; return a list of
+    output CSV rows, one per signature.  'stats' is as for
+    classify_signature, plus signature loading and downsampling times.
+    """
+    if stats is None:
+        stats = Counter()
+
+    rows = []
+    start = time.perf_counter()
+    siglist = list(sourmash_lib.load_signatures(query_filename, ksize=ksize))
+    stats['load_signatures_seconds'] += time.perf_counter() - start
+    stats['n_signatures'] += len(siglist)
+
+    for query_sig in siglist:
+        debug('classifying', query_sig.name())
+
+        # make sure we're looking at the same scaled value as database
+        start = time.perf_counter()
+        query_sig.minhash = query_sig.minhash.downsample_scaled(scaled)
+        stats['downsample_seconds'] += time.perf_counter() - start
+
+        lineage = classify_signature(query_sig, dblist, threshold, stats)
+
+        # output!
+        row = [query_sig.name()]
+        for taxrank, (rank, name) in itertools.zip_longest(taxlist, lineage, fillvalue=('', '')):
+            if rank:
+                assert taxrank == rank
+            row.append(name)
+
+        rows.append(row)
+
+    return rows
+
+
+_worker_state = {}
+
+
+def _classify_query_file(query_filename):
+    stats = Counter()
+    rows = classify_query_file(query_filename, _worker_state['dblist'],
+                               _worker_state['ksize'], _worker_state['scaled'],
+                               _worker_state['threshold'], stats)
+    return query_filename, rows, stats
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument('--db', nargs='+', action='append')
@@ -315,12 +641,22 @@ def main():
                    help='output CSV to this file instead of stdout')
     #p.add_argument('-v', '--verbose', action='store_true')
     p.add_argument('-d', '--debug', action='store_true')
+    p.add_argument('-j', '--jobs', default=1, type=int,
+                   help='number of worker processes for classification')
+    p.add_argument('--no-merge', action='store_true',
+                   help='look up hashes in each database separately, rather than merging them at load')
+    profiling.add_profile_report_option(p)
     args = p.parse_args()
 
+    if args.jobs < 1:
+        p.error('--jobs must be at least 1')
+
     if args.debug:
         global _print_debug
         _print_debug = True
 
+    profile = profiling.Profile(enabled=bool(args.profile_report))
+
     ksize_vals = set()
     scaled_vals = set()
     dblist = []
@@ -334,8 +670,10 @@ def main():
         print('... loading database {}'.format(db_name), end='\r',
               file=sys.stderr)
 
-        lca_db = LCA_Database()
-        lca_db.load(db_name)
+        with profile.phase('load_database', filename=db_name) as record:
+            lca_db = LCA_Database()
+            lca_db.load(db_name)
+            record['n_hashvals'] = len(lca_db.hashvals)
 
         ksize_vals.add(lca_db.ksize)
         if len(ksize_vals) > 1:
@@ -348,6 +686,13 @@ def main():
 
     print(u'\r\033[K', end=u'', file=sys.stderr)
     print('loaded {} databases for LCA use.'.format(len(dblist)))
+    check_stacked_lca_lineages(dblist)
+
+    if len(dblist) > 1 and not args.no_merge:
+        with profile.phase('merge_databases', n_databases=len(dblist)) as record:
+            dblist = [merge_databases(dblist)]
+            record['n_hashvals'] = len(dblist[0].hashvals)
+        print('merged into one database with {} hashvals.'.format(len(dblist[0].hashvals)))
 
     ksize = ksize_vals.pop()
     scaled = scaled_vals.pop()
@@ -363,35 +708,50 @@ def main():
     csvfp.writerow(['ID'] + taxlist)
 
     total_count = 0
-    n = 0
     total_n = len(args.query)
-    for query_filename in args.query:
-        n += 1
-        for query_sig in sourmash_lib.load_signatures(query_filename,
-                                                      ksize=ksize):
+
+    # classify each query file, in parallel if requested; workers inherit
+    # the loaded databases from this process via fork.  With --jobs, the
+    # time spent in each step is summed across the workers, and peak RSS
+    # is for this process only.
+    _worker_state.update(dblist=dblist, ksize=ksize, scaled=scaled,
+                         threshold=args.threshold)
+    with profile.phase('classify', n_files=total_n, jobs=args.jobs) as record:
+        if args.jobs > 1:
+            pool = multiprocessing.get_context('fork').Pool(args.jobs)
+            results = pool.imap(_classify_query_file, args.query)
+        else:
+            pool = None
+            results = map(_classify_query_file, args.query)
+
+        stats = Counter()
+        for n, (query_filename, rows, file_stats) in enumerate(results, 1):
             print(u'\r\033[K', end=u'', file=sys.stderr)
-            print('... classifying {} (file {} of {})'.format(query_sig.name(), n, total_n), end='\r',
+            print('... classified {} (file {} of {})'.format(query_filename, n, total_n), end='\r',
                   file=sys.stderr)
-            debug('classifying', query_sig.name())
-            total_count += 1
-
-            # make sure we're looking at the same scaled value as database
-            query_sig.minhash = query_sig.minhash.downsample_scaled(scaled)
-
-            lineage = classify_signature(query_sig, dblist, args.threshold)
-
-            # output!
-            row = [query_sig.name()]
-            for taxrank, (rank, name) in itertools.zip_longest(taxlist, lineage, fillvalue=('', '')):
-                if rank:
-                    assert taxrank == rank
-                row.append(name)
-
-            csvfp.writerow(row)
+            for row in rows:
+                csvfp.writerow(row)
+            total_count += len(rows)
+            stats.update(file_stats)
+
+        if pool:
+            pool.close()
+            pool.join()
+        _worker_state.clear()
+
+        for key in ('n_signatures', 'n_hashes', 'n_found',
+                    'load_signatures_seconds', 'downsample_seconds',
+                    'lookup_seconds', 'lca_seconds'):
+            record[key] = stats[key]
+        record['hit_rate'] = stats['n_found'] / stats['n_hashes'] \
+                             if stats['n_hashes'] else None
 
     print(u'\r\033[K', end=u'', file=sys.stderr)
     print('classified {} signatures total'.format(total_count), file=sys.stderr)
 
+    if args.profile_report:
+        profile.write_report(args.profile_report, script='free-tax-2.py')
+
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -19,9 +19,7 @@ def main():
     p.add_argument('-o', '--output', type=argparse.FileType('wt'))
     a = p.parse_args()
 
-    taxfoo = ncbi_taxdump_utils.NCBI_TaxonomyFoo()
-    taxfoo.load_nodes_dmp(a.nodes_dmp)
-    taxfoo.load_names_dmp(a.names_dmp)
+    taxfoo = ncbi_taxdump_utils.load_taxonomy(a.nodes_dmp, a.names_dmp)
     taxfoo.load_accessions_csv(a.accession_csv)
 
     csv_w = None
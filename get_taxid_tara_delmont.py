@@ -60,9 +60,8 @@ def main():
     args = p.parse_args()
 
     # ok, read in all the tax info.
-    taxfoo = ncbi_taxdump_utils.NCBI_TaxonomyFoo()
-    taxfoo.load_names_dmp(args.names_dmp, False)
-    taxfoo.load_nodes_dmp(args.nodes_dmp, False)
+    taxfoo = ncbi_taxdump_utils.load_taxonomy(args.nodes_dmp, args.names_dmp,
+                                              False)
 
     # reverse index names -> tasxids
     names_to_taxids = defaultdict(set)
@@ -0,0 +1,852 @@
+"""
+On-disk sorted-array index of hashval -> LCA taxid.
+
+The index is a small JSON header followed by a sorted uint64 column of
+hash values and a parallel uint32 column of taxids.  It is opened with
+mmap, so loading is near-instant and several processes on one machine
+share the same pages through the OS page cache.
+
+The 'packed' variant (PackedLCA_Index) stores the same mapping in a
+compressed but randomly accessible form; see its docstring.
+"""
+
+import json
+import os
+import struct
+
+import numpy
+
+
+MAGIC = b'SMLCAIDX'
+ALIGN = 8
+
+MAX_HASH = 2**64 - 1                      # as in sourmash_lib
+
+
+def max_hash_for_scaled(scaled):
+    "Hash values below this are kept by a MinHash at the given scaled."
+    if scaled == 1:
+        return MAX_HASH
+    return int(round(MAX_HASH / scaled, 0))
+
+
+class LCA_Index(object):
+    """
+    Read-only hashval -> LCA taxid mapping backed by sorted arrays.
+
+    Supports the parts of the dict interface used by the scripts in this
+    repo (get, in, len, iteration, items).
+    """
+    def __init__(self, hashvals, taxids):
+        assert len(hashvals) == len(taxids)
+        self.hashvals = hashvals
+        self.taxids = taxids
+
+    @classmethod
+    def from_dict(cls, hashval_to_lca):
+        "Build an in-memory index from a hashval -> taxid dictionary."
+        hashvals = numpy.fromiter(hashval_to_lca.keys(), dtype=numpy.uint64,
+                                  count=len(hashval_to_lca))
+        taxids = numpy.fromiter(hashval_to_lca.values(), dtype=numpy.uint32,
+                                count=len(hashval_to_lca))
+        order = numpy.argsort(hashvals, kind='stable')
+        return cls(hashvals[order], taxids[order])
+
+    def _find(self, hashval):
+        i = int(numpy.searchsorted(self.hashvals, numpy.uint64(hashval)))
+        if i < len(self.hashvals) and int(self.hashvals[i]) == hashval:
+            return i
+        return -1
+
+    def get(self, hashval, default=None):
+        i = self._find(hashval)
+        if i < 0:
+            return default
+        return int(self.taxids[i])
+
+    def __getitem__(self, hashval):
+        i = self._find(hashval)
+        if i < 0:
+            raise KeyError(hashval)
+        return int(self.taxids[i])
+
+    def __contains__(self, hashval):
+        return self._find(hashval) >= 0
+
+    def __len__(self):
+        return len(self.hashvals)
+
+    def __iter__(self):
+        for hashval in self.hashvals:
+            yield int(hashval)
+
+    def items(self):
+        for hashval, taxid in zip(self.hashvals, self.taxids):
+            yield int(hashval), int(taxid)
+
+    def get_lcas(self, hashvals):
+        """
+        Look up many hash values at once; returns a uint32 numpy array of
+        LCA taxids in the same order as 'hashvals', with 0 for a miss.
+        """
+        hashvals = numpy.asarray(hashvals, dtype=numpy.uint64)
+        lcas = numpy.zeros(len(hashvals), dtype=numpy.uint32)
+        if not len(self.hashvals) or not len(hashvals):
+            return lcas
+
+        # search in sorted order, to walk through the mmapped column once.
+        order = numpy.argsort(hashvals, kind='stable')
+        sorted_q = hashvals[order]
+
+        idx = numpy.searchsorted(self.hashvals, sorted_q)
+        idx[idx == len(self.hashvals)] = 0
+        found = self.hashvals[idx] == sorted_q
+
+        lcas[order[found]] = self.taxids[idx[found]]
+        return lcas
+
+    def downsample(self, scaled):
+        """
+        Restrict to the hash values kept by a MinHash at 'scaled'; since
+        the hash values are sorted, this is just a prefix of the arrays.
+        """
+        max_hash = max_hash_for_scaled(scaled)
+        n = int(numpy.searchsorted(self.hashvals, numpy.uint64(max_hash),
+                                   side='right'))
+        if n == len(self.hashvals):
+            return self
+        return LCA_Index(self.hashvals[:n], self.taxids[:n])
+
+    def save(self, filename):
+        header = dict(type='sourmash_lca_index', version=1, format='sorted')
+        save_arrays(filename, header, [('hashvals', self.hashvals),
+                                       ('taxids', self.taxids)])
+
+
+class PackedLCA_Index(LCA_Index):
+    """
+    Compressed hashval -> LCA taxid mapping, in the style of a partitioned
+    Elias-Fano encoding.
+
+    The sorted hash values are split into buckets by their high bits, and
+    'bucket_offsets' (the skip pointers) gives the start of each bucket.
+    Only the low 'residual_bits' of each hash value are stored, bit-packed
+    into 64-bit words.  Taxids are replaced by their index in a sorted
+    'palette' of the distinct taxids, also bit-packed.
+
+    Since hash values are uniform after downsampling, buckets hold about
+    BUCKET_SIZE values each, and a lookup is a short binary search within
+    one bucket.  All lookups are vectorized over the queries.
+    """
+    BUCKET_SIZE = 16
+
+    def __init__(self, n, residual_bits, bucket_offsets, residuals,
+                 palette, taxid_codes):
+        self.n = n
+        self.residual_bits = residual_bits
+        self.bucket_offsets = bucket_offsets
+        self.residuals = residuals
+        self.palette = palette
+        self.taxid_codes = taxid_codes
+        self.taxid_bits = _bit_width(len(palette) - 1)
+
+    @classmethod
+    def from_arrays(cls, hashvals, taxids):
+        "Pack sorted, distinct 'hashvals' and the parallel 'taxids'."
+        hashvals = numpy.asarray(hashvals, dtype=numpy.uint64)
+        taxids = numpy.asarray(taxids, dtype=numpy.uint32)
+        n = len(hashvals)
+
+        max_hashval = int(hashvals[-1]) if n else 0
+        n_buckets_bits = _bit_width(max(n // cls.BUCKET_SIZE, 1))
+        residual_bits = max(_bit_width(max_hashval) - n_buckets_bits, 0)
+
+        buckets = hashvals >> numpy.uint64(residual_bits)
+        n_buckets = (max_hashval >> residual_bits) + 1
+        offset_dtype = numpy.uint32 if n < 2**32 else numpy.uint64
+        bucket_offsets = numpy.searchsorted(buckets,
+                                            numpy.arange(n_buckets + 1,
+                                                         dtype=numpy.uint64))
+        bucket_offsets = bucket_offsets.astype(offset_dtype)
+
+        mask = numpy.uint64((1 << residual_bits) - 1)
+        residuals = pack_bits(hashvals & mask, residual_bits)
+
+        palette, codes = numpy.unique(taxids, return_inverse=True)
+        palette = palette.astype(numpy.uint32)
+        taxid_codes = pack_bits(codes.ravel(), _bit_width(len(palette) - 1))
+
+        return cls(n, residual_bits, bucket_offsets, residuals, palette,
+                   taxid_codes)
+
+    @classmethod
+    def from_dict(cls, hashval_to_lca):
+        index = LCA_Index.from_dict(hashval_to_lca)
+        return cls.from_arrays(index.hashvals, index.taxids)
+
+    @property
+    def hashvals(self):
+        "All of the hash values, decoded into memory."
+        positions = numpy.arange(self.n, dtype=numpy.int64)
+        buckets = numpy.repeat(numpy.arange(len(self.bucket_offsets) - 1,
+                                            dtype=numpy.uint64),
+                               numpy.diff(self.bucket_offsets.astype(numpy.int64)))
+        return (buckets << numpy.uint64(self.residual_bits)) | \
+               unpack_bits(self.residuals, positions, self.residual_bits)
+
+    @property
+    def taxids(self):
+        "All of the taxids, decoded into memory."
+        return self._taxids_at(numpy.arange(self.n, dtype=numpy.int64))
+
+    def _taxids_at(self, positions):
+        return self.palette[unpack_bits(self.taxid_codes, positions,
+                                        self.taxid_bits).astype(numpy.int64)]
+
+    def _search(self, hashvals):
+        """
+        Return the position of each of 'hashvals' (a uint64 numpy array),
+        or -1 if it is not present.
+        """
+        n_buckets = len(self.bucket_offsets) - 1
+        buckets = hashvals >> numpy.uint64(self.residual_bits)
+        valid = buckets < numpy.uint64(n_buckets)
+        buckets = numpy.where(valid, buckets, 0).astype(numpy.int64)
+
+        lo = self.bucket_offsets[buckets].astype(numpy.int64)
+        end = self.bucket_offsets[buckets + 1].astype(numpy.int64)
+        end[~valid] = lo[~valid]
+        hi = end.copy()
+        target = hashvals & numpy.uint64((1 << self.residual_bits) - 1)
+
+        # binary search for the lower bound within each bucket, in parallel.
+        active = lo < hi
+        while active.any():
+            mid = (lo + hi) // 2
+            values = unpack_bits(self.residuals, numpy.where(active, mid, 0),
+                                 self.residual_bits)
+            go_right = active & (values < target)
+            lo = numpy.where(go_right, mid + 1, lo)
+            hi = numpy.where(active & ~go_right, mid, hi)
+            active = lo < hi
+
+        found = lo < end
+        values = unpack_bits(self.residuals, numpy.where(found, lo, 0),
+                             self.residual_bits)
+        found &= values == target
+        return numpy.where(found, lo, -1)
+
+    def _find(self, hashval):
+        return int(self._search(numpy.array([hashval], dtype=numpy.uint64))[0])
+
+    def get(self, hashval, default=None):
+        i = self._find(hashval)
+        if i < 0:
+            return default
+        return int(self._taxids_at(numpy.array([i]))[0])
+
+    def __getitem__(self, hashval):
+        i = self._find(hashval)
+        if i < 0:
+            raise KeyError(hashval)
+        return int(self._taxids_at(numpy.array([i]))[0])
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for hashval in self.hashvals:
+            yield int(hashval)
+
+    def items(self):
+        for hashval, taxid in zip(self.hashvals, self.taxids):
+            yield int(hashval), int(taxid)
+
+    def downsample(self, scaled):
+        """
+        Restrict to the hash values kept by a MinHash at 'scaled': keep a
+        prefix of the buckets, with the last one cut short.  The packed
+        columns are shared, not copied.
+        """
+        max_hash = max_hash_for_scaled(scaled)
+        n_buckets = len(self.bucket_offsets) - 1
+        last = max_hash >> self.residual_bits
+        if last >= n_buckets:
+            return self
+
+        start = int(self.bucket_offsets[last])
+        end = int(self.bucket_offsets[last + 1])
+        residuals = unpack_bits(self.residuals,
+                                numpy.arange(start, end, dtype=numpy.int64),
+                                self.residual_bits)
+        target = numpy.uint64(max_hash & ((1 << self.residual_bits) - 1))
+        n = start + int(numpy.searchsorted(residuals, target, side='right'))
+        if n == self.n:
+            return self
+
+        bucket_offsets = numpy.minimum(self.bucket_offsets[:last + 2], n)
+        bucket_offsets = bucket_offsets.astype(self.bucket_offsets.dtype)
+        return PackedLCA_Index(n, self.residual_bits, bucket_offsets,
+                               self.residuals, self.palette, self.taxid_codes)
+
+    def get_lcas(self, hashvals):
+        hashvals = numpy.asarray(hashvals, dtype=numpy.uint64)
+        lcas = numpy.zeros(len(hashvals), dtype=numpy.uint32)
+        if not self.n or not len(hashvals):
+            return lcas
+
+        pos = self._search(hashvals)
+        found = pos >= 0
+        lcas[found] = self._taxids_at(pos[found])
+        return lcas
+
+    def save(self, filename):
+        header = dict(type='sourmash_lca_index', version=1, format='packed',
+                      n=self.n, residual_bits=self.residual_bits)
+        save_arrays(filename, header,
+                    [('bucket_offsets', self.bucket_offsets),
+                     ('residuals', self.residuals),
+                     ('palette', self.palette),
+                     ('taxid_codes', self.taxid_codes)])
+
+
+class LCA_IndexWriter(object):
+    """
+    Write an LCA index incrementally, without holding it in memory.
+    Hash values must be added in increasing order.
+
+    Columns are streamed to temporary files next to 'filename' and
+    assembled into the final index by 'close()'.
+    """
+    BLOCK_SIZE = 2**20                    # values packed at a time
+
+    def __init__(self, filename, packed=False):
+        self.filename = filename
+        self.packed = packed
+        self.hashvals_fp = open(filename + '.hashvals.tmp', 'wb')
+        self.taxids_fp = open(filename + '.taxids.tmp', 'wb')
+        self.last_hashval = None
+        self.n = 0
+
+    def add_many(self, hashvals, taxids):
+        hashvals = numpy.asarray(hashvals, dtype=numpy.uint64)
+        taxids = numpy.asarray(taxids, dtype=numpy.uint32)
+        if not len(hashvals):
+            return
+
+        if self.last_hashval is not None:
+            assert hashvals[0] > self.last_hashval
+        self.last_hashval = hashvals[-1]
+
+        hashvals.tofile(self.hashvals_fp)
+        taxids.tofile(self.taxids_fp)
+        self.n += len(hashvals)
+
+    def close(self):
+        self.hashvals_fp.close()
+        self.taxids_fp.close()
+
+        hashvals = _memmap_or_empty(self.hashvals_fp.name, numpy.uint64)
+        taxids = _memmap_or_empty(self.taxids_fp.name, numpy.uint32)
+        if self.packed:
+            self._save_packed(hashvals, taxids)
+        else:
+            LCA_Index(hashvals, taxids).save(self.filename)
+        del hashvals, taxids
+
+        os.unlink(self.hashvals_fp.name)
+        os.unlink(self.taxids_fp.name)
+
+    def _save_packed(self, hashvals, taxids):
+        """
+        Save as a PackedLCA_Index, packing BLOCK_SIZE values at a time into
+        memory-mapped temporary files, so that only the palette is held in
+        memory.  BLOCK_SIZE is a multiple of 64, so every block but the last
+        fills whole words, and the blocks' words can just be concatenated.
+        """
+        n = len(hashvals)
+        if not n:
+            PackedLCA_Index.from_arrays(hashvals, taxids).save(self.filename)
+            return
+
+        block_size = self.BLOCK_SIZE
+        assert block_size % 64 == 0
+        blocks = [ (start, min(start + block_size, n))
+                   for start in range(0, n, block_size) ]
+
+        # first pass: the palette of distinct taxids.
+        palette = numpy.zeros(0, dtype=numpy.uint32)
+        for start, end in blocks:
+            palette = numpy.union1d(palette, taxids[start:end])
+        palette = palette.astype(numpy.uint32)
+        taxid_bits = _bit_width(len(palette) - 1)
+
+        max_hashval = int(hashvals[-1])
+        n_buckets_bits = _bit_width(max(n // PackedLCA_Index.BUCKET_SIZE, 1))
+        residual_bits = max(_bit_width(max_hashval) - n_buckets_bits, 0)
+        n_buckets = (max_hashval >> residual_bits) + 1
+        offset_dtype = numpy.uint32 if n < 2**32 else numpy.uint64
+        mask = numpy.uint64((1 << residual_bits) - 1)
+
+        def column(suffix, dtype, length):
+            return numpy.memmap(self.filename + suffix, dtype=dtype,
+                                mode='w+', shape=(length,))
+
+        bucket_offsets = column('.bucket_offsets.tmp', offset_dtype,
+                                n_buckets + 1)
+        residuals = column('.residuals.tmp', numpy.uint64,
+                           (n * residual_bits + 63) // 64 + 1)
+        taxid_codes = column('.taxid_codes.tmp', numpy.uint64,
+                             (n * taxid_bits + 63) // 64 + 1)
+
+        # second pass: bucket offsets, residuals and taxid codes.
+        next_bucket = 0
+        for start, end in blocks:
+            block = numpy.asarray(hashvals[start:end])
+            buckets = block >> numpy.uint64(residual_bits)
+            last_bucket = int(buckets[-1])
+            targets = numpy.arange(next_bucket, last_bucket + 1,
+                                   dtype=numpy.uint64)
+            bucket_offsets[next_bucket:last_bucket + 1] = \
+              start + numpy.searchsorted(buckets, targets)
+            next_bucket = last_bucket + 1
+
+            codes = numpy.searchsorted(palette, taxids[start:end])
+            for words, values, width in ((residuals, block & mask,
+                                          residual_bits),
+                                         (taxid_codes, codes, taxid_bits)):
+                packed = pack_bits(values, width)
+                first_word = start * width // 64
+                if end < n:               # drop the padding word.
+                    packed = packed[:-1]
+                words[first_word:first_word + len(packed)] = packed
+        bucket_offsets[next_bucket:] = n
+
+        for words in (bucket_offsets, residuals, taxid_codes):
+            words.flush()
+
+        PackedLCA_Index(n, residual_bits, bucket_offsets, residuals, palette,
+                        taxid_codes).save(self.filename)
+        for words in (bucket_offsets, residuals, taxid_codes):
+            os.unlink(words.filename)
+
+
+def save_lca_index(filename, hashval_to_lca, packed=False):
+    """
+    Save a hashval -> taxid dictionary as an mmap-able LCA index; with
+    'packed', save it as a PackedLCA_Index.
+    """
+    if packed:
+        PackedLCA_Index.from_dict(hashval_to_lca).save(filename)
+    else:
+        LCA_Index.from_dict(hashval_to_lca).save(filename)
+
+
+def load_lca_index(filename):
+    "Open an LCA index written by 'save_lca_index' via mmap."
+    header, arrays = load_arrays(filename)
+    assert header['type'] == 'sourmash_lca_index'
+    assert header['version'] == 1
+
+    if header['format'] == 'packed':
+        return PackedLCA_Index(header['n'], header['residual_bits'],
+                               arrays['bucket_offsets'], arrays['residuals'],
+                               arrays['palette'], arrays['taxid_codes'])
+
+    return LCA_Index(arrays['hashvals'], arrays['taxids'])
+
+
+def is_lca_index(filename):
+    "Check the magic bytes to see if 'filename' is an array file."
+    if filename.endswith('.gz'):
+        return False
+    with open(filename, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+### fixed-width bit packing
+
+
+def _bit_width(n):
+    "Number of bits needed to store 0..n."
+    return max(int(n), 0).bit_length()
+
+
+def pack_bits(values, width):
+    """
+    Pack unsigned integers of at most 'width' bits each into an array of
+    uint64 words, with one extra word of padding for 'unpack_bits'.
+    """
+    values = numpy.asarray(values, dtype=numpy.uint64)
+    n_words = (len(values) * width + 63) // 64 + 1
+    words = numpy.zeros(n_words, dtype=numpy.uint64)
+    if not width:
+        return words
+
+    bitpos = numpy.arange(len(values), dtype=numpy.uint64) * numpy.uint64(width)
+    word = (bitpos >> numpy.uint64(6)).astype(numpy.int64)
+    shift = bitpos & numpy.uint64(63)
+
+    # fields never overlap, so OR-ing them in is the same as adding them.
+    numpy.bitwise_or.at(words, word, values << shift)
+
+    spill = shift + numpy.uint64(width) > numpy.uint64(64)
+    numpy.bitwise_or.at(words, word[spill] + 1,
+                        values[spill] >> (numpy.uint64(64) - shift[spill]))
+    return words
+
+
+def unpack_bits(words, positions, width):
+    "Get the 'width'-bit values at 'positions' from 'pack_bits' output."
+    positions = numpy.asarray(positions, dtype=numpy.uint64)
+    if not width:
+        return numpy.zeros(len(positions), dtype=numpy.uint64)
+
+    bitpos = positions * numpy.uint64(width)
+    word = (bitpos >> numpy.uint64(6)).astype(numpy.int64)
+    shift = bitpos & numpy.uint64(63)
+
+    # shift the next word left by (64 - shift), in two steps so that a
+    # shift of 0 doesn't turn into a (undefined) shift by 64.
+    values = (words[word] >> shift) | \
+             ((words[word + 1] << numpy.uint64(1)) << (numpy.uint64(63) - shift))
+    return values & numpy.uint64((1 << width) - 1)
+
+
+### external sort of (hashval, taxid) records
+
+
+RECORD_DTYPE = numpy.dtype([('hashval', '<u8'), ('taxid', '<u4')])
+
+
+def write_sorted_run(filename, hashvals, taxids):
+    """
+    Sort (hashval, taxid) pairs, remove duplicates, and write them to
+    'filename' as a run of records for 'merge_sorted_runs'.
+    """
+    records = numpy.empty(len(hashvals), dtype=RECORD_DTYPE)
+    records['hashval'] = hashvals
+    records['taxid'] = taxids
+    records = numpy.unique(records)       # sorts by hashval, then taxid
+    records.tofile(filename)
+    return len(records)
+
+
+def merge_sorted_runs(filenames, block_size=1000000):
+    """
+    k-way merge of the runs written by 'write_sorted_run'.  Yields sorted
+    chunks of records; all records for a given hashval are in the same
+    chunk.  At most about 'block_size' records per run are held in memory.
+    """
+    runs = [ _memmap_or_empty(filename, RECORD_DTYPE) for filename in filenames ]
+    pos = [ 0 ] * len(runs)
+    pending = [ numpy.empty(0, dtype=RECORD_DTYPE) for run in runs ]
+
+    def read_block(i):
+        block = numpy.array(runs[i][pos[i]:pos[i] + block_size])
+        pos[i] += len(block)
+        pending[i] = numpy.concatenate((pending[i], block))
+
+    for i in range(len(runs)):
+        read_block(i)
+
+    while 1:
+        active = [ i for i in range(len(runs)) if pos[i] < len(runs[i]) ]
+        if not active:                    # everything is in memory; done.
+            chunk = numpy.concatenate(pending)
+            if len(chunk):
+                yield numpy.sort(chunk, order=['hashval', 'taxid'])
+            return
+
+        # anything below the smallest last-read hashval of the runs with
+        # more to read is complete, and can be merged & emitted.
+        boundary = min([ pending[i]['hashval'][-1] for i in active
+                         if len(pending[i]) ])
+
+        chunk = []
+        for i in range(len(runs)):
+            n = numpy.searchsorted(pending[i]['hashval'], boundary)
+            chunk.append(pending[i][:n])
+            pending[i] = pending[i][n:]
+
+        chunk = numpy.concatenate(chunk)
+        if len(chunk):
+            yield numpy.sort(chunk, order=['hashval', 'taxid'])
+
+        # refill runs that are running low; this also makes sure that
+        # the run(s) holding only 'boundary' records can make progress.
+        for i in active:
+            if len(pending[i]) <= block_size // 2 or \
+               pending[i]['hashval'][0] == boundary:
+                read_block(i)
+
+
+def find_runs(hashvals):
+    "Return (starts, ends) of each run of equal values in sorted 'hashvals'."
+    hashvals = numpy.asarray(hashvals)
+    starts = numpy.flatnonzero(numpy.r_[True, hashvals[1:] != hashvals[:-1]])
+    ends = numpy.append(starts[1:], len(hashvals))
+    return starts, ends
+
+
+### hashval -> set of taxids, stored as sorted (hashval, taxid) records
+
+
+def records_from_dict(hashval_to_taxids):
+    "Convert a hashval -> set of taxids dictionary into sorted records."
+    sizes = numpy.fromiter(map(len, hashval_to_taxids.values()),
+                           dtype=numpy.int64, count=len(hashval_to_taxids))
+    records = numpy.empty(int(sizes.sum()), dtype=RECORD_DTYPE)
+    records['hashval'] = numpy.repeat(
+        numpy.fromiter(hashval_to_taxids.keys(), dtype=numpy.uint64,
+                       count=len(hashval_to_taxids)), sizes)
+    records['taxid'] = numpy.fromiter(
+        (taxid for taxids in hashval_to_taxids.values() for taxid in taxids),
+        dtype=numpy.uint32, count=len(records))
+    return numpy.unique(records)
+
+
+def save_hashval_taxids(filename, records, ksize, scaled):
+    """
+    Save sorted, distinct (hashval, taxid) records: the full hashval ->
+    taxids assignment that an LCA database was reduced from.
+    """
+    header = dict(type='sourmash_lca_taxids', version=1, ksize=ksize,
+                  scaled=scaled)
+    save_arrays(filename, header, [('hashvals', records['hashval']),
+                                   ('taxids', records['taxid'])])
+
+
+def load_hashval_taxids(filename):
+    """
+    Load the records saved by 'save_hashval_taxids' into memory; returns
+    (header, records).
+    """
+    header, arrays = load_arrays(filename)
+    assert header['type'] == 'sourmash_lca_taxids'
+    assert header['version'] == 1
+
+    records = numpy.empty(len(arrays['hashvals']), dtype=RECORD_DTYPE)
+    records['hashval'] = arrays['hashvals']
+    records['taxid'] = arrays['taxids']
+    return header, records
+
+
+def _memmap_or_empty(filename, dtype):
+    if not os.path.getsize(filename):
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r')
+
+
+### generic array container
+
+
+def save_arrays(filename, header, arrays):
+    """
+    Write a JSON header plus a list of (name, numpy array) columns to
+    'filename', with each column 8-byte aligned so that it can be mmapped.
+    """
+    header = dict(header)
+    columns = []
+    offset = 0
+    for name, arr in arrays:
+        arr = numpy.ascontiguousarray(arr)
+        columns.append(dict(name=name, dtype=arr.dtype.str,
+                            shape=list(arr.shape), offset=offset))
+        offset += _padded(arr.nbytes)
+    header['columns'] = columns
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (_padded(len(header_bytes)) - len(header_bytes))
+
+    with open(filename, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack('<Q', len(header_bytes)))
+        fp.write(header_bytes)
+        for name, arr in arrays:
+            arr = numpy.ascontiguousarray(arr)
+            arr.tofile(fp)
+            fp.write(b'\0' * (_padded(arr.nbytes) - arr.nbytes))
+
+
+def load_arrays(filename):
+    """
+    Load a file written by 'save_arrays'; returns (header, arrays) where
+    'arrays' is a dictionary of read-only memory-mapped numpy arrays.
+    """
+    with open(filename, 'rb') as fp:
+        magic = fp.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError('{} is not an LCA array file'.format(filename))
+        header_len, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_len).decode('utf-8'))
+
+    data_start = len(MAGIC) + 8 + header_len
+
+    arrays = {}
+    for column in header['columns']:
+        dtype = numpy.dtype(column['dtype'])
+        shape = tuple(column['shape'])
+        if not numpy.prod(shape, dtype=numpy.int64):
+            arrays[column['name']] = numpy.zeros(shape, dtype=dtype)
+            continue
+
+        arrays[column['name']] = numpy.memmap(filename, dtype=dtype,
+                                              mode='r', shape=shape,
+                                              offset=data_start + column['offset'])
+
+    return header, arrays
+
+
+def _padded(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def test_lca_index_get():
+    idx = LCA_Index.from_dict({ 5: 2, 1: 3, 2**64 - 1: 4 })
+    assert idx.get(1) == 3
+    assert idx.get(5) == 2
+    assert idx.get(2**64 - 1) == 4
+    assert idx.get(3) is None
+    assert 5 in idx
+    assert 6 not in idx
+    assert list(idx.items()) == [(1, 3), (5, 2), (2**64 - 1, 4)]
+
+
+def test_lca_index_get_lcas():
+    idx = LCA_Index.from_dict({ 5: 2, 1: 3, 2**64 - 1: 4 })
+    lcas = idx.get_lcas([2**64 - 1, 6, 1, 0, 5, 1])
+    assert list(lcas) == [4, 0, 3, 0, 2, 3]
+
+    empty = LCA_Index.from_dict({})
+    assert list(empty.get_lcas([1, 2])) == [0, 0]
+
+
+def test_lca_index_save_load(tmpdir):
+    filename = str(tmpdir.join('test.lca'))
+    save_lca_index(filename, { 5: 2, 1: 3 })
+
+    assert is_lca_index(filename)
+    idx = load_lca_index(filename)
+    assert len(idx) == 2
+    assert dict(idx.items()) == { 5: 2, 1: 3 }
+
+
+def test_pack_bits():
+    for width in (0, 1, 7, 33, 64):
+        values = [ (i * 0x9e3779b97f4a7c15) % (2**width) for i in range(100) ]
+        words = pack_bits(values, width)
+        assert unpack_bits(words, range(100), width).tolist() == values
+        assert unpack_bits(words, [99, 0], width).tolist() == [values[99],
+                                                               values[0]]
+
+
+def test_packed_lca_index(tmpdir):
+    d = { 5: 2, 1: 3, 2**64 - 1: 4, 2**40: 3 }
+    for i in range(1000):
+        d[(i * 0x9e3779b97f4a7c15) % 2**50] = i % 7 + 10
+
+    idx = PackedLCA_Index.from_dict(d)
+    assert len(idx) == len(d)
+    assert dict(idx.items()) == d
+    assert idx.get(2**40) == 3
+    assert idx.get(6) is None
+    assert 2**64 - 1 in idx
+
+    queries = list(d) + [0, 6, 2**64 - 2, 2**50 + 1]
+    lcas = idx.get_lcas(queries)
+    assert list(lcas) == [ d.get(q, 0) for q in queries ]
+
+    filename = str(tmpdir.join('test.lca'))
+    save_lca_index(filename, d, packed=True)
+    idx = load_lca_index(filename)
+    assert isinstance(idx, PackedLCA_Index)
+    assert list(idx.get_lcas(queries)) == list(lcas)
+
+    empty = PackedLCA_Index.from_dict({})
+    assert list(empty.get_lcas([1, 2])) == [0, 0]
+    assert list(empty.items()) == []
+
+
+def test_lca_index_downsample():
+    max_hash = max_hash_for_scaled(1000)
+    d = { 1: 2, max_hash - 1: 3, max_hash: 4, max_hash + 1: 5, 2**64 - 1: 6 }
+    for i in range(1000):
+        d[(i * 0x9e3779b97f4a7c15) % 2**64] = 7
+
+    want = dict([ (k, v) for (k, v) in d.items() if k <= max_hash ])
+    for idx in (LCA_Index.from_dict(d), PackedLCA_Index.from_dict(d)):
+        small = idx.downsample(1000)
+        assert dict(small.items()) == want
+        assert len(small) == len(want)
+        assert list(small.get_lcas(list(d))) == [ want.get(k, 0) for k in d ]
+        assert small.get(max_hash + 1) is None
+
+        assert idx.downsample(1) is idx
+
+
+def test_merge_sorted_runs(tmpdir):
+    run1 = str(tmpdir.join('run1'))
+    run2 = str(tmpdir.join('run2'))
+    write_sorted_run(run1, [5, 1, 3, 5, 1], [10, 10, 11, 12, 10])
+    write_sorted_run(run2, [3, 2, 6], [12, 13, 14])
+
+    chunks = list(merge_sorted_runs([run1, run2], block_size=1))
+    records = numpy.concatenate(chunks)
+    assert records.tolist() == [(1, 10), (2, 13), (3, 11), (3, 12),
+                                (5, 10), (5, 12), (6, 14)]
+
+    # all records for a hashval should be in the same chunk.
+    seen = set()
+    for chunk in chunks:
+        chunk_hashvals = set(chunk['hashval'].tolist())
+        assert not seen.intersection(chunk_hashvals)
+        seen.update(chunk_hashvals)
+
+
+def test_hashval_taxids_save_load(tmpdir):
+    filename = str(tmpdir.join('test.hashvals'))
+    records = records_from_dict({ 5: set([2, 1]), 1: set([3]), 7: set() })
+    assert records.tolist() == [(1, 3), (5, 1), (5, 2)]
+
+    save_hashval_taxids(filename, records, 31, 10000)
+    header, records = load_hashval_taxids(filename)
+    assert header['ksize'] == 31
+    assert records.tolist() == [(1, 3), (5, 1), (5, 2)]
+
+    starts, ends = find_runs(records['hashval'])
+    assert starts.tolist() == [0, 1]
+    assert ends.tolist() == [1, 3]
+
+
+def test_lca_index_writer(tmpdir):
+    filename = str(tmpdir.join('test.lca'))
+    w = LCA_IndexWriter(filename)
+    w.add_many([1, 5], [3, 2])
+    w.add_many([], [])
+    w.add_many([7], [9])
+    w.close()
+
+    idx = load_lca_index(filename)
+    assert dict(idx.items()) == { 1: 3, 5: 2, 7: 9 }
+
+
+def test_lca_index_writer_packed(tmpdir):
+    # pack in several small blocks, and check it's the same as all at once.
+    rng = numpy.random.RandomState(1)
+    hashvals = numpy.unique(rng.randint(0, 2**62, 1000, dtype=numpy.int64))
+    hashvals = hashvals.astype(numpy.uint64)
+    taxids = rng.randint(1, 50, len(hashvals)).astype(numpy.uint32)
+
+    filename = str(tmpdir.join('test.lca'))
+    w = LCA_IndexWriter(filename, packed=True)
+    w.BLOCK_SIZE = 128
+    w.add_many(hashvals[:300], taxids[:300])
+    w.add_many(hashvals[300:], taxids[300:])
+    w.close()
+
+    expected = str(tmpdir.join('expected.lca'))
+    PackedLCA_Index.from_arrays(hashvals, taxids).save(expected)
+    with open(filename, 'rb') as fp, open(expected, 'rb') as fp2:
+        assert fp.read() == fp2.read()
+    assert sorted(os.listdir(str(tmpdir))) == ['expected.lca', 'test.lca']
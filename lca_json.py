@@ -3,11 +3,19 @@ import gzip
 import os
 from pickle import load
 
-from ncbi_taxdump_utils import NCBI_TaxonomyFoo
+from ncbi_taxdump_utils import load_taxonomy
+import lca_index
 
 
 class LCA_Database(object):
+    """
+    An lca.json file, listing LCA databases by ksize and scaled.  Use
+    'get_handle' to get a lazily loaded LCA_DatabaseHandle for one of them;
+    handles share their taxonomy.
+    """
     def __init__(self, filename=None):
+        self.taxonomies = {}
+        self.handles = {}
         if filename:
             self.load(filename)
         else:
@@ -23,6 +31,8 @@ class LCA_Database(object):
         info['basepath'] = os.path.dirname(filename)
 
         self.lca = info
+        self.taxonomies = {}
+        self.handles = {}
 
     def save(self, filename):
         if 'basepath' in self.lca:
@@ -39,54 +49,123 @@ class LCA_Database(object):
         db_info['nodes'] = nodes_path
         db_info['names'] = names_path
 
+        # replace any existing database at this ksize and scaled.
+        self.lca['dblist'] = [ db for db in self.lca['dblist']
+                               if (db['ksize'], db['scaled']) != \
+                                  (db_info['ksize'], db_info['scaled']) ]
         self.lca['dblist'].append(db_info)
+        self.handles = {}
+
+    def get_handle(self, ksize, scaled=None):
+        """
+        Get the LCA_DatabaseHandle for the database at 'ksize' that can
+        answer queries at 'scaled': the coarsest one with a scaled of at
+        most 'scaled', or the finest one if 'scaled' is None.  Nothing is
+        loaded until the handle is used.
+        """
+        assert self.lca['version'] == 1
+
+        matching = [ db for db in self.lca['dblist'] if db['ksize'] == ksize ]
+        if scaled is not None:
+            matching = [ db for db in matching if db['scaled'] <= scaled ]
+        if not matching:
+            raise ValueError('no LCA database for ksize={} at scaled={} or finer'.format(ksize, scaled))
+
+        if scaled is None:
+            entry = min(matching, key=lambda db: db['scaled'])
+        else:
+            entry = max(matching, key=lambda db: db['scaled'])
 
-    def get_database(self, ksize, scaled):
-        lca_info = self.lca
-
-        assert lca_info['version'] == 1
-        basepath = lca_info['basepath']
-
-        matching_ksizes = []
-        for db in lca_info['dblist']:
-            if db['ksize'] == ksize:
-                matching_ksizes.append(db)
-
-        # ignore scaled matching for now, take first one
-        assert len(matching_ksizes) == 1
-        entry = matching_ksizes[0]
-
-        taxfoo = self.get_taxonomy(entry)
-        
-        lca_file = os.path.join(basepath, entry['lca_db'])
-        print('loading k-mer DB from:', lca_file)
-        with xopen(lca_file, 'rb') as hashval_fp:
-            hashval_to_lca = load(hashval_fp)
+        key = (entry['ksize'], entry['scaled'])
+        if key not in self.handles:
+            self.handles[key] = LCA_DatabaseHandle(self, entry)
+        return self.handles[key]
 
-        return taxfoo, hashval_to_lca, entry['scaled']
+    def get_database(self, ksize, scaled):
+        """
+        Load and return (taxfoo, hashval_to_lca, scaled) for 'ksize'; if
+        'scaled' is given, the database is downsampled to it.
+        """
+        db = self.get_handle(ksize, scaled)
+        if scaled is None:
+            scaled = db.scaled
+        return db.taxfoo, db.get_index(scaled), scaled
 
     def get_taxonomy(self, entry=None):
         if entry == None:
             entry = self.lca['dblist'][0]
 
         basepath = self.lca['basepath']
-        taxfoo = NCBI_TaxonomyFoo()
 
-        # load the nodes_dmp file to get the tax tree
+        # load the nodes_dmp & names_dmp files to get the tax tree
         nodes_file = os.path.join(basepath, entry['nodes'])
-        print('loading taxonomic nodes from:', nodes_file)
-        taxfoo.load_nodes_dmp(nodes_file)
-
         names_file = os.path.join(basepath, entry['names'])
-        print('loading taxonomic names from:', names_file)
-        taxfoo.load_names_dmp(names_file)
 
-        return taxfoo
+        key = (nodes_file, names_file)
+        if key not in self.taxonomies:
+            print('loading taxonomy from:', nodes_file, names_file)
+            self.taxonomies[key] = load_taxonomy(nodes_file, names_file)
+
+        return self.taxonomies[key]
+
+
+class LCA_DatabaseHandle(object):
+    """
+    One (ksize, scaled) database from an lca.json file.  The taxonomy and
+    the hashval -> LCA index are loaded when first used; 'close' releases
+    the index again.
+    """
+    def __init__(self, lca_db, entry):
+        self.lca_db = lca_db
+        self.entry = entry
+        self.ksize = entry['ksize']
+        self.scaled = entry['scaled']
+        self.filename = os.path.join(lca_db.lca['basepath'], entry['lca_db'])
+        self._hashval_to_lca = None
+
+    @property
+    def taxfoo(self):
+        return self.lca_db.get_taxonomy(self.entry)
+
+    @property
+    def hashval_to_lca(self):
+        if self._hashval_to_lca is None:
+            print('loading k-mer DB from:', self.filename)
+            self._hashval_to_lca = load_lca_file(self.filename)
+        return self._hashval_to_lca
+
+    def get_index(self, scaled=None):
+        """
+        Get the hashval -> LCA index restricted to the hash values kept at
+        'scaled', which must be at least this database's scaled.
+        """
+        if scaled is None or scaled == self.scaled:
+            return self.hashval_to_lca
+        if scaled < self.scaled:
+            raise ValueError('cannot query a scaled={} database at scaled={}'.format(self.scaled, scaled))
+        return self.hashval_to_lca.downsample(scaled)
+
+    def get_lcas(self, hashvals):
+        return self.hashval_to_lca.get_lcas(hashvals)
+
+    def close(self):
+        self._hashval_to_lca = None
 
 
 ### utility functions
 
 
+def load_lca_file(lca_file):
+    "Load a hashval -> LCA database, either an index or a pickled dict."
+    if lca_index.is_lca_index(lca_file):
+        return lca_index.load_lca_index(lca_file)
+
+    # old-style pickled dictionary
+    with xopen(lca_file, 'rb') as hashval_fp:
+        hashval_to_lca = load(hashval_fp)
+    return lca_index.LCA_Index.from_dict(hashval_to_lca)
+
+
 def xopen(filename, mode):
     if filename.endswith('.gz'):
         return gzip.open(filename, mode)
@@ -0,0 +1,187 @@
+"""
+Binary (version 3.0) sourmash_lca databases, as written by free-tax-1.py.
+
+The file is an lca_index array file: the JSON header holds ksize, scaled,
+license, the lineage table and signatures_to_lineage, and the hashval ->
+lineage ids assignments are stored CSR-style in three columns --
+
+* 'hashvals', sorted uint64;
+* 'offsets', int64, one longer than 'hashvals';
+* 'lineage_ids', uint32; the ids for hashvals[i] are
+  lineage_ids[offsets[i]:offsets[i + 1]].
+
+Databases built with 'free-tax-1.py --precompute-lca' store one lineage id
+for hashvals whose lineages lie on one path.  With
+'--precompute-lca-branches', disagreeing lineages are replaced by their
+LCA too, and the lineages that stand for such LCAs are listed under
+'lca_lineages' in the header.
+
+Everything but the header is mmapped on load, with no parsing step.
+"""
+from collections import OrderedDict
+
+import numpy
+
+import lca_index
+
+VERSION = '3.0'
+
+
+def hashval_assignments_to_arrays(hashval_to_lineage):
+    """
+    Convert a dictionary of hashval -> list of lineage ids into the sorted
+    (hashvals, offsets, lineage_ids) arrays.
+    """
+    hashvals = numpy.array(sorted(hashval_to_lineage), dtype=numpy.uint64)
+
+    offsets = numpy.zeros(len(hashvals) + 1, dtype=numpy.int64)
+    lineage_ids = []
+    for i, hashval in enumerate(hashvals.tolist()):
+        lineage_ids.extend(hashval_to_lineage[hashval])
+        offsets[i + 1] = len(lineage_ids)
+
+    return hashvals, offsets, numpy.array(lineage_ids, dtype=numpy.uint32)
+
+
+def save_lineage_db(filename, ksize, scaled, lineage_dict, hashvals, offsets,
+                    lineage_ids, signatures_to_lineage, license='CC0',
+                    lca_lineages=None, sources=None):
+    """
+    Save a v3 database; 'lineage_dict' maps lineage ids to dictionaries of
+    rank -> name.  'sources', if given, is stored in the header as is, to
+    record the files the database was built from.
+    """
+    header = OrderedDict()
+    header['version'] = VERSION
+    header['type'] = 'sourmash_lca'
+    header['license'] = license
+    header['ksize'] = ksize
+    header['scaled'] = scaled
+    header['lineages'] = OrderedDict([ (str(k), OrderedDict(v)) \
+                                       for k, v in lineage_dict.items() ])
+    header['signatures_to_lineage'] = signatures_to_lineage
+    if lca_lineages:
+        header['lca_lineages'] = sorted(lca_lineages)
+    if sources:
+        header['sources'] = sources
+
+    lca_index.save_arrays(filename, header,
+                          [('hashvals', numpy.asarray(hashvals, dtype=numpy.uint64)),
+                           ('offsets', numpy.asarray(offsets, dtype=numpy.int64)),
+                           ('lineage_ids', numpy.asarray(lineage_ids, dtype=numpy.uint32))])
+
+
+def load_lineage_db(filename):
+    """
+    Load a v3 database; returns (header, hashvals, offsets, lineage_ids),
+    where the arrays are memory-mapped.
+    """
+    header, arrays = lca_index.load_arrays(filename)
+    assert header['version'] == VERSION
+    assert header['type'] == 'sourmash_lca'
+
+    return header, arrays['hashvals'], arrays['offsets'], arrays['lineage_ids']
+
+
+def merge_lineage_dbs(dbs):
+    """
+    Merge several databases into one with a single lineage table.  Each of
+    'dbs', and the result, is a (lineage_dict, hashvals, offsets,
+    lineage_ids, signatures_to_lineage, lca_lineages) tuple, where
+    'lineage_dict' maps integer lineage ids to lists of (rank, name).
+
+    Lineages that are the same once empty names are left out get one id,
+    unless only one of them is an LCA lineage.  Each hashval keeps the
+    lineage ids from every database, in database order, so that the merged
+    database classifies just as the list of databases would.
+    """
+    lineage_dict = {}
+    lineage_index = {}                    # (path, is LCA) -> lineage id
+    signatures_to_lineage = {}
+    lca_lineages = set()
+    all_hashvals = []
+    all_lineage_ids = []
+    for db_lineages, hashvals, offsets, lineage_ids, db_sigs, db_lca in dbs:
+        db_lca = set(db_lca or ())
+        remap = numpy.zeros(max(db_lineages, default=-1) + 1,
+                            dtype=numpy.uint32)
+        for k, lineage in db_lineages.items():
+            is_lca = k in db_lca
+            key = (tuple([ (rank, name) for rank, name in lineage if name ]),
+                   is_lca)
+            lineage_id = lineage_index.get(key)
+            if lineage_id is None:
+                lineage_id = len(lineage_index)
+                lineage_index[key] = lineage_id
+                lineage_dict[lineage_id] = lineage
+                if is_lca:
+                    lca_lineages.add(lineage_id)
+            remap[k] = lineage_id
+
+        for md5, k in db_sigs.items():
+            signatures_to_lineage.setdefault(md5, int(remap[k]))
+
+        all_hashvals.append(numpy.repeat(numpy.asarray(hashvals, dtype=numpy.uint64),
+                                         numpy.diff(offsets)))
+        all_lineage_ids.append(remap[lineage_ids])
+
+    # a stable sort keeps each hashval's ids in database order.
+    hashvals = numpy.concatenate(all_hashvals)
+    order = numpy.argsort(hashvals, kind='stable')
+    hashvals = hashvals[order]
+    lineage_ids = numpy.concatenate(all_lineage_ids)[order]
+
+    hashvals, starts = numpy.unique(hashvals, return_index=True)
+    offsets = numpy.append(starts, len(lineage_ids)).astype(numpy.int64)
+
+    return (lineage_dict, hashvals, offsets, lineage_ids,
+            signatures_to_lineage, lca_lineages)
+
+
+def test_save_load_lineage_db(tmpdir):
+    filename = str(tmpdir.join('test.lca'))
+    arrays = hashval_assignments_to_arrays({ 5: [0], 2: [1, 0], 9: [1] })
+    assert arrays[0].tolist() == [2, 5, 9]
+    assert arrays[1].tolist() == [0, 2, 3, 4]
+    assert arrays[2].tolist() == [1, 0, 0, 1]
+
+    lineage_dict = { 0: [('superkingdom', 'a')],
+                     1: [('superkingdom', 'a'), ('phylum', 'b')] }
+    save_lineage_db(filename, 31, 10000, lineage_dict, *arrays,
+                    signatures_to_lineage={ 'md5': 1 })
+
+    header, hashvals, offsets, lineage_ids = load_lineage_db(filename)
+    assert header['ksize'] == 31
+    assert header['scaled'] == 10000
+    assert header['lineages'] == { '0': { 'superkingdom': 'a' },
+                                   '1': { 'superkingdom': 'a',
+                                          'phylum': 'b' } }
+    assert header['signatures_to_lineage'] == { 'md5': 1 }
+    assert hashvals.tolist() == [2, 5, 9]
+    assert offsets.tolist() == [0, 2, 3, 4]
+    assert lineage_ids.tolist() == [1, 0, 0, 1]
+
+
+def test_merge_lineage_dbs():
+    db1 = ({ 0: [('superkingdom', 'a'), ('phylum', '')],
+             1: [('superkingdom', 'a'), ('phylum', 'b')] },
+           *hashval_assignments_to_arrays({ 2: [1, 0], 5: [0] }),
+           { 'md5a': 0 }, set())
+    db2 = ({ 0: [('superkingdom', 'a'), ('phylum', 'b')],
+             1: [('superkingdom', 'a')],
+             2: [('superkingdom', 'c')] },
+           *hashval_assignments_to_arrays({ 5: [2, 0], 9: [1] }),
+           { 'md5a': 2, 'md5c': 2 }, { 1 })
+
+    lineage_dict, hashvals, offsets, lineage_ids, sigs, lca_lineages = \
+      merge_lineage_dbs([db1, db2])
+
+    assert lineage_dict == { 0: [('superkingdom', 'a'), ('phylum', '')],
+                             1: [('superkingdom', 'a'), ('phylum', 'b')],
+                             2: [('superkingdom', 'a')],
+                             3: [('superkingdom', 'c')] }
+    assert lca_lineages == { 2 }
+    assert sigs == { 'md5a': 0, 'md5c': 3 }
+    assert hashvals.tolist() == [2, 5, 9]
+    assert offsets.tolist() == [0, 2, 5, 6]
+    assert lineage_ids.tolist() == [1, 0, 0, 3, 1, 2]
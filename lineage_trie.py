@@ -0,0 +1,260 @@
+"""
+Lineages interned as nodes of an integer trie, for free-tax-2.py.
+
+A lineage is a list of (rank, name) tuples, kingdom on down; empty names
+are skipped, so a lineage is identified by the path of its non-empty
+(rank, name) tuples from the root.  Each distinct path prefix is a node,
+numbered from 0 (the root, labeled ('root', 'root')), with its parent and
+depth kept in plain lists so that LCAs are walks over small ints.
+
+Each distinct (rank, name) also gets an integer label.  Usually a label
+belongs to exactly one node, but the same (rank, name) can turn up under
+different parents, e.g. when a spreadsheet leaves out an intermediate
+rank for some rows; 'n_ambiguous' counts such labels.
+"""
+import itertools
+
+ROOT = 0
+ROOT_LABEL = ('root', 'root')
+
+
+class LineageTrie(object):
+    def __init__(self):
+        self.parent = [ROOT]
+        self.depth = [0]
+        self.label = [0]                  # node -> label id
+        self.children = {}                # (node, label id) -> child node
+
+        self.labels = [ROOT_LABEL]        # label id -> (rank, name)
+        self.label_ids = { ROOT_LABEL: 0 }
+        self.label_node = [ROOT]          # label id -> node, -1 if many
+        self.n_ambiguous = 0
+
+    def __len__(self):
+        return len(self.parent)
+
+    def get_label_id(self, rank_name):
+        label_id = self.label_ids.get(rank_name)
+        if label_id is None:
+            label_id = len(self.labels)
+            self.labels.append(rank_name)
+            self.label_ids[rank_name] = label_id
+            self.label_node.append(None)
+        return label_id
+
+    def add(self, lineage):
+        "Intern 'lineage'; return the node for it (ROOT if all empty)."
+        node = ROOT
+        for rank, name in lineage:
+            if not name:
+                continue
+
+            label_id = self.get_label_id((rank, name))
+            child = self.children.get((node, label_id))
+            if child is None:
+                child = len(self.parent)
+                self.parent.append(node)
+                self.depth.append(self.depth[node] + 1)
+                self.label.append(label_id)
+                self.children[(node, label_id)] = child
+
+                if self.label_node[label_id] is None:
+                    self.label_node[label_id] = child
+                elif self.label_node[label_id] != -1:
+                    self.label_node[label_id] = -1
+                    self.n_ambiguous += 1
+            node = child
+
+        return node
+
+    def get_lineage(self, node):
+        "Return the lineage for 'node' as a list of (rank, name) tuples."
+        lineage = []
+        while node != ROOT:
+            lineage.append(self.labels[self.label[node]])
+            node = self.parent[node]
+        lineage.reverse()
+        return lineage
+
+    def find_lca(self, nodes, branched=None):
+        """
+        Find the node at which the paths from the root to 'nodes' first
+        branch, or the deepest of 'nodes' if they all lie on one path --
+        so that, as with free-tax-2's 'find_lca' on a tree of lineages, a
+        lineage that is a prefix of another one does not count against it.
+
+        'branched', if given, flags which of 'nodes' are themselves branch
+        points, i.e. LCAs of disagreeing lineages from an earlier find_lca.
+        """
+        return self.fold_lca(nodes, branched)[0]
+
+    def fold_lca(self, nodes, branched=None):
+        "As for 'find_lca', but return (lca, whether the paths branch there)."
+        parent = self.parent
+        depth = self.depth
+
+        nodes = iter(nodes)
+        if branched is None:
+            branched = itertools.repeat(False)
+        else:
+            branched = iter(branched)
+
+        lca = next(nodes, ROOT)
+        is_branch = next(branched, False)
+        for node, node_is_branch in zip(nodes, branched):
+            a, b = lca, node
+            while depth[a] > depth[b]:
+                a = parent[a]
+            while depth[b] > depth[a]:
+                b = parent[b]
+            while a != b:
+                a = parent[a]
+                b = parent[b]
+
+            if a == lca:                  # 'node' is at or below lca...
+                if not is_branch:         # ...so the path gets longer.
+                    lca, is_branch = node, node_is_branch
+            elif a == node:               # 'node' is above lca.
+                if node_is_branch:
+                    lca, is_branch = node, True
+            else:                         # a new branch above lca.
+                lca, is_branch = a, True
+
+        return lca, is_branch
+
+    def has_ambiguous_label(self, node, top=ROOT):
+        """
+        Is any label on the path to 'node' below the depth of 'top' ambiguous?
+        """
+        while self.depth[node] > self.depth[top]:
+            if self.label_node[self.label[node]] == -1:
+                return True
+            node = self.parent[node]
+        return False
+
+    def get_label_parents(self, nodes):
+        """
+        Map each ambiguous label on the paths to 'nodes' to the label of its
+        parent on the last of those paths that it is on.
+        """
+        label_parents = {}
+        if not self.n_ambiguous:
+            return label_parents
+
+        # the last path to write a label wins; so go backwards, keep first,
+        # and stop at nodes that a later path has already been through.
+        seen = set()
+        for node in reversed(nodes):
+            while node != ROOT and node not in seen:
+                seen.add(node)
+                label_id = self.label[node]
+                if self.label_node[label_id] == -1:
+                    label_parents.setdefault(label_id,
+                                             self.label[self.parent[node]])
+                node = self.parent[node]
+
+        return label_parents
+
+    def find_label_lca(self, label_ids, label_parents):
+        """
+        As for 'find_lca', but over the lineages ending at the (rank, name)
+        labels in 'label_ids', with the parents of ambiguous labels taken
+        from 'label_parents'.  Returns the lineage.
+        """
+        if not self.n_ambiguous:
+            node = self.find_lca([ self.label_node[label_id]
+                                   for label_id in label_ids ])
+            return self.get_lineage(node)
+
+        # build the tree of just these lineages, and find the LCA in that.
+        tree = LineageTrie()
+        nodes = []
+        for label_id in label_ids:
+            lineage = []
+            while label_id != 0:
+                lineage.append(self.labels[label_id])
+                node = self.label_node[label_id]
+                if node == -1:
+                    label_id = label_parents[label_id]
+                else:
+                    label_id = self.label[self.parent[node]]
+            lineage.reverse()
+            nodes.append(tree.add(lineage))
+
+        return tree.get_lineage(tree.find_lca(nodes))
+
+
+def test_add():
+    trie = LineageTrie()
+    a = trie.add([('rank1', 'name1'), ('rank2', 'name2')])
+    b = trie.add([('rank1', 'name1'), ('rank2', ''), ('rank3', 'name3')])
+    assert trie.add([('rank1', 'name1'), ('rank2', 'name2')]) == a
+    assert trie.add([('rank1', ''), ('rank2', '')]) == ROOT
+
+    assert trie.get_lineage(a) == [('rank1', 'name1'), ('rank2', 'name2')]
+    assert trie.get_lineage(b) == [('rank1', 'name1'), ('rank3', 'name3')]
+    assert trie.parent[a] == trie.parent[b]
+    assert trie.depth[a] == 2
+    assert trie.n_ambiguous == 0
+
+
+def test_find_lca():
+    trie = LineageTrie()
+    a = trie.add([('rank1', 'name1'), ('rank2', 'name2a')])
+    b = trie.add([('rank1', 'name1'), ('rank2', 'name2b')])
+    c = trie.add([('rank1', 'name1')])
+    d = trie.add([('rank1', 'other')])
+
+    assert trie.find_lca([a]) == a
+    assert trie.find_lca([a, a]) == a
+    assert trie.get_lineage(trie.find_lca([a, b])) == [('rank1', 'name1')]
+    assert trie.find_lca([a, b, c]) == c
+    assert trie.find_lca([a, b, d]) == ROOT
+    assert trie.find_lca([]) == ROOT
+
+
+def test_find_lca_prefix():
+    # a lineage that is a prefix of another doesn't count against it.
+    trie = LineageTrie()
+    a = trie.add([('rank1', 'name1'), ('rank2', 'name2')])
+    c = trie.add([('rank1', 'name1')])
+
+    assert trie.find_lca([c, a]) == a
+    assert trie.find_lca([a, c]) == a
+    assert trie.find_lca([ROOT, a]) == a
+
+
+def test_ambiguous_labels():
+    trie = LineageTrie()
+    a = trie.add([('rank1', 'name1a'), ('rank2', 'name2')])
+    b = trie.add([('rank1', 'name1b'), ('rank2', 'name2')])
+    assert trie.n_ambiguous == 1
+    assert trie.has_ambiguous_label(a)
+    assert not trie.has_ambiguous_label(trie.parent[a])
+    assert not trie.has_ambiguous_label(a, a)
+
+    name2 = trie.label[a]
+    assert trie.label[b] == name2
+    assert trie.get_label_parents([a, b]) == { name2: trie.label[trie.parent[b]] }
+    assert trie.get_label_parents([b, a]) == { name2: trie.label[trie.parent[a]] }
+
+    label_parents = trie.get_label_parents([b, a])
+    assert trie.find_label_lca([name2], label_parents) == \
+        [('rank1', 'name1a'), ('rank2', 'name2')]
+
+
+def test_fold_lca_branched():
+    trie = LineageTrie()
+    a = trie.add([('rank1', 'name1'), ('rank2', 'name2a')])
+    b = trie.add([('rank1', 'name1'), ('rank2', 'name2b')])
+    c = trie.add([('rank1', 'name1')])
+    d = trie.add([('rank1', 'name1'), ('rank2', 'name2a'), ('rank3', 'name3')])
+
+    assert trie.fold_lca([a, b]) == (c, True)
+    assert trie.fold_lca([a, d]) == (d, False)
+
+    # folding in an earlier LCA gives the same answer as all the nodes.
+    lca, is_branch = trie.fold_lca([a, b])
+    assert trie.fold_lca([lca, d], [is_branch, False]) == \
+        trie.fold_lca([a, b, d])
+    assert trie.fold_lca([d, lca], [False, is_branch]) == (c, True)
@@ -0,0 +1,38 @@
+#! /usr/bin/env python
+"""
+Compile NCBI nodes.dmp + names.dmp into a compact, mmap-able '.taxdb' file.
+
+Usage::
+
+   make-taxdb.py genbank/nodes.dmp genbank/names.dmp
+
+This writes 'genbank/nodes.dmp.taxdb', which is then picked up in place of
+the .dmp files (and their pickle caches) by all the scripts here.
+"""
+import argparse
+
+import ncbi_taxdump_utils
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('nodes_dmp')
+    p.add_argument('names_dmp')
+    p.add_argument('-o', '--output', help='default: <nodes_dmp>.taxdb')
+    args = p.parse_args()
+
+    output = args.output or args.nodes_dmp + '.taxdb'
+
+    taxfoo = ncbi_taxdump_utils.NCBI_TaxonomyFoo()
+    print('loading taxonomic nodes from:', args.nodes_dmp)
+    taxfoo.load_nodes_dmp(args.nodes_dmp, False)
+    print('loading taxonomic names from:', args.names_dmp)
+    taxfoo.load_names_dmp(args.names_dmp, False)
+
+    compact = ncbi_taxdump_utils.NCBI_CompactTaxonomyFoo.from_taxonomy(taxfoo)
+    print('saving compact taxonomy to:', output)
+    compact.save_taxonomy_db(output)
+
+
+if __name__ == '__main__':
+    main()
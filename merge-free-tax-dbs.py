@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+"""
+Merge several databases built by 'free-tax-1.py' (v3, or v2 JSON) into
+one v3 database with a single lineage table, so that 'free-tax-2.py'
+looks each query hashval up once rather than once per database.
+
+Usage::
+
+   merge-free-tax-dbs.py merged.lca tara-delmont.lca tara-tully.lca genbank.lca
+
+The databases must have the same ksize and scaled.  Classifying against
+the merged database gives the same results as giving all of them to
+'free-tax-2.py --db'.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+
+import lineage_db
+
+
+def load_free_tax_2():
+    "Import free-tax-2.py, for its database loading and merging."
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'free-tax-2.py')
+    spec = importlib.util.spec_from_file_location('free_tax_2', filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('lca_db_out')
+    p.add_argument('lca_dbs', nargs='+')
+    args = p.parse_args()
+
+    free_tax_2 = load_free_tax_2()
+
+    dblist = []
+    for db_name in args.lca_dbs:
+        print('loading database {}'.format(db_name), file=sys.stderr)
+        lca_db = free_tax_2.LCA_Database()
+        lca_db.load(db_name)
+        dblist.append(lca_db)
+
+    free_tax_2.check_stacked_lca_lineages(dblist)
+    merged = free_tax_2.merge_databases(dblist)
+    print('merged {} databases: {} hashvals, {} lineages'.format(len(dblist), len(merged.hashvals), len(merged.lineage_dict)), file=sys.stderr)
+
+    lca_lineages = [ lineage_id for lineage_id, branched in
+                     enumerate(merged.lineage_branched.tolist()) if branched ]
+    print('saving to LCA DB v3: {}'.format(args.lca_db_out))
+    lineage_db.save_lineage_db(args.lca_db_out, merged.ksize, merged.scaled,
+                               merged.lineage_dict, merged.hashvals,
+                               merged.offsets, merged.lineage_ids,
+                               merged.signatures_to_lineage,
+                               lca_lineages=lca_lineages)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,8 +5,18 @@ Utilities to deal with NCBI taxonomic foo.
 import gzip
 import csv
 import os
+import subprocess
+import sys
 from pickle import dump, load
 import collections
+import collections.abc
+import functools
+import itertools
+from array import array
+
+import numpy
+
+import lca_index
 
 
 names_mem_cache = {}
@@ -15,6 +25,8 @@ nodes_mem_cache = {}
 
 want_taxonomy = ['superkingdom', 'phylum', 'order', 'class', 'family', 'genus', 'species']
 
+LINEAGE_CACHE_SIZE = 2**17                # lineages memoized per taxonomy
+
 
 class NCBI_TaxonomyFoo(object):
     def __init__(self):
@@ -22,8 +34,16 @@ class NCBI_TaxonomyFoo(object):
         self.node_to_info = None
         self.taxid_to_names = None
         self.accessions = None
+        self.lca_depth = None
+        self.lca_up = None
+        self.parent_and_depth = None
+        self.clear_lineage_cache()
 
     def load_nodes_dmp(self, filename, do_save_cache=True):
+        self.parent_and_depth = None
+        self.lca_depth = None
+        self.lca_up = None
+        self.clear_lineage_cache()
         if filename in nodes_mem_cache:
             self.child_to_parent, self.node_to_info = nodes_mem_cache[filename]
             return
@@ -44,6 +64,7 @@ class NCBI_TaxonomyFoo(object):
             dump((self.child_to_parent, self.node_to_info), cache_fp)
 
     def load_names_dmp(self, filename, do_save_cache=True):
+        self.clear_lineage_cache()
         if filename in names_mem_cache:
             self.taxid_to_names = names_mem_cache[filename]
             return
@@ -62,8 +83,8 @@ class NCBI_TaxonomyFoo(object):
         with xopen(cache_file, 'wb') as cache_fp:
             dump(self.taxid_to_names, cache_fp)
 
-    def load_accessions_csv(self, filename):
-        self.accessions = load_genbank_accessions_csv(filename)
+    def load_accessions_csv(self, filename, do_save_cache=True):
+        self.accessions = load_accession_index(filename, do_save_cache)
 
     # get taxid
     def get_taxid(self, acc):
@@ -71,13 +92,112 @@ class NCBI_TaxonomyFoo(object):
         if acc.startswith('NZ_'):
             acc = acc[3:]
 
-        info = self.accessions.get(acc)
-        if not info:
-            return None
+        return self.accessions.get(acc)
 
-        taxid = info['taxid']
-        taxid = int(taxid)
-        return taxid
+    def get_parent_and_depth(self):
+        """
+        Return (parent, depth) numpy arrays indexed by taxid, with -1 for
+        missing parents and for the depth of taxids that aren't connected to
+        the root (see compute_depths).  Computed once, on first use.
+        """
+        if self.parent_and_depth is None:
+            children = numpy.fromiter(self.child_to_parent.keys(),
+                                      dtype=numpy.int64)
+            parents = numpy.fromiter(self.child_to_parent.values(),
+                                     dtype=numpy.int64)
+            max_taxid = max(children.max(), parents.max())
+            parent = numpy.full(max_taxid + 1, -1, dtype=numpy.int32)
+            parent[children] = parents
+
+            self.parent_and_depth = parent, compute_depths(parent)
+
+        return self.parent_and_depth
+
+    def build_lca_index(self):
+        """
+        Precompute depth and binary-lifting ancestor tables for the tree,
+        so that 'find_lca' costs O(log depth) per taxid instead of walking
+        and scanning full lineages.  Call once after 'load_nodes_dmp'.
+        """
+        self._set_lca_tables(self.get_parent_and_depth()[0])
+
+    def _set_lca_tables(self, parent):
+        # as in the path walk of 'find_lca', a taxid with no known parent
+        # (including those in subtrees that aren't connected to the root,
+        # and unknown taxids) hangs directly off the root.
+        parent = numpy.asarray(parent)
+        n_taxids = max(len(parent), int(parent.max()) + 1)
+        lca_parent = numpy.ones(n_taxids, dtype=numpy.int32)
+        lca_parent[:len(parent)] = numpy.where(parent >= 0, parent, 1)
+        lca_parent[1] = 1
+
+        depth = compute_depths(lca_parent)
+        if (depth < 0).any():             # cycles; cut them at the root.
+            lca_parent[depth < 0] = 1
+            depth = compute_depths(lca_parent)
+        parent = lca_parent
+
+        # up[k][taxid] is the 2**k'th ancestor of taxid (or the root).
+        up = [parent]
+        max_depth = int(depth.max())
+        while (1 << len(up)) <= max_depth:
+            up.append(up[-1][up[-1]])
+
+        self.lca_depth = array('i', numpy.asarray(depth, dtype=numpy.int32).tobytes())
+        self.lca_up = [ array('i', level.tobytes()) for level in up ]
+
+    def _find_lca_pair(self, a, b):
+        depth = self.lca_depth
+        up = self.lca_up
+
+        da, db = depth[a], depth[b]
+        if da < db:
+            a, b, da, db = b, a, db, da
+
+        # lift the deeper taxid up to the depth of the other one...
+        diff = da - db
+        k = 0
+        while diff:
+            if diff & 1:
+                a = up[k][a]
+            diff >>= 1
+            k += 1
+
+        if a == b:
+            return a
+
+        # ...and then lift both to just below their last common ancestor.
+        for k in range(len(up) - 1, -1, -1):
+            ua, ub = up[k][a], up[k][b]
+            if ua != ub:
+                a, b = ua, ub
+
+        return up[0][a]
+
+    def _find_lca_indexed(self, taxid_set):
+        depth = self.lca_depth
+        n_taxids = len(depth)
+
+        lca = None
+        for taxid in taxid_set:
+            # taxids past the end of the tables hang directly off the root.
+            if taxid >= n_taxids:
+                if lca is not None and lca != taxid:
+                    return 1
+                lca = taxid
+                continue
+
+            if lca is None:
+                lca = taxid
+            elif lca >= n_taxids:
+                return 1
+            else:
+                lca = self._find_lca_pair(lca, taxid)
+
+            if lca == 1:
+                return 1
+
+        return lca
 
     # code to find the last common ancestor from a set of taxids
     def find_lca(self, taxid_set):
@@ -85,6 +205,9 @@ class NCBI_TaxonomyFoo(object):
         if not taxid_set:
             return 1
 
+        if self.lca_up is not None:
+            return self._find_lca_indexed(taxid_set)
+
         # get the first full path
         taxid_set = set(taxid_set)        # make a copy
         taxid = taxid_set.pop()
@@ -148,45 +271,54 @@ class NCBI_TaxonomyFoo(object):
         """
         Extract the text taxonomic lineage in order (kingdom on down).
         """
-        taxid = int(taxid)
-
-        lineage = []
-        while 1:
-            if taxid not in self.node_to_info:
-                print('cannot find taxid {}; quitting.'.format(taxid))
-                break
-            rank = self.get_taxid_rank(taxid)
-            name = self.get_taxid_name(taxid)
-            if not want_taxonomy or rank in want_taxonomy:
-                lineage.insert(0, name)
-            taxid = self.get_taxid_parent(taxid)
-            if taxid == 1:
-                break
-
-        return lineage
-
+        return [ name for rank, name in
+                 self.get_lineage_tuple(taxid, want_taxonomy) ]
 
     def get_lineage_as_dict(self, taxid, want_taxonomy=None):
         """
         Extract the text taxonomic lineage in order (kingdom on down);
         return in dictionary.
         """
-        taxid = int(taxid)
+        # (built from the species up, so that the top one of any repeated
+        # rank wins.)
+        return dict(reversed(self.get_lineage_tuple(taxid, want_taxonomy)))
 
-        lineage = {}
+    def get_lineage_tuple(self, taxid, want_taxonomy=None):
+        """
+        Extract the taxonomic lineage in order (kingdom on down), as a tuple
+        of (rank, name).  Memoized in an LRU cache of LINEAGE_CACHE_SIZE
+        lineages; the tuple is shared between callers.
+        """
+        if want_taxonomy:
+            want_taxonomy = tuple(want_taxonomy)
+        else:
+            want_taxonomy = None
+
+        return self._lineage_cache(int(taxid), want_taxonomy)
+
+    def lineage_cache_info(self):
+        "Hits and misses for get_lineage_tuple, as a functools CacheInfo."
+        return self._lineage_cache.cache_info()
+
+    def clear_lineage_cache(self):
+        self._lineage_cache = \
+          functools.lru_cache(maxsize=LINEAGE_CACHE_SIZE)(self._build_lineage_tuple)
+
+    def _build_lineage_tuple(self, taxid, want_taxonomy):
+        lineage = []
         while 1:
             if taxid not in self.node_to_info:
                 print('cannot find taxid {}; quitting.'.format(taxid))
                 break
             rank = self.get_taxid_rank(taxid)
-            name = self.get_taxid_name(taxid)
             if not want_taxonomy or rank in want_taxonomy:
-                lineage[rank] = name
+                lineage.append((rank, self.get_taxid_name(taxid)))
             taxid = self.get_taxid_parent(taxid)
             if taxid == 1:
                 break
 
-        return lineage
+        lineage.reverse()
+        return tuple(lineage)
 
     def get_lowest_lineage(self, taxids, want_taxonomy):
         """\
@@ -244,7 +376,289 @@ class NCBI_TaxonomyFoo(object):
         return (None, None, None)
 
 
+class NCBI_CompactTaxonomyFoo(NCBI_TaxonomyFoo):
+    """
+    Array-backed taxonomy: parent, rank code and depth are dense columns
+    indexed by taxid, and names are stored in one utf-8 blob plus offsets.
+    Saved as a flat binary '.taxdb' file that is loaded by mmap.
+
+    'child_to_parent', 'node_to_info' and 'taxid_to_names' are read-only
+    mapping views over the columns, for code that uses them directly;
+    only the rank and the scientific name are kept.
+    """
+    def __init__(self):
+        NCBI_TaxonomyFoo.__init__(self)
+        self.parent = None
+        self.rank_code = None
+        self.depth = None
+        self.name_offsets = None
+        self.name_blob = None
+        self.ranks = None
+
+    @classmethod
+    def from_taxonomy(cls, taxfoo):
+        "Build from an NCBI_TaxonomyFoo with nodes and names loaded."
+        self = cls()
+
+        max_taxid = max(max(taxfoo.child_to_parent),
+                        max(taxfoo.child_to_parent.values()))
+        parent = numpy.full(max_taxid + 1, -1, dtype=numpy.int32)
+        rank_code = numpy.full(max_taxid + 1, NO_RANK, dtype=numpy.uint8)
+
+        ranks = sorted(set([ info[0] for info in taxfoo.node_to_info.values() ]))
+        assert len(ranks) < NO_RANK
+        rank_to_code = dict([ (rank, i) for (i, rank) in enumerate(ranks) ])
+
+        for taxid, parent_taxid in taxfoo.child_to_parent.items():
+            parent[taxid] = parent_taxid
+            rank_code[taxid] = rank_to_code[taxfoo.node_to_info[taxid][0]]
+
+        names = []
+        name_offsets = numpy.zeros(max_taxid + 2, dtype=numpy.uint64)
+        pos = 0
+        for taxid in range(max_taxid + 1):
+            info = taxfoo.taxid_to_names.get(taxid)
+            if info:
+                name = info[0].encode('utf-8')
+                names.append(name)
+                pos += len(name)
+            name_offsets[taxid + 1] = pos
+
+        self.parent = parent
+        self.rank_code = rank_code
+        self.depth = compute_depths(parent)
+        self.name_offsets = name_offsets
+        self.name_blob = numpy.frombuffer(b''.join(names), dtype=numpy.uint8)
+        self.ranks = ranks
+
+        self._set_views()
+        return self
+
+    def save_taxonomy_db(self, filename):
+        header = dict(type='ncbi_taxonomy', version=1, ranks=self.ranks)
+        lca_index.save_arrays(filename, header,
+                              [('parent', self.parent),
+                               ('rank_code', self.rank_code),
+                               ('depth', self.depth),
+                               ('name_offsets', self.name_offsets),
+                               ('name_blob', self.name_blob)])
+
+    def load_taxonomy_db(self, filename):
+        header, arrays = lca_index.load_arrays(filename)
+        assert header['type'] == 'ncbi_taxonomy'
+        assert header['version'] == 1
+
+        self.parent = arrays['parent']
+        self.rank_code = arrays['rank_code']
+        self.depth = arrays['depth']
+        self.name_offsets = arrays['name_offsets']
+        self.name_blob = arrays['name_blob']
+        self.ranks = header['ranks']
+
+        self._set_views()
+        self.clear_lineage_cache()
+
+    def _set_views(self):
+        self.child_to_parent = _ParentView(self)
+        self.node_to_info = _InfoView(self)
+        self.taxid_to_names = _NamesView(self)
+
+    def has_taxid(self, taxid):
+        return 0 <= taxid < len(self.parent) and self.parent[taxid] >= 0
+
+    def get_taxid_name(self, taxid):
+        if not self.has_taxid(taxid):
+            return None
+
+        start = int(self.name_offsets[taxid])
+        end = int(self.name_offsets[taxid + 1])
+        if start == end:
+            return None
+        return self.name_blob[start:end].tobytes().decode('utf-8')
+
+    def get_taxid_rank(self, taxid):
+        if not self.has_taxid(taxid):
+            return None
+
+        return self.ranks[self.rank_code[taxid]]
+
+    def get_taxid_parent(self, taxid):
+        if not self.has_taxid(taxid):
+            return None
+
+        return int(self.parent[taxid])
+
+    def get_parent_and_depth(self):
+        return self.parent, self.depth
+
+
+class _ParentView(collections.abc.Mapping):
+    def __init__(self, taxfoo):
+        self.taxfoo = taxfoo
+
+    def __getitem__(self, taxid):
+        if not self.taxfoo.has_taxid(taxid):
+            raise KeyError(taxid)
+        return self._value(taxid)
+
+    def __contains__(self, taxid):
+        return self.taxfoo.has_taxid(taxid)
+
+    def __iter__(self):
+        for taxid in numpy.flatnonzero(numpy.asarray(self.taxfoo.parent) >= 0):
+            yield int(taxid)
+
+    def __len__(self):
+        return int((numpy.asarray(self.taxfoo.parent) >= 0).sum())
+
+    def _value(self, taxid):
+        return int(self.taxfoo.parent[taxid])
+
+
+class _InfoView(_ParentView):
+    def _value(self, taxid):
+        return (self.taxfoo.get_taxid_rank(taxid),)
+
+
+class _NamesView(_ParentView):
+    def __getitem__(self, taxid):
+        name = self.taxfoo.get_taxid_name(taxid)
+        if name is None:
+            raise KeyError(taxid)
+        return (name, '', 'scientific name')
+
+    def __contains__(self, taxid):
+        return self.taxfoo.get_taxid_name(taxid) is not None
+
+    def __iter__(self):
+        offsets = numpy.asarray(self.taxfoo.name_offsets)
+        for taxid in numpy.flatnonzero(offsets[1:] > offsets[:-1]):
+            yield int(taxid)
+
+    def __len__(self):
+        offsets = numpy.asarray(self.taxfoo.name_offsets)
+        return int((offsets[1:] > offsets[:-1]).sum())
+
+
+class AccessionIndex(object):
+    """
+    Sorted table of accession -> taxid: a column of fixed-width accession
+    byte strings, searched by bisection, and a parallel column of taxids.
+    Saved as a flat binary '.accidx' file that is loaded by mmap.
+    """
+    def __init__(self, accessions, taxids):
+        assert len(accessions) == len(taxids)
+        self.accessions = accessions
+        self.taxids = taxids
+
+    @classmethod
+    def from_dict(cls, acc_to_taxid):
+        "Build from an accession -> taxid dictionary."
+        accs = sorted([ acc.encode('utf-8') for acc in acc_to_taxid ])
+        width = max([ len(acc) for acc in accs ] + [1])
+        accessions = numpy.array(accs, dtype='S{}'.format(width))
+        taxids = numpy.array([ acc_to_taxid[acc.decode('utf-8')]
+                               for acc in accs ], dtype=numpy.uint32)
+        return cls(accessions, taxids)
+
+    def save(self, filename):
+        header = dict(type='accession_taxids', version=1)
+        lca_index.save_arrays(filename, header,
+                              [('accessions', self.accessions),
+                               ('taxids', self.taxids)])
+
+    @classmethod
+    def load(cls, filename):
+        header, arrays = lca_index.load_arrays(filename)
+        assert header['type'] == 'accession_taxids'
+        assert header['version'] == 1
+
+        return cls(arrays['accessions'], arrays['taxids'])
+
+    def get(self, acc, default=None):
+        key = acc.encode('utf-8')
+        if len(key) > self.accessions.dtype.itemsize:
+            return default
+
+        i = int(numpy.searchsorted(self.accessions, key))
+        if i < len(self.accessions) and self.accessions[i] == key:
+            return int(self.taxids[i])
+        return default
+
+    def __contains__(self, acc):
+        return self.get(acc) is not None
+
+    def __len__(self):
+        return len(self.accessions)
+
+
+def load_accession_index(filename, do_save_cache=True):
+    """
+    Load the accession -> taxid information in a genbank accessions CSV
+    file.  The first time, the CSV is parsed and compiled into an
+    AccessionIndex, saved as '<filename>.accidx'; after that, the index is
+    loaded instead.  'filename' can also be an '.accidx' file itself.
+    """
+    if lca_index.is_lca_index(filename):
+        index_file = filename
+    else:
+        index_file = filename + '.accidx'
+
+    if os.path.exists(index_file):
+        print('loading accession -> taxid index from:', index_file)
+        return AccessionIndex.load(index_file)
+
+    accessions = AccessionIndex.from_dict(load_genbank_accession_taxids(filename))
+    if do_save_cache:
+        print('saving accession -> taxid index to:', index_file)
+        accessions.save(index_file)
+
+    return accessions
+
+
+def load_taxonomy(nodes_file, names_file=None, do_save_cache=True):
+    """
+    Load the NCBI taxonomy for the given nodes.dmp/names.dmp.  If a
+    compact '.taxdb' file exists next to nodes.dmp (see make-taxdb.py),
+    mmap that instead of loading the .dmp files.
+    """
+    taxdb_file = nodes_file + '.taxdb'
+    if os.path.exists(taxdb_file):
+        print('loading compact taxonomy from:', taxdb_file)
+        taxfoo = NCBI_CompactTaxonomyFoo()
+        taxfoo.load_taxonomy_db(taxdb_file)
+        return taxfoo
+
+    taxfoo = NCBI_TaxonomyFoo()
+    taxfoo.load_nodes_dmp(nodes_file, do_save_cache)
+    if names_file:
+        taxfoo.load_names_dmp(names_file, do_save_cache)
+
+    return taxfoo
+
+
 ### internal utility functions
+NO_RANK = 255
+
+
+def compute_depths(parent):
+    """
+    Given a numpy array of parent taxids indexed by taxid (-1 for missing),
+    return an int32 array of depths below the root (taxid 1); -1 for taxids
+    that aren't connected to the root.
+    """
+    parent = numpy.asarray(parent)
+    depth = numpy.full(len(parent), -1, dtype=numpy.int32)
+    depth[1] = 0
+    while 1:
+        todo = (depth == -1) & (parent >= 0)
+        todo[todo] = depth[parent[todo]] >= 0
+        if not todo.any():
+            break
+        depth[todo] = depth[parent[todo]] + 1
+
+    return depth
+
 def xopen(filename, mode):
     if filename.endswith('.gz'):
         return gzip.open(filename, mode)
@@ -305,3 +719,147 @@ def load_genbank_accessions_csv(filename):
             accessions[acc] = row
 
     return accessions
+
+
+def load_genbank_accession_taxids(filename):
+    """
+    Load just the accession -> taxid information from a genbank accessions
+    CSV file (see 'load_genbank_accessions_csv'); accessions without a
+    taxid are skipped.
+    """
+    print('loading genbank accession -> taxid info')
+    acc_to_taxid = {}
+    with xopen(filename, 'rt') as fp:
+        for row in csv.reader(fp):
+            if len(row) > 1 and row[1].isdigit():
+                acc_to_taxid[row[0]] = int(row[1])
+
+    return acc_to_taxid
+
+
+### tests
+
+# taxid -> (parent, rank, name); 10 and 11 hang off 50, which isn't in
+# the tree, and so (as far as 'find_lca' is concerned) off the root.
+TEST_NODES = { 1: (1, 'no rank', 'root'),
+               2: (1, 'superkingdom', 'Bacteria'),
+               3: (2, 'phylum', 'Proteobacteria'),
+               4: (3, 'class', 'Gammaproteobacteria'),
+               5: (3, 'class', 'Alphaproteobacteria'),
+               6: (2, 'phylum', 'Firmicutes'),
+               7: (6, 'no rank', 'unclassified Firmicutes'),
+               8: (7, 'class', 'Bacilli'),
+               9: (1, 'superkingdom', 'Archaea'),
+               10: (50, 'species', 'orphan a'),
+               11: (50, 'species', 'orphan b') }
+
+
+def _write_test_dmp(dirname, nodes=TEST_NODES):
+    nodes_file = os.path.join(dirname, 'nodes.dmp')
+    names_file = os.path.join(dirname, 'names.dmp')
+    with open(nodes_file, 'wt') as fp:
+        for taxid, (parent, rank, _) in sorted(nodes.items()):
+            fields = [taxid, parent, rank] + [''] * 10
+            fp.write('\t|\t'.join(map(str, fields)) + '\t|\n')
+    with open(names_file, 'wt') as fp:
+        for taxid, (_, _, name) in sorted(nodes.items()):
+            fields = [taxid, name, '', 'scientific name']
+            fp.write('\t|\t'.join(map(str, fields)) + '\t|\n')
+
+    return nodes_file, names_file
+
+
+def test_find_lca_indexed(tmpdir):
+    nodes_file, _ = _write_test_dmp(str(tmpdir))
+    taxfoo = NCBI_TaxonomyFoo()
+    taxfoo.load_nodes_dmp(nodes_file, False)
+    indexed = NCBI_TaxonomyFoo()
+    indexed.load_nodes_dmp(nodes_file, False)
+    indexed.build_lca_index()
+
+    assert indexed.find_lca([4, 5]) == 3
+    assert indexed.find_lca([4, 8]) == 2
+    assert indexed.find_lca([10, 11]) == 50          # missing parent
+    assert indexed.find_lca([4, 10]) == 1
+    assert indexed.find_lca([1, 4]) == 1             # root
+    assert indexed.find_lca([99]) == 99              # unknown taxids
+    assert indexed.find_lca([20, 4]) == 1
+    assert indexed.find_lca([]) == 1
+
+    # ...and everything agrees with the path walk.
+    taxids = list(TEST_NODES) + [20, 50, 99]
+    for n in (1, 2, 3):
+        for taxid_set in itertools.combinations(taxids, n):
+            assert indexed.find_lca(taxid_set) == taxfoo.find_lca(taxid_set), taxid_set
+
+
+def test_load_nodes_dmp_resets_lca_index(tmpdir):
+    nodes_file, _ = _write_test_dmp(str(tmpdir))
+    taxfoo = NCBI_TaxonomyFoo()
+    taxfoo.load_nodes_dmp(nodes_file, False)
+    taxfoo.build_lca_index()
+    assert taxfoo.find_lca([4, 5]) == 3
+
+    # move class 5 under Firmicutes.
+    nodes = dict(TEST_NODES)
+    nodes[5] = (6, 'class', 'Alphaproteobacteria')
+    tmpdir.mkdir('v2')
+    nodes_file, _ = _write_test_dmp(str(tmpdir.join('v2')), nodes)
+    taxfoo.load_nodes_dmp(nodes_file, False)
+
+    assert taxfoo.lca_up is None
+    assert taxfoo.find_lca([4, 5]) == 2
+
+
+def test_compact_taxonomy(tmpdir):
+    nodes_file, names_file = _write_test_dmp(str(tmpdir))
+    make_taxdb = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'make-taxdb.py')
+    subprocess.check_call([sys.executable, make_taxdb, nodes_file, names_file])
+
+    taxfoo = NCBI_TaxonomyFoo()
+    taxfoo.load_nodes_dmp(nodes_file, False)
+    taxfoo.load_names_dmp(names_file, False)
+    compact = load_taxonomy(nodes_file, names_file, False)
+    assert isinstance(compact, NCBI_CompactTaxonomyFoo)
+
+    taxids = list(TEST_NODES) + [20, 50, 99]
+    for taxid in taxids:
+        assert compact.get_taxid_rank(taxid) == taxfoo.get_taxid_rank(taxid)
+        assert compact.get_taxid_name(taxid) == taxfoo.get_taxid_name(taxid)
+        if taxid in TEST_NODES:
+            assert compact.get_lineage_tuple(taxid) == \
+              taxfoo.get_lineage_tuple(taxid)
+            assert compact.get_lineage(taxid, want_taxonomy) == \
+              taxfoo.get_lineage(taxid, want_taxonomy)
+
+    compact.build_lca_index()
+    for taxid_set in itertools.combinations(taxids, 2):
+        assert compact.find_lca(taxid_set) == taxfoo.find_lca(taxid_set)
+
+
+def test_accession_index(tmpdir):
+    csv_file = str(tmpdir.join('accessions.csv'))
+    with open(csv_file, 'wt') as fp:
+        fp.write('NC_000913.3,511145,Bacteria;Proteobacteria\n')
+        fp.write('AB1.1,562,Bacteria;Proteobacteria\n')
+        fp.write('NZ_CP009072.1,1,\n')
+        fp.write('CP0001.1,,\n')                  # no taxid; skipped.
+
+    accessions = load_accession_index(csv_file)
+    assert os.path.exists(csv_file + '.accidx')
+    for accessions in (accessions, load_accession_index(csv_file),
+                       load_accession_index(csv_file + '.accidx')):
+        assert len(accessions) == 3
+        assert accessions.accessions.dtype.itemsize == len('NZ_CP009072.1')
+
+        assert accessions.get('NC_000913.3') == 511145
+        assert accessions.get('AB1.1') == 562       # shorter than the width
+        assert accessions.get('NZ_CP009072.1') == 1
+        assert 'AB1.1' in accessions
+
+        assert accessions.get('CP0001.1') is None
+        assert accessions.get('NC_000913') is None  # prefix of an accession
+        assert accessions.get('AB1.10') is None
+        assert accessions.get('NZ_CP009072.10', 0) == 0  # wider than any
+        assert 'XY1.1' not in accessions
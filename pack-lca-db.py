@@ -0,0 +1,42 @@
+#! /usr/bin/env python
+"""
+Convert an LCA database built by 'extract.py' (pickled, possibly gzipped,
+or an index) into the compressed 'packed' index format.
+
+Usage::
+
+   pack-lca-db.py db.lca.gz db.lca.packed
+
+and then point the 'lca_db' entry in the lca.json file at the new file.
+"""
+import argparse
+import os
+
+import lca_index
+import lca_json
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('lca_input')
+    p.add_argument('lca_output')
+    args = p.parse_args()
+
+    if args.lca_output.endswith('.gz'):
+        p.error('cannot mmap a gzipped index')
+
+    print('loading LCA database from:', args.lca_input)
+    hashval_to_lca = lca_json.load_lca_file(args.lca_input)
+
+    print('packing {} hashvals'.format(len(hashval_to_lca)))
+    packed = lca_index.PackedLCA_Index.from_arrays(hashval_to_lca.hashvals,
+                                                   hashval_to_lca.taxids)
+    packed.save(args.lca_output)
+
+    print('saved to {}: {} bytes, from {} bytes'.format(args.lca_output,
+                                                        os.path.getsize(args.lca_output),
+                                                        os.path.getsize(args.lca_input)))
+
+
+if __name__ == '__main__':
+    main()
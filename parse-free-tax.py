@@ -103,9 +103,8 @@ def main():
 
     # ok, read in all the tax info.
     print('loading NCBI tax names/nodes', file=sys.stderr)
-    taxfoo = ncbi_taxdump_utils.NCBI_TaxonomyFoo()
-    taxfoo.load_names_dmp(args.names_dmp, False)
-    taxfoo.load_nodes_dmp(args.nodes_dmp, False)
+    taxfoo = ncbi_taxdump_utils.load_taxonomy(args.nodes_dmp, args.names_dmp,
+                                              False)
 
     # reverse index names -> taxids
     names_to_taxids = defaultdict(set)
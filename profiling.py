@@ -0,0 +1,113 @@
+"""
+Wall-clock time and memory measurement, per phase of a run.
+
+Used by benchmark.py and by the --profile-report option of the
+classifiers.  Memory is measured as resident set size (RSS).  On
+Linux, the peak RSS ('VmHWM') is reset at the start of each phase, so that
+'peak_rss' is the peak during that phase; elsewhere it is the peak for the
+whole process so far.
+"""
+import json
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def current_rss():
+    "Current resident set size in bytes, or None if unavailable."
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss():
+    "Peak resident set size in bytes."
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':         # bytes on macOS, kB elsewhere.
+        return maxrss
+    return maxrss * 1024
+
+
+def reset_peak_rss():
+    "Reset the peak RSS to the current RSS; returns False if unsupported."
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class Profile(object):
+    """
+    A list of timed phases.  Use as::
+
+       profile = Profile()
+       with profile.phase('load', filename=filename) as record:
+           ...
+           record['n_hashes'] = n
+
+    Each phase is recorded as a dictionary with its name, any extra info,
+    'seconds', 'rss' (at the end of the phase) and 'peak_rss'.  If
+    'enabled' is False, nothing is measured or recorded.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, **info):
+        record = OrderedDict(name=name)
+        record.update(info)
+        if not self.enabled:
+            yield record
+            return
+
+        is_phase_peak = reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['rss'] = current_rss()
+            record['peak_rss'] = peak_rss()
+            record['peak_rss_is_per_phase'] = is_phase_peak
+            self.phases.append(record)
+
+    def save(self, fp, **info):
+        "Write the phases, and any extra top-level info, as JSON to 'fp'."
+        report = OrderedDict(info)
+        # the peak is reset for each phase, so take the largest of them.
+        report['peak_rss'] = max([ phase['peak_rss'] for phase in self.phases ]
+                                 + [ peak_rss() ])
+        report['phases'] = self.phases
+        json.dump(report, fp, indent=2)
+        fp.write('\n')
+
+    def write_report(self, filename, **info):
+        "Save to 'filename', or to stderr if 'filename' is '-'."
+        if filename == '-':
+            self.save(sys.stderr, **info)
+        else:
+            with open(filename, 'wt') as fp:
+                self.save(fp, **info)
+
+
+def add_profile_report_option(parser):
+    "Add the --profile-report option to an argparse parser."
+    parser.add_argument('--profile-report', nargs='?', const='-',
+                        metavar='FILE',
+                        help='write per-phase timings and memory use as JSON to FILE (default: stderr)')
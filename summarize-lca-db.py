@@ -55,10 +55,12 @@ def main():
     
     for ksize in ksizes:
         #assert ksize not in ksize_to_rank_counts
-        taxfoo, hashval_to_lca, scaled = lca_db.get_database(ksize, None)
+        db = lca_db.get_handle(ksize)
 
-        rank_counts = summarize_lca_db(taxfoo, hashval_to_lca)
+        # the taxonomy is loaded once and shared between the ksizes.
+        rank_counts = summarize_lca_db(db.taxfoo, db.hashval_to_lca)
         ksize_to_rank_counts[ksize] = rank_counts
+        db.close()
 
     # this should be enforced by summarize_lca_db(...)
     all_ranks = set()